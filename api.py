@@ -0,0 +1,547 @@
+"""JSON API (/api/v1) for timelines, profiles and follow/like lists.
+
+Lists are paginated with keyset cursors: every response carries a
+`next_cursor`, which is passed back as `?cursor=` to get the following
+page, so deep pages cost the same as the first one. `?limit=` sets the
+page size (up to MAX_LIMIT) and `?fields=id,text,...` picks the fields.
+
+Queries select only the requested columns and the rows are serialized
+straight from their tuples; no ORM objects are built on the way.
+Messages can be on any shard (see shards.py), so message lists ask every
+shard for a page and merge them, and take their authors' fields from the
+user card cache.
+
+Likes and follows can also be written in bulk through /api/v1/batch.
+
+/api/v1/availability says whether a username or email is free, for the
+signup form to check as it's filled in.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from flask import Blueprint, Response, g, request
+from sqlalchemy import delete, func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from availability import FIELDS as AVAILABILITY_FIELDS, is_taken
+from caching import user_cards
+from models import db, User, Message, Follows, Likes
+from readmodels import MessageRow
+from shards import each_shard, message_rows, message_stats, user_shard
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MAX_BATCH_OPERATIONS = 500
+
+MESSAGE_FIELDS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'user_id': Message.user_id,
+    'username': User.username,
+    'image_url': User.image_url,
+}
+
+# the message fields that are the author's, from their user card
+AUTHOR_FIELDS = frozenset({'username', 'image_url'})
+
+USER_FIELDS = {
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+}
+
+PROFILE_FIELDS = dict(
+    USER_FIELDS,
+    messages_count=(select(func.count(Message.id))
+                    .where(Message.user_id == User.id)
+                    .scalar_subquery()),
+    following_count=(select(func.count())
+                     .select_from(Follows)
+                     .where(Follows.user_following_id == User.id)
+                     .scalar_subquery()),
+    followers_count=(select(func.count())
+                     .select_from(Follows)
+                     .where(Follows.user_being_followed_id == User.id)
+                     .scalar_subquery()),
+    likes_count=(select(func.count(Likes.id))
+                 .where(Likes.user_id == User.id)
+                 .scalar_subquery()),
+)
+
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False,
+                            check_circular=False)
+
+
+class ApiError(Exception):
+    """Error to send back to the client as JSON."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@api.errorhandler(ApiError)
+def handle_api_error(error):
+    return json_response(dict(error=error.message), error.status)
+
+
+##############################################################################
+# Serialization
+
+
+def json_response(obj, status=200):
+    """Compact JSON response for `obj`."""
+
+    return Response(_encoder.encode(obj), status=status,
+                    mimetype='application/json')
+
+
+def serialize_rows(names, rows):
+    """List of dicts for `rows` (tuples of values for the `names` fields).
+
+    Rows may carry extra trailing values (sort keys for the cursor);
+    those are left out. Datetimes are sent as ISO 8601 strings.
+    """
+
+    width = len(names)
+    datetimes = None
+    items = []
+
+    for row in rows:
+        if datetimes is None:
+            datetimes = [i for i in range(width) if isinstance(row[i], datetime)]
+        if datetimes:
+            row = list(row[:width])
+            for i in datetimes:
+                if row[i] is not None:
+                    row[i] = row[i].isoformat()
+        items.append(dict(zip(names, row)))
+
+    return items
+
+
+def encode_cursor(values):
+    """Opaque cursor string for a row's sort key `values`."""
+
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(_encoder.encode(values).encode()).decode()
+
+
+def decode_cursor(cursor, types):
+    """Sort key values from `cursor`, converted to `types`."""
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(types):
+            raise ValueError(cursor)
+        return [datetime.fromisoformat(v) if t is datetime else t(v)
+                for v, t in zip(values, types)]
+    except (ValueError, TypeError):
+        raise ApiError(400, 'Invalid cursor.')
+
+
+##############################################################################
+# Request parameters
+
+
+def requested_fields(available):
+    """Names of the fields asked for with ?fields= (default: all)."""
+
+    fields = request.args.get('fields')
+    if not fields:
+        return list(available)
+
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ApiError(400, f"Unknown fields: {', '.join(unknown)}")
+    return names
+
+
+def requested_limit():
+    """Page size asked for with ?limit=, capped at MAX_LIMIT."""
+
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError(400, 'Invalid limit.')
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def require_login():
+    if not g.user:
+        raise ApiError(401, 'Access unauthorized.')
+
+
+def get_user_id_or_404(user_id):
+    if not (db.session.query(User.id)
+            .filter(User.id == user_id, User.deleted_at.is_(None)).first()):
+        raise ApiError(404, 'User not found.')
+    return user_id
+
+
+##############################################################################
+# Queries
+
+
+def paginate(query, available, sort_keys, descending):
+    """Run `query` for one page of the requested fields and return the
+    JSON response for it.
+
+    `query` is a Core select with its FROM clause and filters in place;
+    the requested columns and the `sort_keys` columns are added here.
+    """
+
+    names = requested_fields(available)
+    limit = requested_limit()
+
+    key = tuple_(*sort_keys)
+    cursor = request.args.get('cursor')
+    if cursor:
+        values = decode_cursor(cursor, [c.type.python_type for c in sort_keys])
+        query = query.where(key < tuple_(*values) if descending
+                            else key > tuple_(*values))
+
+    order = [c.desc() if descending else c.asc() for c in sort_keys]
+    query = (query
+             .add_columns(*[available[name] for name in names], *sort_keys)
+             .order_by(*order)
+             .limit(limit + 1))
+
+    rows = db.session.execute(query).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][len(names):])
+
+    return json_response(dict(data=serialize_rows(names, rows),
+                              next_cursor=next_cursor))
+
+
+def message_values(names, messages):
+    """Rows of the `names` fields of `messages` (MessageRows), for
+    serialize_rows. Messages whose author is gone are left out."""
+
+    cards = user_cards({msg.user_id for msg in messages})
+    rows = []
+    for msg in messages:
+        card = cards.get(msg.user_id)
+        if card is not None:
+            rows.append([getattr(card if name in AUTHOR_FIELDS else msg, name)
+                         for name in names])
+    return rows
+
+
+def paginate_messages(criterion):
+    """The JSON response for one page of the messages matching
+    `criterion`, newest first, from every shard."""
+
+    names = requested_fields(MESSAGE_FIELDS)
+    limit = requested_limit()
+
+    statement = MessageRow.select().where(criterion)
+    cursor = request.args.get('cursor')
+    if cursor:
+        before = decode_cursor(cursor, [datetime, int])
+        statement = statement.where(tuple_(Message.timestamp, Message.id)
+                                    < tuple_(*before))
+
+    # each shard's page is in order; merged, the first limit + 1 are
+    rows = each_shard(statement
+                      .order_by(Message.timestamp.desc(), Message.id.desc())
+                      .limit(limit + 1))
+    messages = sorted((MessageRow(*row) for row in rows),
+                      key=lambda msg: (msg.timestamp, msg.id), reverse=True)
+
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = encode_cursor([messages[-1].timestamp, messages[-1].id])
+
+    return json_response(dict(data=serialize_rows(names,
+                                                  message_values(names, messages)),
+                              next_cursor=next_cursor))
+
+
+def users_select():
+    # closed accounts are left out until purge_user deletes them
+    return select().select_from(User).where(User.deleted_at.is_(None))
+
+
+##############################################################################
+# Endpoints
+
+
+@api.route('/timeline')
+def timeline():
+    """Messages by the users the logged-in user follows, newest first."""
+
+    require_login()
+
+    # the shards have no follows table to join
+    followed_ids = db.session.execute(
+        select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == g.user.id)).scalars().all()
+
+    return paginate_messages(Message.user_id.in_(followed_ids))
+
+
+@api.route('/users/<int:user_id>')
+def user_profile(user_id):
+    """A user's profile, with message/follow/like counts."""
+
+    names = requested_fields(PROFILE_FIELDS)
+    row = db.session.execute(
+        select(*[PROFILE_FIELDS[name] for name in names])
+        .where(User.id == user_id)
+    ).first()
+
+    if row is None:
+        raise ApiError(404, 'User not found.')
+
+    data = serialize_rows(names, [row])[0]
+    # counted in the main database above; the user's messages may be on
+    # another shard
+    if 'messages_count' in data and user_shard(user_id):
+        data['messages_count'], _ = message_stats(user_id)
+
+    return json_response(dict(data=data))
+
+
+@api.route('/availability')
+def availability():
+    """Whether `?username=` and/or `?email=` are free to sign up with."""
+
+    values = {field: request.args[field] for field in AVAILABILITY_FIELDS
+              if request.args.get(field)}
+    if not values:
+        raise ApiError(400, 'Pass a username or an email.')
+
+    return json_response(dict(data={field: dict(value=value,
+                                                 available=not is_taken(field, value))
+                                    for field, value in values.items()}))
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    get_user_id_or_404(user_id)
+
+    return paginate_messages(Message.user_id == user_id)
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Users this user follows."""
+
+    require_login()
+    get_user_id_or_404(user_id)
+    query = (users_select()
+             .join(Follows, Follows.user_being_followed_id == User.id)
+             .where(Follows.user_following_id == user_id))
+
+    return paginate(query, USER_FIELDS, [User.id], descending=False)
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """Users following this user."""
+
+    require_login()
+    get_user_id_or_404(user_id)
+    query = (users_select()
+             .join(Follows, Follows.user_following_id == User.id)
+             .where(Follows.user_being_followed_id == user_id))
+
+    return paginate(query, USER_FIELDS, [User.id], descending=False)
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Messages this user liked, most recently liked first."""
+
+    require_login()
+    get_user_id_or_404(user_id)
+
+    names = requested_fields(MESSAGE_FIELDS)
+    limit = requested_limit()
+
+    query = select(Likes.id, Likes.message_id).where(Likes.user_id == user_id)
+    cursor = request.args.get('cursor')
+    if cursor:
+        before, = decode_cursor(cursor, [int])
+        query = query.where(Likes.id < before)
+
+    likes = db.session.execute(query
+                               .order_by(Likes.id.desc())
+                               .limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(likes) > limit:
+        likes = likes[:limit]
+        next_cursor = encode_cursor([likes[-1].id])
+
+    # liked messages may since have been deleted or archived
+    found = message_rows([like.message_id for like in likes])
+    messages = [found[like.message_id] for like in likes
+                if like.message_id in found]
+
+    return json_response(dict(data=serialize_rows(names,
+                                                  message_values(names, messages)),
+                              next_cursor=next_cursor))
+
+
+##############################################################################
+# Batch writes
+#
+# Each operation is {"op": "like"|"unlike", "message_id": id} or
+# {"op": "follow"|"unfollow", "user_id": id}. Operations are collapsed to
+# the final state wanted for each like/follow, the current state of all
+# of them is read with one query per kind, and the changes are written
+# with one multi-row INSERT and one DELETE per kind, in one transaction.
+
+BATCH_OPERATIONS = {
+    # op: (kind, target key, wanted state)
+    'like': ('like', 'message_id', True),
+    'unlike': ('like', 'message_id', False),
+    'follow': ('follow', 'user_id', True),
+    'unfollow': ('follow', 'user_id', False),
+}
+
+
+def parse_operation(operation):
+    """(kind, target id, wanted state) for one batch operation, or an
+    error message if it's malformed."""
+
+    if not isinstance(operation, dict) or operation.get('op') not in BATCH_OPERATIONS:
+        return f"op must be one of {', '.join(BATCH_OPERATIONS)}"
+
+    kind, key, wanted = BATCH_OPERATIONS[operation['op']]
+    target = operation.get(key)
+    if not isinstance(target, int) or isinstance(target, bool):
+        return f"{key} must be an integer"
+    if kind == 'follow' and target == g.user.id:
+        return "can't follow yourself"
+
+    return kind, target, wanted
+
+
+def current_state(kind, targets):
+    """Sets of existing targets and of the current user's existing
+    likes/follows among `targets`."""
+
+    if kind == 'like':
+        existing = {row.id for row in
+                    each_shard(select(Message.id).where(Message.id.in_(targets)))}
+        present = select(Likes.message_id).where(
+            Likes.user_id == g.user.id, Likes.message_id.in_(targets))
+    else:
+        existing = set(db.session.execute(
+            select(User.id).where(User.id.in_(targets))).scalars())
+        present = select(Follows.user_being_followed_id).where(
+            Follows.user_following_id == g.user.id,
+            Follows.user_being_followed_id.in_(targets))
+
+    return existing, set(db.session.execute(present).scalars())
+
+
+def write_changes(kind, added, removed):
+    """Insert the `added` and delete the `removed` likes/follows, and
+    notify whoever's followed, or whose messages are liked."""
+
+    # notifications imports this module
+    from notifications import notify
+
+    if kind == 'like':
+        table, owner, target = Likes.__table__, Likes.user_id, Likes.message_id
+    else:
+        table, owner, target = (Follows.__table__, Follows.user_following_id,
+                                Follows.user_being_followed_id)
+
+    if added:
+        inserted = db.session.execute(
+            insert(table)
+            .values([{owner.key: g.user.id, target.key: t} for t in sorted(added)])
+            .on_conflict_do_nothing()
+            .returning(target)).scalars().all()
+        if kind == 'like':
+            authors = each_shard(select(Message.id, Message.user_id)
+                                 .where(Message.id.in_(inserted)))
+            for message_id, author_id in sorted(authors):
+                notify(author_id, g.user.id, 'like', message_id)
+        else:
+            for user_id in sorted(inserted):
+                notify(user_id, g.user.id, 'follow')
+    if removed:
+        db.session.execute(
+            delete(table).where(owner == g.user.id, target.in_(sorted(removed))))
+
+
+@api.route('/batch', methods=['POST'])
+def batch():
+    """Apply many likes, unlikes, follows and unfollows in one request.
+
+    Responds with one result per operation, in order: "ok" if it changed
+    something, "unchanged" if things already were that way, "superseded"
+    if a later operation in the batch overrode it, "not_found" or
+    "invalid" (with an "error") otherwise.
+    """
+
+    require_login()
+
+    body = request.get_json(silent=True)
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list):
+        raise ApiError(400, 'Expected {"operations": [...]}.')
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise ApiError(400, f"At most {MAX_BATCH_OPERATIONS} operations per batch.")
+
+    results = [None] * len(operations)
+    final = {}  # (kind, target) -> (index of the last operation, wanted)
+
+    for index, operation in enumerate(operations):
+        parsed = parse_operation(operation)
+        if isinstance(parsed, str):
+            results[index] = dict(status='invalid', error=parsed)
+            continue
+
+        kind, target, wanted = parsed
+        if (kind, target) in final:
+            results[final[kind, target][0]] = dict(status='superseded')
+        final[kind, target] = (index, wanted)
+
+    for kind in ('like', 'follow'):
+        wanted = {target: want for (k, target), (_, want) in final.items()
+                  if k == kind}
+        if not wanted:
+            continue
+
+        existing, present = current_state(kind, list(wanted))
+        added, removed = set(), set()
+
+        for target, want in wanted.items():
+            index = final[kind, target][0]
+            if target not in existing:
+                results[index] = dict(status='not_found')
+            elif want == (target in present):
+                results[index] = dict(status='unchanged')
+            else:
+                (added if want else removed).add(target)
+                results[index] = dict(status='ok')
+
+        write_changes(kind, added, removed)
+
+    db.session.commit()
+
+    return json_response(dict(results=results))
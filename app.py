@@ -1,37 +1,191 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   abort, current_app)
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, EditProfileForm
-from models import db, connect_db, User, Message, Likes
-
-from functions import collect_follower_messages
+from models import db, connect_db, User, Message, Likes, Repost
+from caching import init_fragment_cache, init_user_cards, invalidate_user_card
+from assets import init_assets
+from compression import init_compression
+from api import api
+from events import init_events, publish_message
+from export import init_export
+from slow_queries import init_slow_queries
+from availability import init_availability, taken_fields
+from jobs import init_jobs, enqueue, wake_workers, start_worker
+from tags import init_tags, tag_timeline, mentions_timeline
+from trending import init_trending, record_message
+from images import init_images, store_upload
+from partitions import init_partitions, find_archived_message
+from http_caching import (PRIVATE, PUBLIC, set_cache_policy, is_shareable,
+                          not_modified, apply_cache_policy)
+
+from functions import delete_message_rows, profile_page_version
+from readmodels import (init_readmodels, following_rows, follower_rows,
+                        user_rows, followed_user_ids)
+from shards import (init_shards, place_user, add_message, find_message,
+                    delete_message, user_message_rows,
+                    stream_user_message_rows, sharded_user_profile,
+                    sharded_profile_page_version, sharded_liked_message_rows,
+                    sharded_message_page_version)
+from streaming import render_page
+from threads import conversation, thread_page_version
+from reposts import BATCH_SIZE, init_reposts, home_timeline
+from notifications import init_notifications, notify
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+# immutable files are the same for everyone, so they don't read the
+# session (reading it has Flask add Vary: Cookie)
+SESSIONLESS_ENDPOINTS = frozenset(['assets', 'media'])
+
+# (rule, view, options) for every page; create_app adds them all to each
+# app it makes
+ROUTES = []
+
+
+def route(rule, **options):
+    """Like `app.route`, for every app create_app makes."""
+
+    def register(view):
+        ROUTES.append((rule, view, options))
+        return view
+    return register
+
+
+def default_config():
+    """Settings every app starts from, some read from the environment."""
+
+    return {
+        # Get DB_URI from environ variable (useful for production/testing)
+        # or, if not set there, use development local db.
+        'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL',
+                                                  'postgresql:///twitter_db'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SQLALCHEMY_ECHO': False,
+        'SECRET_KEY': os.environ.get('SECRET_KEY', "it's a secret"),
+
+        # Stream long pages (timelines, profiles) to the client as they
+        # render
+        'STREAM_TEMPLATES': os.environ.get('STREAM_TEMPLATES') == '1',
+        'STREAM_BUFFER_SIZE': 20,
+        'STREAM_CHUNK_SIZE': 50,
+
+        # 'shared' keeps user cards in one cache server for all worker
+        # processes (run it with `python caching.py serve`)
+        'USER_CARD_CACHE': os.environ.get('USER_CARD_CACHE', 'memory'),
+
+        # 'postgres' shares live timeline events between worker processes
+        'EVENTS_BROKER': os.environ.get('EVENTS_BROKER', 'local'),
+
+        # more databases to shard messages across, comma separated (see
+        # shards.py)
+        'SHARD_URLS': [url for url in os.environ.get('SHARD_URLS', '').split(',')
+                       if url],
+
+        # usernames allowed on the admin pages, comma separated
+        'ADMINS': [name for name in os.environ.get('ADMINS', '').split(',')
+                   if name],
+
+        # database connections warm_up opens in each worker
+        'WARM_CONNECTIONS': 2,
+    }
+
+
+def create_app(config=None):
+    """Make a Warbler app, with `config` (a dict) over the default config.
+
+    Nothing here touches the database: connections are only opened by the
+    first query, or by warm_up. So an app can be made in a server's
+    master process and forked into workers without them sharing sockets,
+    and several apps with different settings can live in one process.
+    """
+
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+
+    connect_db(app)
+    init_slow_queries(app)
+    init_shards(app)
+    init_availability(app)
+    init_fragment_cache(app)
+    init_user_cards(app)
+    init_jobs(app)
+    init_tags(app)
+    init_readmodels(app)
+    init_reposts(app)
+    init_notifications(app)
+    init_trending(app)
+    init_images(app)
+    init_partitions(app)
+    init_assets(app)
+    init_compression(app)
+    app.register_blueprint(api)
+    init_events(app)
+    init_export(app)
+
+    app.before_request(add_user_to_g)
+    for rule, view, options in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.after_request(add_header)
+
+    return app
+
+
+def warm_up(app):
+    """Get a freshly started worker ready to serve: compile every template,
+    open WARM_CONNECTIONS pooled database connections and build its
+    availability filter, so the first requests don't pay for any of it,
+    and start its job threads.
+
+    Call it in each worker after the fork (gunicorn's post_fork hook, say,
+    or asgi.py's lifespan startup), never before: connections opened
+    before a fork would be shared by every worker.
+    """
+
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+    with app.app_context():
+        connections = [db.engine.connect()
+                       for _ in range(app.config['WARM_CONNECTIONS'])]
+        for connection in connections:
+            connection.close()
+
+        app.extensions['availability'].rebuild()
+
+    if app.config['JOBS_THREADS']:
+        start_worker(app)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///twitter_db'))
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+def __getattr__(name):
+    # `from app import app` makes the default app the first time it's
+    # asked for, so importing this module (for create_app, say) doesn't
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
-connect_db(app)
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if request.endpoint in SESSIONLESS_ENDPOINTS:
+        g.user = None
+
+    elif CURR_USER_KEY in session:
+        user = User.query.get(session[CURR_USER_KEY])
+        # a deleted account's other sessions are logged out too
+        g.user = user if user is not None and user.deleted_at is None else None
 
     else:
         g.user = None
@@ -50,7 +204,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -58,19 +212,31 @@ def signup():
 
     If form not valid, present form.
 
-    If the there already is a user with that username: flash message
-    and re-present form.
+    If the there already is a user with that username or email: flash
+    message and re-present form. That's checked before the password is
+    hashed; the IntegrityError is for the rare duplicate the check misses.
     """
 
     form = UserAddForm()
 
     if form.validate_on_submit():
+        taken = taken_fields(form.username.data, form.email.data)
+        if taken:
+            for field in taken:
+                flash(f"{field.capitalize()} already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
+        image_url = store_upload(form.image, 'avatar')
+        if form.image.errors:
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
+                image_url=(image_url or form.image_url.data
+                           or User.image_url.default.arg),
             )
             db.session.commit()
 
@@ -78,6 +244,8 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        place_user(user.id)
+
         do_login(user)
 
         return redirect("/")
@@ -86,7 +254,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -106,7 +274,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout', methods=['POST'])
+@route('/logout', methods=['POST'])
 def logout():
     """Handle logout of user."""
     do_logout()
@@ -117,41 +285,54 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@route('/users')
 def list_users():
     """Page with listing of users.
 
     Can take a 'q' param in querystring to search by that username.
     """
 
-    search = request.args.get('q')
-
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = user_rows(request.args.get('q'))
 
     return render_template('users/index.html', users=users)
 
 
-@app.route('/users/<int:user_id>')
+@route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Anonymous visitors get a publicly cacheable page and a 304 if their
+    copy is still current.
+    """
+
+    if is_shareable():
+        version = sharded_profile_page_version(profile_page_version(user_id))
+        if version is None:
+            abort(404)
+
+        set_cache_policy(PUBLIC)
+        resp = not_modified('users_show', *version)
+        if resp:
+            return resp
+    else:
+        set_cache_policy(PRIVATE)
 
-    user = User.query.get_or_404(user_id)
+    user = sharded_user_profile(user_id)
+    if user is None:
+        abort(404)
 
-    # snagging messages in order from the database;
+    # snagging messages in order from the user's shard;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    if current_app.config['STREAM_TEMPLATES']:
+        messages = stream_user_message_rows(
+            user_id, 100, current_app.config['STREAM_CHUNK_SIZE'])
+    else:
+        messages = user_message_rows(user_id, 100)
+
+    return render_page('users/show.html', user=user, messages=messages)
 
 
-@app.route('/users/<int:user_id>/following')
+@route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -159,11 +340,14 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = sharded_user_profile(user_id)
+    if user is None:
+        abort(404)
+    return render_template('users/following.html', user=user,
+                           users=following_rows(user_id))
 
 
-@app.route('/users/<int:user_id>/followers')
+@route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -171,11 +355,14 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = sharded_user_profile(user_id)
+    if user is None:
+        abort(404)
+    return render_template('users/followers.html', user=user,
+                           users=follower_rows(user_id))
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -185,12 +372,13 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    notify(followed_user.id, g.user.id, 'follow')
     db.session.commit()
     flash(f'Followed {followed_user.username}')
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -205,7 +393,7 @@ def stop_following(follow_id):
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
     if not g.user:
@@ -217,11 +405,16 @@ def profile():
                                  form.password.data)
 
         if user:
+            image_url = store_upload(form.image, 'avatar')
+            header_image_url = store_upload(form.header_image, 'header')
+            if form.image.errors or form.header_image.errors:
+                return render_template('users/edit.html', user=g.user, form=form)
+
             flash('Sucessfully updated profile!')
             username = form.username.data
             email = form.email.data
-            image_url = form.image_url.data
-            header_image_url = form.header_image_url.data
+            image_url = image_url or form.image_url.data
+            header_image_url = header_image_url or form.header_image_url.data
             bio = form.bio.data
             
             g.user.username = username
@@ -229,8 +422,10 @@ def profile():
             g.user.image_url = image_url
             g.user.header_image_url = header_image_url
             g.user.bio = bio
+            g.user.profile_version += 1
             db.session.add(g.user)
             db.session.commit()
+            invalidate_user_card(g.user.id)
             return redirect(f"/users/{g.user.id}")
         else:
             flash("Invalid credentials.", 'danger')
@@ -238,7 +433,7 @@ def profile():
     return render_template('users/edit.html', user=g.user, form=form)
 
 
-@app.route('/users/delete', methods=["POST"])
+@route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -248,53 +443,97 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # the account is closed now; deleting everything the user ever posted
+    # can take a while, so that's done by a job (see functions.purge_user)
+    user_id = g.user.id
+    g.user.deactivate()
+    enqueue('purge_user', dict(user_id=user_id), key=f"purge_user:{user_id}",
+            lane='high')
     db.session.commit()
+    wake_workers()
+    invalidate_user_card(user_id)
     flash('Account deleted succesfully.', 'success')
     return redirect("/signup")
 
-@app.route('/users/add_like/<int:msg_id>', methods=['POST'])
+@route('/users/add_like/<int:msg_id>', methods=['POST'])
 def add_likes(msg_id):
     """Adds the liked message to the users liked messages"""
     if not g.user:
         flash('Access unauthorized.', 'danger')
         return redirect('/')
-    Message.query.get_or_404(msg_id)
+    msg = find_message(msg_id)[1]
+    if msg is None:
+        abort(404)
     new_like = Likes(user_id=g.user.id, message_id=msg_id)
     db.session.add(new_like)
+    notify(msg.user_id, g.user.id, 'like', msg_id)
     db.session.commit()
     flash('Message Liked', 'success')
     return redirect(f'/users/{g.user.id}')
 
-@app.route('/users/unlike/<int:msg_id>', methods=['POST'])
+@route('/users/unlike/<int:msg_id>', methods=['POST'])
 def unlike_post(msg_id):
     """Removes like from user's likes"""
     if not g.user:
         flash('Access unauthorized.', 'danger')
         return redirect('/')
-    Message.query.get_or_404(msg_id)
-    Likes.query.filter_by(message_id=msg_id).delete()
+    if find_message(msg_id)[1] is None:
+        abort(404)
+    Likes.query.filter_by(user_id=g.user.id, message_id=msg_id).delete()
     db.session.commit()
     flash('Unliked message', 'success')
     return redirect(f'/users/{g.user.id}/likes') 
 
-@app.route('/users/<int:user_id>/likes')
+@route('/users/<int:user_id>/likes')
 def show_user_likes(user_id):
     """Shows the users's liked messages"""
     if not g.user:
         flash('Access unauthorized.', 'danger')
         return redirect('/')
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+    user = sharded_user_profile(user_id)
+    if user is None:
+        abort(404)
+    return render_template('users/likes.html', user=user,
+                           messages=sharded_liked_message_rows(user_id))
+
+@route('/messages/<int:message_id>/repost', methods=['POST'])
+def repost(message_id):
+    """Put a message on the current user's followers' home timelines."""
+
+    if not g.user:
+        flash('Access unauthorized.', 'danger')
+        return redirect('/')
+    if find_message(message_id)[1] is None:
+        abort(404)
+    db.session.execute(insert(Repost)
+                       .values(user_id=g.user.id, message_id=message_id)
+                       .on_conflict_do_nothing())
+    db.session.commit()
+    flash('Message reposted', 'success')
+    return redirect(f'/messages/{message_id}')
+
+
+@route('/messages/<int:message_id>/unrepost', methods=['POST'])
+def unrepost(message_id):
+    """Take back the current user's repost of a message."""
+
+    if not g.user:
+        flash('Access unauthorized.', 'danger')
+        return redirect('/')
+    Repost.query.filter_by(user_id=g.user.id, message_id=message_id).delete()
+    db.session.commit()
+    flash('Repost removed', 'success')
+    return redirect(f'/messages/{message_id}')
 
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
-    Show form if GET. If valid, update message and redirect to user page.
+    Show form if GET. If valid, update message and redirect to user page,
+    or for a reply, to the message it replies to.
     """
 
     if not g.user:
@@ -304,24 +543,73 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        parent = None
+        if form.parent_id.data is not None:
+            _, parent = find_message(form.parent_id.data)
+            if parent is None:
+                flash("That message is gone.", 'danger')
+                return redirect("/")
+
+        msg = add_message(g.user, form.text.data, parent)
+        enqueue('index_message', dict(message_id=msg.id),
+                key=f"index_message:{msg.id}")
         db.session.commit()
+        wake_workers()
+        publish_message(msg)
+        record_message(msg)
 
+        if parent is not None:
+            return redirect(f"/messages/{parent.id}")
         return redirect(f"/users/{g.user.id}")
     flash('Message Created', 'success')
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message in its conversation: the messages it replies to,
+    and a page of the replies under it (?after= for the next one).
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    Anonymous visitors get a publicly cacheable page and a 304 if their
+    copy is still current. Archived messages are looked up in their
+    archive file instead.
+    """
 
+    shareable = is_shareable()
+    archived = False
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+    if shareable:
+        version = thread_page_version(sharded_message_page_version(message_id))
+        if version is not None:
+            set_cache_policy(PUBLIC)
+            resp = not_modified('messages_show', *version)
+            if resp:
+                return resp
+    else:
+        set_cache_policy(PRIVATE)
+
+    _, msg = find_message(message_id)
+    if msg is None:
+        # not in the database; it may have been archived (see partitions.py)
+        msg = find_archived_message(message_id)
+        if msg is None:
+            abort(404)
+        archived = True
+        if shareable:
+            # an archived message never changes, so its page can still be
+            # cached, just not validated as cheaply
+            set_cache_policy(PUBLIC)
+
+    form = None
+    if g.user and not archived:
+        form = MessageForm(formdata=None, parent_id=msg.id)
+
+    return render_template('messages/show.html', message=msg, archived=archived,
+                           thread=conversation(msg, request.args.get('after')),
+                           form=form)
+
+
+@route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -329,49 +617,73 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    db.session.delete(msg)
+    shard, msg = find_message(message_id)
+    if msg is None:
+        abort(404)
+    delete_message_rows([msg.id])
+    delete_message(shard, msg)
     db.session.commit()
 
     flash('Message Deleted', 'success')
     return redirect(f"/users/{g.user.id}")
 
 
+@route('/tags/<tag>')
+def tag_show(tag):
+    """Messages tagged with `tag`, newest first."""
+
+    messages, next_cursor = tag_timeline(tag, request.args.get('cursor'))
+    return render_template('messages/timeline.html', title=f"#{tag.lower()}",
+                           messages=messages, next_cursor=next_cursor)
+
+
+@route('/mentions/<username>')
+def mentions_show(username):
+    """Messages mentioning `username`, newest first."""
+
+    user = User.query.filter_by(username=username).first_or_404()
+    messages, next_cursor = mentions_timeline(user, request.args.get('cursor'))
+    return render_template('messages/timeline.html',
+                           title=f"Mentions of @{user.username}",
+                           messages=messages, next_cursor=next_cursor)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: a page of the messages followed_users posted or reposted,
+      newest first (?cursor= for the next one; see reposts.py)
     """
 
     if g.user:
-        messages = collect_follower_messages(g.user)
-        # user=g.user
-        # raise
-        return render_template('home.html', messages=messages)
+        # read lazily, a batch at a time as the page renders; streamed,
+        # the first batch is kept as small as a streamed chunk
+        config = current_app.config
+        batch_size = (config['STREAM_CHUNK_SIZE']
+                      if config['STREAM_TEMPLATES'] else BATCH_SIZE)
+        messages = home_timeline(followed_user_ids(), request.args.get('cursor'),
+                                 batch_size=batch_size)
+        return render_page('home.html',
+                           profile=sharded_user_profile(g.user.id),
+                           messages=messages)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Caching headers
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages aren't cached unless their view picks a cache policy (see
+# http_caching.py); views that can validate cheaply also send an ETag.
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
+def add_header(resp):
+    """Add the caching headers for the view's cache policy."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    return apply_cache_policy(resp)
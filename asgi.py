@@ -0,0 +1,280 @@
+"""Asyncio serving mode.
+
+Run the app on an ASGI server like:
+
+    uvicorn asgi:application --workers 1
+
+Under a sync WSGI server every request holds a thread until it's done,
+so a worker can only fetch as many timelines at once as it has threads,
+and most of that time is spent waiting on Postgres.
+
+Here the read-heavy pages (ASYNC_ENDPOINTS) run on the event loop with
+their database access going through asyncpg: the views are the regular
+Flask views, run inside SQLAlchemy's `greenlet_spawn` with `db.session`
+bound to an async connection, so every query (lazy loads in templates
+included) yields to the loop instead of blocking it. One worker can have
+hundreds of those in flight.
+
+Every other request (forms, logins with their bcrypt checks, the SSE
+stream) is handed to the plain WSGI app on a pool of ASYNC_THREADS
+threads, exactly as it would run under a sync server.
+
+With SHARD_URLS set, every request goes to the thread pool: the pages
+read the other shards through their own, synchronous engines (see
+shards.py), which would block the loop.
+"""
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from werkzeug.exceptions import HTTPException
+
+from app import app, warm_up
+from models import db
+from slow_queries import watch_engine
+
+ASYNC_ENDPOINTS = frozenset({'homepage', 'users_show', 'list_users',
+                             'messages_show'})
+
+
+def async_database_url(url):
+    """`url` with its driver switched to asyncpg."""
+
+    return make_url(url).set(drivername='postgresql+asyncpg')
+
+
+##############################################################################
+# ASGI <-> WSGI
+
+
+def build_environ(scope, body):
+    """The WSGI environ for an ASGI http `scope` and request `body`."""
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('UTF-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('UTF-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f"HTTP_{name}"
+        if name in environ and name.startswith('HTTP_'):
+            value = f"{environ[name]},{value}"
+        environ[name] = value
+
+    return environ
+
+
+def start_wsgi(wsgi_app, environ):
+    """Call `wsgi_app`; returns (status code, headers, body iterable)."""
+
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.lower().encode('latin-1'),
+                               value.encode('latin-1'))
+                              for name, value in headers]
+
+    body = wsgi_app(environ, start_response)
+    return started['status'], started['headers'], body
+
+
+def close_body(body):
+    if hasattr(body, 'close'):
+        body.close()
+
+
+def call_wsgi(wsgi_app, environ):
+    """Call `wsgi_app` and read its whole body."""
+
+    status, headers, body = start_wsgi(wsgi_app, environ)
+    try:
+        return status, headers, b''.join(body)
+    finally:
+        close_body(body)
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return bytes(body)
+
+
+##############################################################################
+# The ASGI app
+
+
+class AsyncWarbler:
+    """ASGI app serving `flask_app`'s ASYNC_ENDPOINTS on the event loop and
+    everything else on a thread pool."""
+
+    def __init__(self, flask_app):
+        flask_app.config.setdefault('ASYNC_POOL_SIZE', 20)
+        flask_app.config.setdefault('ASYNC_THREADS', 16)
+
+        self.app = flask_app
+        # the shards' engines aren't async
+        self.sharded = bool(flask_app.config.get('SHARD_URLS'))
+        self.engine = create_async_engine(
+            async_database_url(flask_app.config['SQLALCHEMY_DATABASE_URI']),
+            pool_size=flask_app.config['ASYNC_POOL_SIZE'])
+        watch_engine(self.engine.sync_engine, flask_app)
+        self.executor = ThreadPoolExecutor(flask_app.config['ASYNC_THREADS'],
+                                           thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            environ = build_environ(scope, await read_body(receive))
+            if (not self.sharded
+                    and self.endpoint(environ) in ASYNC_ENDPOINTS):
+                await self.serve_async(environ, send)
+            else:
+                await self.serve_threaded(environ, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.warm_up()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def warm_up(self):
+        """Ready this worker before it takes requests: see app.warm_up,
+        plus a connection for the async engine."""
+
+        await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                         warm_up, self.app)
+        async with self.engine.connect():
+            pass
+
+    async def close(self):
+        await self.engine.dispose()
+        self.executor.shutdown(wait=False)
+
+    def endpoint(self, environ):
+        """The endpoint `environ` is routed to, or None."""
+
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        return endpoint
+
+    async def serve_async(self, environ, send):
+        """Run the view on the loop, with its queries going through asyncpg."""
+
+        async with AsyncSession(self.engine) as session:
+            status, headers, body = await session.run_sync(self._call_view,
+                                                           environ)
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def _call_view(self, session, environ):
+        # db.session is scoped to the current greenlet; point this one's at
+        # the async connection (the app's teardown removes it again)
+        db.session.registry.set(session)
+        try:
+            return call_wsgi(self.app.wsgi_app, environ)
+        finally:
+            db.session.registry.clear()
+
+    async def serve_threaded(self, environ, send):
+        """Run the plain WSGI app on the thread pool, sending its body as
+        it's produced (so streamed pages and SSE still stream)."""
+
+        loop = asyncio.get_running_loop()
+        status, headers, body = await loop.run_in_executor(
+            self.executor, start_wsgi, self.app.wsgi_app, environ)
+        chunks = iter(body)
+
+        try:
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': headers})
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next,
+                                                   chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await loop.run_in_executor(self.executor, close_body, body)
+
+
+async def fetch(asgi_app, path, method='GET', headers=(), body=b''):
+    """Make one request to `asgi_app` without a server, for tests and
+    benchmarks. Returns (status code, headers dict, body)."""
+
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': query.encode('latin-1'),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers],
+        'server': ('localhost', 80),
+        'client': ('127.0.0.1', 0),
+    }
+    request = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    response = {'headers': {}, 'body': b''}
+
+    async def receive():
+        return request.pop(0) if request else {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = {name.decode('latin-1'): value.decode('latin-1')
+                                   for name, value in message['headers']}
+        else:
+            response['body'] += message.get('body', b'')
+
+    await asgi_app(scope, receive, send)
+    return response['status'], response['headers'], response['body']
+
+
+application = AsyncWarbler(app)
@@ -0,0 +1,223 @@
+"""Fingerprinted, precompressed static assets.
+
+Build them (after changing anything under static/) like:
+
+    python assets.py
+
+That copies every static file to static/dist/ under a name containing a
+hash of its content (style.css -> style.1a2b3c4d5e6f.css), writes gzip
+and brotli variants of the compressible ones next to it, and records the
+mapping in static/dist/manifest.json. Since a fingerprinted URL can never
+point at different content, the app serves those files from /assets/
+with a one-year immutable Cache-Control.
+
+Templates refer to static files through `asset_url` (and to stored image
+URLs through the `asset_src` filter), which fall back to the plain
+/static/ URL for files that haven't been built.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import abort, current_app, request, send_from_directory
+
+from http_caching import PUBLIC, cache_policy, set_cache_policy
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIRNAME = 'dist'
+MANIFEST = 'manifest.json'
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# images are already compressed; gzipping them again only wastes bytes
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.html'}
+
+# served variants, best first: (Accept-Encoding name, file suffix)
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+CSS_URL_RE = re.compile(r'''url\((["']?)/static/([^"')]+)\1\)''')
+
+
+##############################################################################
+# Build step
+
+
+def fingerprint(path, content):
+    """`path` with a hash of `content` inserted before its extension."""
+
+    root, ext = os.path.splitext(path)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return f"{root}.{digest}{ext}"
+
+
+def rewrite_css_urls(css, manifest):
+    """Point /static/ url()s in `css` at their fingerprinted copies."""
+
+    def replace(match):
+        quote, path = match.groups()
+        if path not in manifest:
+            return match.group(0)
+        return f"url({quote}/assets/{manifest[path]}{quote})"
+
+    return CSS_URL_RE.sub(replace, css.decode('UTF-8')).encode('UTF-8')
+
+
+def write_variants(dest, content):
+    """Write gzip and (if available) brotli versions of `content` next to
+    `dest`, keeping only the ones that actually come out smaller."""
+
+    variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli:
+        variants['.br'] = brotli.compress(content, quality=11)
+
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(content):
+            with open(dest + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+def build(static_dir=STATIC_DIR):
+    """Build static/dist/ from everything else in `static_dir`.
+
+    Returns the manifest, a dict of original -> fingerprinted paths
+    (relative to static/ and static/dist/ respectively).
+    """
+
+    if not brotli:
+        print("brotli isn't installed; writing gzip variants only",
+              file=sys.stderr)
+
+    dist_dir = os.path.join(static_dir, DIST_DIRNAME)
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+
+    sources = []
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        dirnames[:] = [d for d in dirnames
+                       if os.path.join(dirpath, d) != dist_dir]
+        for filename in filenames:
+            full = os.path.join(dirpath, filename)
+            sources.append(os.path.relpath(full, static_dir).replace(os.sep, '/'))
+
+    # stylesheets point at other assets, so they go last, once everything
+    # they could refer to has its fingerprinted name
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+
+    manifest = {}
+    for path in sources:
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            content = f.read()
+        if path.endswith('.css'):
+            content = rewrite_css_urls(content, manifest)
+
+        manifest[path] = fingerprint(path, content)
+        dest = os.path.join(dist_dir, manifest[path])
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, 'wb') as f:
+            f.write(content)
+
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            write_variants(dest, content)
+
+    with open(os.path.join(dist_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+##############################################################################
+# Serving
+
+
+def load_manifest(static_dir=STATIC_DIR):
+    """The manifest from the last build, or {} if there hasn't been one."""
+
+    try:
+        with open(os.path.join(static_dir, DIST_DIRNAME, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(filename):
+    """URL for `filename` (relative to static/): its fingerprinted /assets/
+    URL if it has been built, else the plain /static/ one."""
+
+    manifest = current_app.extensions['assets']['manifest']
+
+    if filename in manifest:
+        return f"/assets/{manifest[filename]}"
+    return f"/static/{filename}"
+
+
+def asset_src(url):
+    """Template filter for stored URLs (like `User.image_url`) that may
+    point at a static file: built /static/ URLs are swapped for their
+    fingerprinted URL, everything else is returned as-is."""
+
+    if url and url.startswith('/static/'):
+        return asset_url(url[len('/static/'):])
+    return url
+
+
+def serve_asset(filename):
+    """Serve a fingerprinted asset, precompressed if the client accepts it."""
+
+    assets = current_app.extensions['assets']
+    if filename not in assets['files']:
+        abort(404)
+
+    dist_dir = os.path.join(current_app.static_folder, DIST_DIRNAME)
+    served, encoding = filename, None
+
+    for name, suffix in ENCODINGS:
+        if (request.accept_encodings[name]
+                and os.path.exists(os.path.join(dist_dir, filename + suffix))):
+            served, encoding = filename + suffix, name
+            break
+
+    resp = send_from_directory(dist_dir, served,
+                               mimetype=mimetypes.guess_type(filename)[0])
+    resp.vary.add('Accept-Encoding')
+    if encoding:
+        resp.content_encoding = encoding
+
+    set_cache_policy(PUBLIC, max_age=ONE_YEAR, immutable=True)
+    return resp
+
+
+def init_assets(app):
+    """Serve fingerprinted assets and add `asset_url` to templates.
+
+    You should call this in your Flask app.
+    """
+
+    manifest = load_manifest(app.static_folder)
+    app.extensions['assets'] = dict(
+        manifest=manifest,
+        files=frozenset(manifest.values()),
+    )
+
+    app.add_url_rule('/assets/<path:filename>', 'assets', serve_asset)
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.jinja_env.filters['asset_src'] = asset_src
+
+    # unbuilt files may still change, so they're only cached with
+    # revalidation (send_file sends a Last-Modified for those)
+    app.view_functions['static'] = cache_policy(PUBLIC)(app.send_static_file)
+
+
+if __name__ == '__main__':
+    manifest = build()
+    print(f"built {len(manifest)} assets into static/{DIST_DIRNAME}/")
@@ -0,0 +1,264 @@
+"""Username and email availability.
+
+Checking whether a username or email is taken is asked often (on every
+signup, and as the user types into the signup form) and is almost always
+answered "no". Each worker keeps a Bloom filter of every username and
+email in the users table, so most of those answers come from memory: a
+value the filter has never seen is certainly free. When the filter says
+it may have seen it, an exact lookup on the column's unique index
+decides, so a false positive costs one indexed query and is never
+reported as taken.
+
+The filter is kept up to date incrementally: at most every
+AVAILABILITY_REFRESH_INTERVAL seconds, a lookup first adds the users with
+an id above the highest one it has read. Users inserted or renamed by
+this worker are added as they are flushed. Renames and deletions made by
+other workers only show up when the filter is rebuilt from scratch, every
+AVAILABILITY_REBUILD_INTERVAL seconds or once it holds more values than
+it was sized for. One lookup does the rebuild; the others meanwhile
+carry on with the old filter rather than wait for it. Until then a
+rename elsewhere can be missed, and the unique constraints are still
+what catch that: signup falls back to its IntegrityError handling.
+"""
+
+import hashlib
+import math
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, inspect, select
+
+from caching import clear_on_drop
+from models import db, User
+
+FIELDS = {
+    'username': User.username,
+    'email': User.email,
+}
+
+# the filter is sized for this many more users than are there when it's
+# built, so it isn't rebuilt on every signup
+HEADROOM = 2
+MIN_CAPACITY = 1024
+
+
+class BloomFilter:
+    """Set of strings that can say "certainly not in it" or "maybe in it",
+    in about 10 bits per member for a 1% false positive rate."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate)
+                                     / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        # double hashing: two 64-bit halves of one digest stand in for
+        # `hashes` independent hash functions
+        digest = hashlib.blake2b(key.encode('UTF-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + n * step) % self.size for n in range(self.hashes)]
+
+    def add(self, key):
+        """Add `key`; returns whether it's new. Only new keys count toward
+        `capacity` (as far as the filter can tell)."""
+
+        positions = self._positions(key)
+        with self._lock:
+            new = False
+            for position in positions:
+                byte, bit = position >> 3, 1 << (position & 7)
+                if not self.bits[byte] & bit:
+                    self.bits[byte] |= bit
+                    new = True
+            if new:
+                self.count += 1
+            return new
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+
+def filter_key(field, value):
+    return f"{field}:{value}"
+
+
+class AvailabilityIndex:
+    """A worker's Bloom filter of the users table's usernames and emails,
+    with what it needs to keep it up to date."""
+
+    def __init__(self, error_rate=0.01, refresh_interval=5,
+                 rebuild_interval=3600):
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.filter = None
+        self.last_id = 0
+        self.refreshed_at = self.built_at = 0
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.filter = None
+            self.last_id = 0
+            self.refreshed_at = self.built_at = 0
+
+    def _add_rows(self, bloom, rows, last_id=0):
+        for user_id, username, email in rows:
+            bloom.add(filter_key('username', username))
+            bloom.add(filter_key('email', email))
+            last_id = max(last_id, user_id)
+        return last_id
+
+    def rebuild_due(self):
+        return (self.filter is None
+                or time.monotonic() - self.built_at >= self.rebuild_interval
+                or self.filter.count >= self.filter.capacity)
+
+    def _rebuild(self):
+        # call with the lock held
+        count = db.session.scalar(select(func.count(User.id)))
+        # two values per user
+        bloom = BloomFilter(max(MIN_CAPACITY, 2 * HEADROOM * count),
+                            self.error_rate)
+        rows = db.session.execute(
+            select(User.id, User.username, User.email)
+            .execution_options(yield_per=1000))
+        self.last_id = self._add_rows(bloom, rows)
+        self.filter = bloom
+        self.refreshed_at = self.built_at = time.monotonic()
+
+    def rebuild(self):
+        """Read every user into a new filter, sized for HEADROOM times as
+        many, and swap it in."""
+
+        with self._lock:
+            self._rebuild()
+
+    def refresh(self):
+        """Add the users inserted since the last refresh, or rebuild when
+        it's time to."""
+
+        now = time.monotonic()
+
+        if self.filter is None:
+            # nothing to answer from yet: wait for whoever is building it,
+            # and only build it if they didn't
+            with self._lock:
+                if self.filter is None:
+                    self._rebuild()
+            return
+
+        # a lookup doesn't wait for another thread's refresh or rebuild;
+        # the filter it reads is at most a refresh behind, or a rebuild
+        # late
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self.rebuild_due():
+                return self._rebuild()
+            rows = db.session.execute(
+                select(User.id, User.username, User.email)
+                .where(User.id > self.last_id)
+                .order_by(User.id))
+            self.last_id = self._add_rows(self.filter, rows, self.last_id)
+            self.refreshed_at = now
+        finally:
+            self._lock.release()
+
+    def refresh_if_due(self):
+        if (self.filter is None
+                or time.monotonic() - self.refreshed_at >= self.refresh_interval):
+            self.refresh()
+
+    def remember(self, field, value):
+        """Add a value this worker has just written."""
+
+        bloom = self.filter
+        if bloom is not None and value is not None:
+            bloom.add(filter_key(field, value))
+
+    def might_be_taken(self, field, value):
+        self.refresh_if_due()
+        return filter_key(field, value) in self.filter
+
+
+def is_taken(field, value):
+    """Is `value` some user's `field` ('username' or 'email')?
+
+    Asks the Bloom filter first, and the database only if it says maybe.
+    The values kept for closed accounts are always taken.
+    """
+
+    if User.is_reserved(field, value):
+        return True
+
+    index = current_app.extensions['availability']
+    if not index.might_be_taken(field, value):
+        return False
+
+    column = FIELDS[field]
+    return db.session.scalar(select(User.id).where(column == value)) is not None
+
+
+def taken_fields(username, email):
+    """Which of `username` and `email` are in use, as a list of field
+    names, in that order."""
+
+    return [field for field, value in (('username', username), ('email', email))
+            if is_taken(field, value)]
+
+
+def remember_fields(user, fields):
+    # if the transaction is rolled back the values stay in the filter,
+    # which only costs an exact lookup when they're checked
+    if has_app_context() and 'availability' in current_app.extensions:
+        index = current_app.extensions['availability']
+        for field in fields:
+            index.remember(field, getattr(user, field))
+
+
+@event.listens_for(User, 'after_insert')
+def remember_user(mapper, connection, user):
+    remember_fields(user, FIELDS)
+
+
+@event.listens_for(User, 'after_update')
+def remember_renamed_user(mapper, connection, user):
+    # most updates are profile edits that leave both alone
+    state = inspect(user)
+    remember_fields(user, [field for field in FIELDS
+                           if state.attrs[field].history.has_changes()])
+
+
+def init_availability(app):
+    """Set up the availability index for `app`.
+
+    AVAILABILITY_ERROR_RATE is the Bloom filter's false positive rate,
+    AVAILABILITY_REFRESH_INTERVAL how many seconds a worker goes between
+    reading newly added users, and AVAILABILITY_REBUILD_INTERVAL how many
+    between reading them all again. The filter is built on the first
+    lookup (or by warm_up).
+
+    You should call this in your Flask app, after connect_db.
+    """
+
+    app.config.setdefault('AVAILABILITY_ERROR_RATE', 0.01)
+    app.config.setdefault('AVAILABILITY_REFRESH_INTERVAL', 5)
+    app.config.setdefault('AVAILABILITY_REBUILD_INTERVAL', 3600)
+
+    index = AvailabilityIndex(app.config['AVAILABILITY_ERROR_RATE'],
+                              app.config['AVAILABILITY_REFRESH_INTERVAL'],
+                              app.config['AVAILABILITY_REBUILD_INTERVAL'])
+    # user ids start over when the tables are rebuilt, which the high
+    # water mark can't tell
+    app.extensions['availability'] = clear_on_drop(index)
+
+    return index
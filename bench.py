@@ -0,0 +1,538 @@
+"""Microbenchmarks for Warbler's hot code paths.
+
+run these benchmarks like:
+
+    python bench.py                              # 1k, 100k and 1M messages
+    python bench.py --sizes 1000 --repeat 3      # quick run
+    python bench.py --save-baseline              # store results as baseline
+
+Each fixture size gets a freshly seeded benchmark database (never the
+dev or test database), and every benchmark is timed `--repeat` times.
+Results are written as JSON to `--output`; if a baseline file exists they
+are compared to it and the run fails (exit status 1) when any path got
+slower than the baseline by more than `--threshold` percent.
+
+The "serve timelines" pair compares serving modes: SERVING_CONCURRENCY
+homepages fetched at once from the WSGI app on SERVING_THREADS threads,
+and from the ASGI app (asgi.py) on one event loop.
+
+"list pages orm" and "list pages read models" load and render the same
+timeline and user listing from ORM instances and from read models
+(readmodels.py), recording each page's peak memory (with tracemalloc,
+in an extra untimed run) besides its render time.
+
+"app cold start" times a fresh worker process from interpreter start to
+its first response, recording how long the imports, create_app, warm_up
+and the first request each took.
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000]
+DEFAULT_DATABASE_URL = 'postgresql:///twitter_db_bench'
+DEFAULT_OUTPUT = 'bench_results.json'
+DEFAULT_BASELINE = 'bench_baseline.json'
+DEFAULT_THRESHOLD = 20.0
+
+BENCH_PASSWORD = 'BENCH_PASSWORD'
+
+# serving benchmarks: timelines fetched at once, and the threads a sync
+# worker gets to serve them with
+SERVING_CONCURRENCY = 50
+SERVING_THREADS = 8
+
+BENCHMARKS = {}
+
+
+def benchmark(name, metrics=None):
+    """Register a benchmark function under `name`.
+
+    A benchmark receives the fixture dict and returns a callable to time;
+    it may also return (setup, callable) when some untimed work has to run
+    before every iteration. `metrics`, if given, is called with the last
+    result of the timed callable and returns extra stats to record.
+    """
+
+    def register(func):
+        BENCHMARKS[name] = (func, metrics)
+        return func
+    return register
+
+
+def payload_metrics(resp):
+    """Size of a response body."""
+
+    return dict(payload_bytes=len(resp.get_data()))
+
+
+def throughput_metrics(result):
+    """Requests per second of a serving benchmark."""
+
+    statuses, seconds = result
+    if any(status != 200 for status in statuses):
+        raise RuntimeError(f"failed requests: {statuses}")
+    return dict(requests=len(statuses),
+                requests_per_sec=round(len(statuses) / seconds, 1))
+
+
+##############################################################################
+# Fixtures
+
+
+def users_for_size(size):
+    """Number of users to seed for a fixture with `size` messages."""
+
+    return max(100, size // 1000)
+
+
+def seed_fixture(db, size, follows_per_user=50):
+    """Rebuild the benchmark database with `size` messages.
+
+    Rows are generated server-side with generate_series, so even the 1M
+    fixture seeds in seconds rather than minutes.
+    """
+
+    from models import bcrypt
+
+    num_users = users_for_size(size)
+
+    db.drop_all()
+    db.create_all()
+
+    hashed_pwd = bcrypt.generate_password_hash(BENCH_PASSWORD).decode('UTF-8')
+
+    db.session.execute(
+        """INSERT INTO users (email, username, image_url, header_image_url,
+                              bio, password)
+           SELECT 'user' || g || '@bench.com', 'user' || g,
+                  '/static/images/default-pic.png',
+                  '/static/images/warbler-hero.jpg',
+                  'Bench user number ' || g, :password
+           FROM generate_series(1, :num_users) g""",
+        dict(password=hashed_pwd, num_users=num_users))
+
+    db.session.execute(
+        """INSERT INTO follows (user_being_followed_id, user_following_id)
+           SELECT DISTINCT 1 + (f.g * 7919 + u.g * 104729) % :num_users, u.g
+           FROM generate_series(1, :num_users) AS u(g),
+                generate_series(1, :follows) AS f(g)
+           WHERE 1 + (f.g * 7919 + u.g * 104729) % :num_users != u.g""",
+        dict(num_users=num_users, follows=follows_per_user))
+
+    # a partition per month the messages span, so they don't all land in
+    # the default partition
+    from partitions import ensure_partitions
+    oldest = datetime.utcnow() - timedelta(minutes=size + 1)
+    ensure_partitions(db.session.connection(), oldest, datetime.utcnow())
+
+    db.session.execute(
+        """INSERT INTO messages (text, timestamp, user_id)
+           SELECT 'Bench warble number ' || g,
+                  now() - g * interval '1 minute',
+                  1 + g % :num_users
+           FROM generate_series(1, :size) g""",
+        dict(size=size, num_users=num_users))
+
+    db.session.commit()
+    db.session.execute('ANALYZE')
+    db.session.commit()
+
+    return dict(size=size, num_users=num_users, viewer_id=1, other_id=2,
+                username='user1', search='user1')
+
+
+##############################################################################
+# Benchmarks
+
+
+@benchmark('collect_follower_messages')
+def bench_collect_follower_messages(fixture, db, app):
+    from functions import collect_follower_messages
+    from models import User
+
+    def setup():
+        db.session.expire_all()
+        return User.query.get(fixture['viewer_id'])
+
+    return setup, collect_follower_messages
+
+
+@benchmark('User.is_following')
+def bench_is_following(fixture, db, app):
+    from models import User
+
+    def setup():
+        db.session.expire_all()
+        return (User.query.get(fixture['viewer_id']),
+                User.query.get(fixture['other_id']))
+
+    return setup, lambda users: users[0].is_following(users[1])
+
+
+@benchmark('User.authenticate')
+def bench_authenticate(fixture, db, app):
+    from models import User
+
+    return lambda: User.authenticate(fixture['username'], BENCH_PASSWORD)
+
+
+@benchmark('homepage render')
+def bench_homepage(fixture, db, app):
+    from app import CURR_USER_KEY
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = fixture['viewer_id']
+
+    return lambda: client.get('/')
+
+
+@benchmark('list_users search')
+def bench_list_users(fixture, db, app):
+    client = app.test_client()
+
+    return lambda: client.get(f"/users?q={fixture['search']}")
+
+
+@benchmark('api timeline', metrics=payload_metrics)
+def bench_api_timeline(fixture, db, app):
+    from app import CURR_USER_KEY
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = fixture['viewer_id']
+
+    return lambda: client.get('/api/v1/timeline?limit=100')
+
+
+@benchmark('api timeline serialize',
+           metrics=lambda payload: dict(payload_bytes=len(payload)))
+def bench_api_serialize(fixture, db, app):
+    from api import MESSAGE_FIELDS, serialize_rows, _encoder
+    from models import Message, User
+
+    names = list(MESSAGE_FIELDS)
+    rows = (db.session.query(*MESSAGE_FIELDS.values())
+            .join(User, Message.user_id == User.id)
+            .order_by(Message.timestamp.desc())
+            .limit(100)
+            .all())
+
+    return lambda: _encoder.encode(dict(data=serialize_rows(names, rows)))
+
+
+def list_page_metrics(result):
+    """Peak memory of one more (untimed) run of a list page benchmark,
+    and the size of the markup it rendered."""
+
+    render, html = result
+
+    tracemalloc.start()
+    try:
+        render()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return dict(payload_bytes=len(html), peak_kib=round(peak / 1024, 1))
+
+
+def list_pages(app, viewer_id, load):
+    """A benchmark callable rendering a timeline and a user listing for
+    `viewer_id`, from the (messages, users) `load` returns for them.
+
+    It returns itself along with the markup, for list_page_metrics.
+    """
+
+    from flask import g, render_template
+    from models import User
+
+    def render():
+        # the request context's teardown removes the session, and with it
+        # anything loaded into it, as after a real request
+        with app.test_request_context('/'):
+            g.user = User.query.get(viewer_id)
+            messages, users = load(g.user)
+            return (render_template('messages/timeline.html', title='Bench',
+                                    messages=messages, next_cursor=None)
+                    + render_template('users/index.html', users=users))
+
+    return lambda: (render, render())
+
+
+@benchmark('list pages orm', metrics=list_page_metrics)
+def bench_list_pages_orm(fixture, db, app):
+    from functions import followed_ids, recent_messages
+    from models import Message, User
+
+    def load(user):
+        return (recent_messages(Message.user_id.in_(followed_ids(user)), 100),
+                User.query.order_by(User.id).all())
+
+    return list_pages(app, fixture['viewer_id'], load)
+
+
+@benchmark('list pages read models', metrics=list_page_metrics)
+def bench_list_pages_read_models(fixture, db, app):
+    from functions import followed_ids
+    from models import Message
+    from readmodels import recent_message_rows, user_rows
+
+    def load(user):
+        return (recent_message_rows(Message.user_id.in_(followed_ids(user)), 100),
+                user_rows())
+
+    return list_pages(app, fixture['viewer_id'], load)
+
+
+COLD_START_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from app import create_app, warm_up
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+warm_up(app)
+warmed = time.perf_counter()
+app.test_client().get('/login')
+served = time.perf_counter()
+print(json.dumps(dict(
+    import_ms=round((imported - start) * 1000, 3),
+    create_ms=round((created - imported) * 1000, 3),
+    warm_up_ms=round((warmed - created) * 1000, 3),
+    first_request_ms=round((served - warmed) * 1000, 3))))
+"""
+
+
+@benchmark('app cold start', metrics=json.loads)
+def bench_cold_start(fixture, db, app):
+    command = [sys.executable, '-c', COLD_START_SCRIPT]
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    return lambda: subprocess.run(command, cwd=cwd, check=True, text=True,
+                                  capture_output=True).stdout
+
+
+def timeline_viewers(fixture):
+    """SERVING_CONCURRENCY user ids, to fetch that many timelines at once."""
+
+    return [1 + n % fixture['num_users'] for n in range(SERVING_CONCURRENCY)]
+
+
+@functools.lru_cache(maxsize=None)
+def serving_loop():
+    """The event loop for async serving benchmarks; the async engine's
+    pooled connections belong to it, so every run has to use the same."""
+
+    return asyncio.new_event_loop()
+
+
+@benchmark('serve timelines sync', metrics=throughput_metrics)
+def bench_serve_sync(fixture, db, app):
+    from concurrent.futures import ThreadPoolExecutor
+    from app import CURR_USER_KEY
+
+    clients = []
+    for user_id in timeline_viewers(fixture):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        clients.append(client)
+
+    pool = ThreadPoolExecutor(SERVING_THREADS)
+
+    def serve():
+        start = time.perf_counter()
+        statuses = list(pool.map(lambda client: client.get('/').status_code,
+                                 clients))
+        return statuses, time.perf_counter() - start
+
+    return serve
+
+
+@benchmark('serve timelines async', metrics=throughput_metrics)
+def bench_serve_async(fixture, db, app):
+    from app import CURR_USER_KEY
+    from asgi import application, fetch
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = [('Cookie', f"{app.session_cookie_name}="
+                          f"{serializer.dumps({CURR_USER_KEY: user_id})}")
+               for user_id in timeline_viewers(fixture)]
+
+    async def fetch_all():
+        return await asyncio.gather(*[fetch(application, '/', headers=[cookie])
+                                      for cookie in cookies])
+
+    def serve():
+        start = time.perf_counter()
+        responses = serving_loop().run_until_complete(fetch_all())
+        return ([status for status, _, _ in responses],
+                time.perf_counter() - start)
+
+    return serve
+
+
+def time_benchmark(prepared, repeat, metrics=None):
+    """Time a prepared benchmark `repeat` times; return stats in ms."""
+
+    if isinstance(prepared, tuple):
+        setup, func = prepared
+    else:
+        setup, func = None, prepared
+
+    timings = []
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    stats = dict(
+        runs=repeat,
+        min_ms=round(min(timings), 3),
+        median_ms=round(statistics.median(timings), 3),
+        max_ms=round(max(timings), 3),
+    )
+    if metrics:
+        stats.update(metrics(result))
+    return stats
+
+
+def run_benchmarks(sizes, repeat, names=None):
+    """Seed each fixture size and run every (selected) benchmark on it."""
+
+    from app import app
+    from models import db
+
+    app.config['TESTING'] = True
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    results = {}
+    for size in sizes:
+        print(f"seeding fixture with {size} messages...", file=sys.stderr)
+        fixture = seed_fixture(db, size)
+        results[str(size)] = size_results = {}
+
+        for name, (bench, metrics) in BENCHMARKS.items():
+            if names and name not in names:
+                continue
+            prepared = bench(fixture, db, app)
+            time_benchmark(prepared, 1)  # warm up caches and connections
+            size_results[name] = time_benchmark(prepared, repeat, metrics)
+            print(f"  {name:<28} {size_results[name]['median_ms']:>10.3f} ms",
+                  file=sys.stderr)
+
+    db.session.remove()
+    return results
+
+
+##############################################################################
+# Results and baselines
+
+
+def compare_results(current, baseline, threshold):
+    """Compare median timings of `current` to `baseline`.
+
+    Returns a list of regression dicts for every (size, benchmark) that got
+    slower by more than `threshold` percent. Entries missing from either
+    side are ignored.
+    """
+
+    regressions = []
+    for size, benchmarks in current.items():
+        for name, stats in benchmarks.items():
+            base = baseline.get(size, {}).get(name)
+            if not base or not base['median_ms']:
+                continue
+            change = (stats['median_ms'] - base['median_ms']) / base['median_ms'] * 100
+            if change > threshold:
+                regressions.append(dict(
+                    size=size,
+                    benchmark=name,
+                    baseline_ms=base['median_ms'],
+                    current_ms=stats['median_ms'],
+                    change_pct=round(change, 1),
+                ))
+    return regressions
+
+
+def write_json(path, results):
+    """Write `results` with some context about the run to `path`."""
+
+    with open(path, 'w') as f:
+        json.dump(dict(
+            created=datetime.utcnow().isoformat(),
+            python=platform.python_version(),
+            machine=platform.node(),
+            results=results,
+        ), f, indent=2)
+
+
+def load_results(path):
+    """Load the results stored in `path`, or None if it doesn't exist."""
+
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS),
+                        help='run only these benchmarks')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float,
+                        default=float(os.environ.get('BENCH_THRESHOLD',
+                                                     DEFAULT_THRESHOLD)),
+                        help='allowed slowdown in percent (default %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--database-url',
+                        default=os.environ.get('BENCH_DATABASE_URL',
+                                               DEFAULT_DATABASE_URL))
+    args = parser.parse_args(argv)
+
+    # like the tests, this has to happen before the app is imported; the
+    # fixtures drop all tables, so never fall back to the dev database
+    os.environ['DATABASE_URL'] = args.database_url
+
+    results = run_benchmarks(args.sizes, args.repeat, args.only)
+    write_json(args.output, results)
+
+    if args.save_baseline:
+        write_json(args.baseline, results)
+        print(f"baseline saved to {args.baseline}", file=sys.stderr)
+        return 0
+
+    baseline = load_results(args.baseline)
+    if baseline is None:
+        print(f"no baseline at {args.baseline}; run with --save-baseline",
+              file=sys.stderr)
+        return 0
+
+    regressions = compare_results(results, baseline, args.threshold)
+    for r in regressions:
+        print(f"REGRESSION {r['benchmark']} @ {r['size']} messages: "
+              f"{r['baseline_ms']} ms -> {r['current_ms']} ms "
+              f"(+{r['change_pct']}%)", file=sys.stderr)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
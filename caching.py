@@ -0,0 +1,390 @@
+"""Caches for Warbler.
+
+Run a shared cache server for several worker processes like:
+
+    python caching.py serve --address localhost:11311
+"""
+
+import argparse
+import logging
+import os
+from collections import OrderedDict, namedtuple
+from itertools import islice
+from multiprocessing.managers import BaseManager
+from threading import Lock
+from weakref import WeakSet
+from time import monotonic
+
+from flask import current_app, render_template
+from markupsafe import Markup
+from sqlalchemy import event
+
+from models import db, User
+
+logger = logging.getLogger(__name__)
+
+
+# every cache that holds something by id, for clear_dropped; weak, so an
+# app's caches go with it
+CLEARED_ON_DROP = WeakSet()
+
+
+def clear_on_drop(cache):
+    """Clear `cache` (anything with a clear()) whenever the tables are
+    dropped: ids start over when they're rebuilt (seeding, tests), so
+    anything cached from before would be wrong. Returns `cache`."""
+
+    CLEARED_ON_DROP.add(cache)
+    return cache
+
+
+@event.listens_for(db.metadata, 'after_drop')
+def clear_dropped(*args, **kw):
+    for cache in list(CLEARED_ON_DROP):
+        cache.clear()
+
+
+class LRUCache:
+    """A thread-safe cache that drops the least recently used entries
+    once it holds more than `maxsize` of them.
+
+    Entries set with a `ttl` (in seconds) also expire after that long.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        # key -> (value, monotonic time it expires at, or None)
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _lookup(self, key, now):
+        """(True, value) for a live entry, dropping an expired one, else
+        (False, None). Call with the lock held."""
+
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            return False, None
+        if expires is not None and expires <= now:
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def _store(self, mapping, ttl):
+        """Call with the lock held."""
+
+        expires = None if ttl is None else monotonic() + ttl
+        for key, value in mapping.items():
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        """Return the value cached for `key` (or `default`)."""
+
+        with self._lock:
+            found, value = self._lookup(key, monotonic())
+        return value if found else default
+
+    def set(self, key, value, ttl=None):
+        """Cache `value` under `key`, evicting old entries if needed."""
+
+        with self._lock:
+            self._store({key: value}, ttl)
+
+    def get_many(self, keys):
+        """Return a dict of the values cached for any of `keys`."""
+
+        found = {}
+        now = monotonic()
+        with self._lock:
+            for key in keys:
+                hit, value = self._lookup(key, now)
+                if hit:
+                    found[key] = value
+        return found
+
+    def set_many(self, mapping, ttl=None):
+        """Cache every value in `mapping` under its key."""
+
+        with self._lock:
+            self._store(mapping, ttl)
+
+    def delete(self, key):
+        """Drop `key` from the cache, if it's there."""
+
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Drop everything."""
+
+        with self._lock:
+            self._data.clear()
+
+
+##############################################################################
+# Shared cache
+#
+# An LRUCache only helps the process that filled it, and invalidating it
+# doesn't reach the other workers. For those, `python caching.py serve`
+# runs one LRUCache in a process of its own, and every worker talks to it
+# through a SharedCache. That process is a local stand-in for memcached or
+# Redis: anything with get_many/set_many/delete/clear can take its place.
+
+CACHE_METHODS = ('get', 'set', 'delete', 'clear', 'get_many', 'set_many',
+                 '__len__')
+
+
+class CacheManager(BaseManager):
+    """Connects to the cache served by `make_cache_server`."""
+
+
+CacheManager.register('cache', exposed=CACHE_METHODS)
+
+
+def parse_address(address):
+    """'host:port' -> (host, port)"""
+
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+def make_cache_server(address, authkey, maxsize=100000):
+    """A server for one LRUCache; call its serve_forever() to run it."""
+
+    cache = LRUCache(maxsize)
+
+    class Manager(BaseManager):
+        pass
+
+    Manager.register('cache', callable=lambda: cache, exposed=CACHE_METHODS)
+    return Manager(address=address, authkey=authkey).get_server()
+
+
+class SharedCache:
+    """Client for a cache server, with the same interface as LRUCache.
+
+    Every call is one round trip. When the server can't be reached, the
+    cache behaves as if it were empty rather than failing the request.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._proxy = None
+        self._lock = Lock()
+
+    def __len__(self):
+        return self._call('__len__', default=0)
+
+    def _cache(self):
+        with self._lock:
+            if self._proxy is None:
+                manager = CacheManager(address=self.address,
+                                       authkey=self.authkey)
+                manager.connect()
+                self._proxy = manager.cache()
+            return self._proxy
+
+    def _call(self, method, *args, default=None):
+        try:
+            return getattr(self._cache(), method)(*args)
+        except (OSError, EOFError) as e:
+            logger.warning("cache server %s unavailable: %s", self.address, e)
+            with self._lock:
+                self._proxy = None
+            return default
+
+    def get(self, key, default=None):
+        return self._call('get', key, default, default=default)
+
+    def set(self, key, value, ttl=None):
+        self._call('set', key, value, ttl)
+
+    def get_many(self, keys):
+        return self._call('get_many', list(keys), default={})
+
+    def set_many(self, mapping, ttl=None):
+        self._call('set_many', mapping, ttl)
+
+    def delete(self, key):
+        self._call('delete', key)
+
+    def clear(self):
+        self._call('clear')
+
+
+##############################################################################
+# User cards
+#
+# Every message on a page shows its author's username and avatar, and user
+# listings add the header image. Those come from the user card cache
+# instead of the users table; `profile` and `delete_user` invalidate a
+# user's card after changing it. A request that read the old card just
+# before that can still cache it just after, so cards also expire after
+# USER_CARD_TTL seconds, which bounds how long a stale one is shown.
+
+UserCard = namedtuple('UserCard', ['id', 'username', 'image_url',
+                                   'header_image_url', 'profile_version'])
+
+
+def user_cards(user_ids):
+    """Cards for `user_ids`, as a dict by id: whatever's cached is fetched
+    in one lookup and the rest in one query. Missing users are left out."""
+
+    cache = current_app.extensions['user_cards']
+    user_ids = set(user_ids)
+
+    cards = cache.get_many(user_ids)
+    missing = user_ids.difference(cards)
+
+    if missing:
+        loaded = {row.id: UserCard(*row) for row in
+                  db.session.query(*[getattr(User, field)
+                                     for field in UserCard._fields])
+                  .filter(User.id.in_(missing))}
+        cache.set_many(loaded, current_app.config['USER_CARD_TTL'])
+        cards.update(loaded)
+
+    return cards
+
+
+def user_card(user_id):
+    """The card for `user_id`, or None if there's no such user."""
+
+    return user_cards([user_id]).get(user_id)
+
+
+def invalidate_user_card(user_id):
+    """Drop `user_id`'s card; call this after committing a change to it."""
+
+    current_app.extensions['user_cards'].delete(user_id)
+
+
+def with_authors(messages):
+    """Template filter pairing each of `messages` with its author's card.
+    Messages whose author is gone (deleted since the page was read) are
+    skipped.
+
+    Cards are looked up USER_CARD_BATCH_SIZE messages at a time, so a page
+    of messages costs one cache round trip (a streamed one, one per batch).
+    """
+
+    batch_size = current_app.config['USER_CARD_BATCH_SIZE']
+    messages = iter(messages)
+
+    while True:
+        batch = list(islice(messages, batch_size))
+        if not batch:
+            return
+
+        cards = user_cards(msg.user_id for msg in batch)
+        for msg in batch:
+            card = cards.get(msg.user_id)
+            if card is not None:
+                yield msg, card
+
+
+def init_user_cards(app):
+    """Set up the user card cache for `app`.
+
+    USER_CARD_CACHE picks the backend: 'memory' (an LRUCache per process,
+    the default) or 'shared' (a SharedCache for the server at
+    USER_CARD_CACHE_ADDRESS). Cards expire after USER_CARD_TTL seconds.
+
+    You should call this in your Flask app, after connect_db.
+    """
+
+    app.config.setdefault('USER_CARD_CACHE', 'memory')
+    app.config.setdefault('USER_CARD_CACHE_SIZE', 10000)
+    app.config.setdefault('USER_CARD_CACHE_ADDRESS', 'localhost:11311')
+    app.config.setdefault('USER_CARD_BATCH_SIZE', 50)
+    app.config.setdefault('USER_CARD_TTL', 300)
+
+    if app.config['USER_CARD_CACHE'] == 'shared':
+        cache = SharedCache(parse_address(app.config['USER_CARD_CACHE_ADDRESS']),
+                            app.config['SECRET_KEY'].encode('UTF-8'))
+    else:
+        cache = LRUCache(app.config['USER_CARD_CACHE_SIZE'])
+
+    app.extensions['user_cards'] = clear_on_drop(cache)
+    app.jinja_env.filters['with_authors'] = with_authors
+
+    return cache
+
+
+##############################################################################
+# Message fragments
+#
+# The avatar, username, date and text of a message look the same to every
+# viewer, so that markup is rendered once and reused on every timeline and
+# profile it shows up on. Only the like button is rendered per request.
+
+
+def message_fragment_key(msg, author):
+    """Cache key for the rendered markup of `msg` by `author`.
+
+    Messages can't be edited, so the only thing that changes a fragment is
+    its author editing their profile, which bumps `profile_version` and so
+    orphans all of their old fragments (the LRU drops them eventually).
+    """
+
+    return (msg.id, msg.user_id, author.profile_version)
+
+
+def message_fragment(msg, author=None):
+    """Viewer-independent markup for `msg` in a list of messages.
+
+    `author` may be the author's UserCard, which saves loading the User.
+    """
+
+    if author is None:
+        author = msg.user
+
+    cache = current_app.extensions['fragment_cache']
+    key = message_fragment_key(msg, author)
+
+    html = cache.get(key)
+    if html is None:
+        html = Markup(render_template('messages/_fragment.html', msg=msg,
+                                      author=author))
+        cache.set(key, html)
+    return html
+
+
+def init_fragment_cache(app):
+    """Set up the message fragment cache for `app`.
+
+    You should call this in your Flask app, after connect_db.
+    """
+
+    cache = LRUCache(app.config.get('FRAGMENT_CACHE_SIZE', 10000))
+    app.extensions['fragment_cache'] = clear_on_drop(cache)
+    app.jinja_env.globals['message_fragment'] = message_fragment
+
+    return cache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Warbler cache server')
+    parser.add_argument('command', choices=['serve'])
+    parser.add_argument('--address', default='localhost:11311')
+    parser.add_argument('--size', type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    # the same key the app signs sessions with (see USER_CARD_CACHE)
+    authkey = os.environ.get('SECRET_KEY', "it's a secret").encode('UTF-8')
+
+    server = make_cache_server(parse_address(args.address), authkey, args.size)
+    print(f"serving cache on {args.address}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
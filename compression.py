@@ -0,0 +1,187 @@
+"""On-the-fly compression of dynamic responses.
+
+Timeline and profile pages repeat the same markup for every message, so
+they shrink a lot with gzip or brotli. `init_compression` adds an
+after_request hook that picks the best encoding the client accepts and
+compresses the body:
+
+- buffered responses smaller than COMPRESS_MIN_SIZE are left alone;
+- streamed responses (whose size isn't known up front) are compressed
+  chunk by chunk, flushing after each chunk so they still stream;
+- COMPRESS_LEVEL (gzip, 1-9) and COMPRESS_BROTLI_QUALITY (0-11) trade
+  CPU for size.
+
+Bytes in/out and the CPU time spent compressing are added up in
+`app.extensions['compression']` (a CompressionStats).
+"""
+
+import time
+import zlib
+from threading import Lock
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import current_app, request
+
+COMPRESSIBLE_MIMETYPES = {
+    'text/html',
+    'text/plain',
+    'text/css',
+    'application/json',
+    'application/javascript',
+}
+
+
+class CompressionStats:
+    """Running totals for everything the app has compressed."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def record(self, bytes_in, bytes_out, cpu_seconds, response=False):
+        with self._lock:
+            self.responses += response
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.cpu_seconds += cpu_seconds
+
+    @property
+    def ratio(self):
+        """Compressed size as a fraction of the original size."""
+
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+    def as_dict(self):
+        return dict(responses=self.responses, bytes_in=self.bytes_in,
+                    bytes_out=self.bytes_out, ratio=round(self.ratio, 4),
+                    cpu_ms=round(self.cpu_seconds * 1000, 3))
+
+
+def make_compressor(encoding, config):
+    """Returns (compress, flush, finish) functions for `encoding`."""
+
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=config['COMPRESS_BROTLI_QUALITY'])
+        return compressor.process, compressor.flush, compressor.finish
+
+    # wbits=31: zlib's deflate with a gzip header and trailer
+    compressor = zlib.compressobj(config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)
+    return (compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush)
+
+
+def choose_encoding():
+    """The best encoding this request accepts, or None."""
+
+    if brotli and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_body(body, encoding, config, stats):
+    """Compress a buffered body in one go."""
+
+    compress, _, finish = make_compressor(encoding, config)
+
+    start = time.thread_time()
+    compressed = compress(body) + finish()
+    stats.record(len(body), len(compressed), time.thread_time() - start,
+                 response=True)
+
+    return compressed
+
+
+def compress_stream(chunks, encoding, config, stats):
+    """Compress a streamed body, flushing after every chunk."""
+
+    compress, flush, finish = make_compressor(encoding, config)
+    stats.record(0, 0, 0, response=True)
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('UTF-8')
+            if not chunk:
+                continue
+
+            start = time.thread_time()
+            compressed = compress(chunk) + flush()
+            stats.record(len(chunk), len(compressed), time.thread_time() - start)
+            yield compressed
+
+        start = time.thread_time()
+        compressed = finish()
+        stats.record(0, len(compressed), time.thread_time() - start)
+        yield compressed
+
+    finally:
+        # let the wrapped stream clean up (e.g. pop its request context)
+        # even if the client went away halfway through
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(resp):
+    """Compress `resp` if it's worth it and the client accepts it."""
+
+    resp.vary.add('Accept-Encoding')
+
+    if (resp.status_code < 200 or resp.status_code in (204, 304)
+            or request.method == 'HEAD'
+            or resp.direct_passthrough
+            or 'Content-Encoding' in resp.headers
+            or resp.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return resp
+
+    encoding = choose_encoding()
+    if not encoding:
+        return resp
+
+    config = current_app.config
+    stats = current_app.extensions['compression']
+
+    if resp.is_streamed:
+        resp.response = compress_stream(resp.response, encoding, config, stats)
+        resp.headers.pop('Content-Length', None)
+    else:
+        body = resp.get_data()
+        if len(body) < config['COMPRESS_MIN_SIZE']:
+            return resp
+        resp.set_data(compress_body(body, encoding, config, stats))
+
+    resp.content_encoding = encoding
+
+    # the compressed bytes differ from the uncompressed ones, so the
+    # validator can only promise they're equivalent
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+
+    return resp
+
+
+def init_compression(app):
+    """Compress `app`'s dynamic responses on the fly.
+
+    You should call this in your Flask app.
+    """
+
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)
+
+    stats = CompressionStats()
+    app.extensions['compression'] = stats
+    app.after_request(compress_response)
+
+    return stats
@@ -0,0 +1,261 @@
+"""Live timeline updates over Server-Sent Events.
+
+When a message is posted, `publish_message` announces its id on the
+author's topic ("user:<id>"). Clients of /stream/timeline subscribe to
+the topics of everyone they follow and get an SSE `messages_add` event
+for each new message, so they can fetch just that message instead of
+reloading the whole timeline.
+
+Events go through a Hub: every subscriber has its own bounded queue, and
+publishing never blocks. When a slow client's queue is full its events
+are dropped and it gets an `overflow` event instead, telling it to
+reload.
+
+With EVENTS_BROKER = 'local' (the default) the hub only sees events
+published in the same process. With 'postgres', events are sent with
+NOTIFY and each process runs one LISTEN thread that feeds its hub, so
+all workers see every event. Either way a stream holds no database
+connection while it waits.
+"""
+
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from collections import defaultdict
+
+from flask import Blueprint, Response, current_app, g
+from sqlalchemy import text
+
+from models import db, Follows
+
+stream = Blueprint('stream', __name__, url_prefix='/stream')
+
+NOTIFY_CHANNEL = 'warbler_events'
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One subscriber's bounded queue of events."""
+
+    def __init__(self, hub, topics, maxsize):
+        self.hub = hub
+        self.topics = frozenset(topics)
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Next event, or None if nothing arrived within `timeout` secs."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class Hub:
+    """In-process publish/subscribe by topic."""
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics):
+        sub = Subscription(self, topics, self.queue_size)
+        with self._lock:
+            for topic in sub.topics:
+                self._subscribers[topic].add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for topic in sub.topics:
+                self._subscribers[topic].discard(sub)
+                if not self._subscribers[topic]:
+                    del self._subscribers[topic]
+
+    def subscriber_count(self, topic):
+        with self._lock:
+            return len(self._subscribers.get(topic, ()))
+
+    def dispatch(self, topic, event):
+        """Hand `event` to every subscriber of `topic`, without blocking."""
+
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+        for sub in subscribers:
+            sub.put(event)
+
+
+class LocalBroker:
+    """Delivers events to this process's hub only."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def start(self):
+        pass
+
+    def publish(self, topic, event):
+        self.hub.dispatch(topic, event)
+
+
+class PostgresBroker:
+    """Delivers events to the hubs of every process, through Postgres
+    NOTIFY/LISTEN on one dedicated connection per process."""
+
+    def __init__(self, hub, database_url):
+        self.hub = hub
+        self.database_url = database_url
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def publish(self, topic, event):
+        payload = json.dumps(dict(topic=topic, event=event))
+        with db.engine.begin() as conn:
+            conn.execute(text('SELECT pg_notify(:channel, :payload)'),
+                         dict(channel=NOTIFY_CHANNEL, payload=payload))
+
+    def start(self):
+        """Start the LISTEN thread, if it isn't running yet."""
+
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self.listen,
+                                                  name='events-listener',
+                                                  daemon=True)
+                self._listener.start()
+
+    def listen(self):
+        import psycopg2  # only the listener thread needs it directly
+
+        while True:
+            try:
+                self._listen()
+            except psycopg2.Error:
+                logger.exception('events listener lost its connection')
+                time.sleep(5)
+
+    def _listen(self):
+        import psycopg2
+
+        conn = psycopg2.connect(self.database_url)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        conn.cursor().execute(f'LISTEN {NOTIFY_CHANNEL}')
+
+        try:
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    message = json.loads(notify.payload)
+                    self.hub.dispatch(message['topic'], message['event'])
+        finally:
+            conn.close()
+
+
+def user_topic(user_id):
+    return f"user:{user_id}"
+
+
+def publish_message(msg):
+    """Announce a newly committed message to its author's followers."""
+
+    broker = current_app.extensions['events']['broker']
+    broker.publish(user_topic(msg.user_id),
+                   dict(type='messages_add', id=msg.id, user_id=msg.user_id))
+
+
+##############################################################################
+# SSE endpoint
+
+
+def format_sse(event, data=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data) if data is not None else ''}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def event_stream(sub, keepalive):
+    """SSE text for `sub`'s events; comments keep idle connections open."""
+
+    try:
+        yield f"retry: {int(keepalive * 1000)}\n\n"
+
+        while True:
+            event = sub.get(timeout=keepalive)
+
+            if sub.overflowed:
+                sub.overflowed = False
+                yield format_sse('overflow')
+
+            if event is None:
+                yield ': keepalive\n\n'
+            else:
+                yield format_sse(event['type'], event, event_id=event['id'])
+
+    finally:
+        sub.close()
+
+
+@stream.route('/timeline')
+def timeline():
+    """New messages from the users the logged-in user follows."""
+
+    if not g.user:
+        return Response('Access unauthorized.', status=401)
+
+    followed_ids = (db.session.query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == g.user.id))
+    topics = [user_topic(user_id) for (user_id,) in followed_ids]
+
+    # the stream can stay open for hours; give the connection back now
+    db.session.remove()
+
+    events = current_app.extensions['events']
+    events['broker'].start()
+    sub = events['hub'].subscribe(topics)
+
+    return Response(event_stream(sub, current_app.config['EVENTS_KEEPALIVE']),
+                    mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+def init_events(app):
+    """Set up the event hub and broker and the /stream endpoints.
+
+    You should call this in your Flask app, after connect_db.
+    """
+
+    app.config.setdefault('EVENTS_BROKER', 'local')
+    app.config.setdefault('EVENTS_QUEUE_SIZE', 100)
+    app.config.setdefault('EVENTS_KEEPALIVE', 15)
+
+    hub = Hub(app.config['EVENTS_QUEUE_SIZE'])
+    if app.config['EVENTS_BROKER'] == 'postgres':
+        broker = PostgresBroker(hub, app.config['SQLALCHEMY_DATABASE_URI'])
+    else:
+        broker = LocalBroker(hub)
+
+    app.extensions['events'] = dict(hub=hub, broker=broker)
+    app.register_blueprint(stream)
+
+    return hub
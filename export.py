@@ -0,0 +1,268 @@
+"""Downloadable exports of a user's own data.
+
+/users/export streams the logged in user's profile, messages, likes and
+follow lists, as newline-delimited JSON (the default) or, with
+?format=zip, as a zip of one .ndjson file per section. Each line of the
+NDJSON export has a "section" key saying which one it belongs to.
+
+Rows are read from server-side cursors EXPORT_CHUNK_SIZE at a time, and
+the output is sent in chunks of about EXPORT_WRITE_SIZE bytes as it's
+produced, so an export holds about the same memory however much the
+user has posted. The whole export is read in one REPEATABLE READ
+transaction, so every section is from the same snapshot.
+
+Each worker runs at most EXPORT_CONCURRENCY exports at once; past that,
+/users/export answers 429 with a Retry-After.
+
+With shards (see shards.py), the messages are read from the user's
+shard, and liked messages that aren't on the main database are looked
+up on the others a chunk at a time. Each shard's reads are a snapshot of
+their own.
+
+Messages that have been archived (see partitions.py) aren't included.
+"""
+
+import json
+import zipfile
+from contextlib import nullcontext
+from itertools import islice
+from threading import BoundedSemaphore
+
+from flask import Blueprint, Response, current_app, flash, g, redirect, request
+from sqlalchemy import select
+
+from models import db, User, Message, Follows, Likes
+from shards import shard_count, shard_engine, user_shard
+
+export = Blueprint('export', __name__, url_prefix='/users')
+
+FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'zip': ('application/zip', 'zip'),
+}
+
+RETRY_AFTER = 30
+
+
+def export_queries(user_id):
+    """(section, query) for everything exported besides the profile."""
+
+    return [
+        ('messages', select(Message.id, Message.text, Message.timestamp)
+         .where(Message.user_id == user_id)
+         .order_by(Message.id)),
+        # liked messages may have been deleted or archived since
+        ('likes', select(Likes.message_id, Message.text, Message.timestamp,
+                         Message.user_id)
+         .outerjoin(Message, Message.id == Likes.message_id)
+         .where(Likes.user_id == user_id)
+         .order_by(Likes.id)),
+        ('following', select(User.id, User.username)
+         .join(Follows, Follows.user_being_followed_id == User.id)
+         .where(Follows.user_following_id == user_id)
+         .order_by(User.id)),
+        ('followers', select(User.id, User.username)
+         .join(Follows, Follows.user_following_id == User.id)
+         .where(Follows.user_being_followed_id == user_id)
+         .order_by(User.id)),
+    ]
+
+
+def sharded_likes(rows, engines, chunk_size):
+    """The likes section's `rows`, with the messages that are on a shard
+    other than the main database (the first of `engines`) filled in."""
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+
+        missing = [row['message_id'] for row in chunk if row['text'] is None]
+        found = {}
+        for engine in engines[1:] if missing else ():
+            with engine.connect() as connection:
+                found.update(
+                    (row.id, dict(text=row.text, timestamp=row.timestamp,
+                                  user_id=row.user_id))
+                    for row in connection.execute(
+                        select(Message.id, Message.text, Message.timestamp,
+                               Message.user_id)
+                        .where(Message.id.in_(missing))))
+
+        for row in chunk:
+            row.update(found.get(row['message_id'], {}))
+        yield from chunk
+
+
+def export_sections(engines, user_id, shard, chunk_size):
+    """(section, rows) pairs for `user_id`'s export, rows being dicts.
+
+    `engines` are the shards', the main database's first, and `shard` is
+    the one holding the user's messages.
+
+    Each section's rows have to be used up before asking for the next
+    section; they come off server-side cursors, on one connection per
+    database read.
+    """
+
+    with engines[0].connect() as connection, \
+            (engines[shard].connect() if shard else nullcontext()) as sharded:
+        connection = connection.execution_options(
+            isolation_level='REPEATABLE READ')
+        messages_connection = connection
+        if sharded is not None:
+            sharded = messages_connection = sharded.execution_options(
+                isolation_level='REPEATABLE READ')
+
+        with connection.begin(), \
+                (sharded.begin() if sharded is not None else nullcontext()):
+            profile = connection.execute(
+                select(User.id, User.username, User.email, User.bio,
+                       User.location, User.image_url, User.header_image_url)
+                .where(User.id == user_id)).one()
+            yield 'profile', [dict(profile._mapping)]
+
+            for section, query in export_queries(user_id):
+                reading = (messages_connection if section == 'messages'
+                           else connection)
+                result = (reading
+                          .execution_options(stream_results=True,
+                                             max_row_buffer=chunk_size)
+                          .execute(query))
+                rows = (dict(row._mapping) for row in result)
+                if section == 'likes' and len(engines) > 1:
+                    rows = sharded_likes(rows, engines, chunk_size)
+                yield section, rows
+
+
+def json_line(record):
+    return (json.dumps(record, default=lambda value: value.isoformat())
+            + '\n').encode('UTF-8')
+
+
+class ChunkWriter:
+    """A write-only file that hands back what's written to it in chunks of
+    at least `size` bytes.
+
+    It has no tell() or seek(), so zipfile writes to it as a stream.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray()
+        self.chunks = []
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.size:
+            self.chunks.append(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self, final=False):
+        """The chunks filled since the last call; with `final`, whatever
+        is left over too."""
+
+        if final and self.buffer:
+            self.chunks.append(bytes(self.buffer))
+            self.buffer.clear()
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def ndjson_export(sections, write_size):
+    writer = ChunkWriter(write_size)
+
+    for section, rows in sections:
+        for row in rows:
+            writer.write(json_line(dict(section=section, **row)))
+            yield from writer.take()
+
+    yield from writer.take(final=True)
+
+
+def zip_export(sections, write_size):
+    writer = ChunkWriter(write_size)
+
+    with zipfile.ZipFile(writer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for section, rows in sections:
+            # the size isn't known up front, so allow for a big one
+            with archive.open(f"{section}.ndjson", 'w', force_zip64=True) as out:
+                for row in rows:
+                    out.write(json_line(row))
+                    yield from writer.take()
+
+    yield from writer.take(final=True)
+
+
+@export.route('/export')
+def export_data():
+    """Download everything about the logged in user as ?format=ndjson
+    (the default) or zip."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in FORMATS:
+        return Response(f"Unknown format {export_format!r}.", status=400)
+
+    exports = current_app.extensions['export']
+    if not exports['slots'].acquire(blocking=False):
+        return Response("Too many exports running; try again shortly.",
+                        status=429, headers={'Retry-After': str(RETRY_AFTER)})
+
+    try:
+        config = current_app.config
+        user_id, username = g.user.id, g.user.username
+        engines = [shard_engine(shard) for shard in range(shard_count())]
+        shard = user_shard(user_id)
+
+        # the export reads on a connection of its own; don't hold the
+        # session's while it streams
+        db.session.remove()
+
+        sections = export_sections(engines, user_id, shard,
+                                   config['EXPORT_CHUNK_SIZE'])
+        body = (zip_export if export_format == 'zip' else ndjson_export)(
+            sections, config['EXPORT_WRITE_SIZE'])
+
+        mimetype, extension = FORMATS[export_format]
+        resp = Response(body, mimetype=mimetype, headers={
+            'Content-Disposition':
+                f'attachment; filename="warbler-{username}.{extension}"',
+            'X-Accel-Buffering': 'no',
+        })
+    except BaseException:
+        exports['slots'].release()
+        raise
+
+    # these run when the server is done with the response, whether or not
+    # the body was read to the end
+    resp.call_on_close(sections.close)
+    resp.call_on_close(exports['slots'].release)
+    return resp
+
+
+def init_export(app):
+    """Set up /users/export for `app`.
+
+    EXPORT_CONCURRENCY is how many exports each worker runs at once,
+    EXPORT_CHUNK_SIZE how many rows are fetched from the database at a
+    time, and EXPORT_WRITE_SIZE roughly how many bytes are sent at a time.
+
+    You should call this in your Flask app, after connect_db.
+    """
+
+    app.config.setdefault('EXPORT_CONCURRENCY', 2)
+    app.config.setdefault('EXPORT_CHUNK_SIZE', 500)
+    app.config.setdefault('EXPORT_WRITE_SIZE', 64 * 1024)
+
+    app.extensions['export'] = dict(
+        slots=BoundedSemaphore(app.config['EXPORT_CONCURRENCY']),
+    )
+    app.register_blueprint(export)
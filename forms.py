@@ -1,25 +1,41 @@
 from re import S
 from flask.app import Flask
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed
 from models import User
-from wtforms import StringField, PasswordField, TextAreaField
-from wtforms.validators import DataRequired, Email, Length
+from wtforms import IntegerField, StringField, PasswordField, TextAreaField
+from wtforms.validators import (DataRequired, Email, Length, Optional,
+                                ValidationError)
+from wtforms.widgets import HiddenInput
 
 
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+
+
+def not_reserved(form, field):
+    """Refuse the usernames and emails kept for closed accounts."""
+
+    if field.data and User.is_reserved(field.name, field.data):
+        raise ValidationError(f"That {field.label.text.lower()} is reserved.")
+
 
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
 
     text = TextAreaField('text', validators=[DataRequired()])
+    # set when replying to a message
+    parent_id = IntegerField(widget=HiddenInput(), validators=[Optional()])
 
 
 class UserAddForm(FlaskForm):
     """Form for adding users."""
 
-    username = StringField('Username', validators=[DataRequired()])
-    email = StringField('E-mail', validators=[DataRequired()])
+    username = StringField('Username', validators=[DataRequired(), not_reserved])
+    email = StringField('E-mail', validators=[DataRequired(), not_reserved])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Profile image URL')
+    image = FileField('(Optional) Upload a profile image',
+                      validators=[FileAllowed(IMAGE_EXTENSIONS, 'Images only!')])
 
 
 class LoginForm(FlaskForm):
@@ -31,9 +47,13 @@ class LoginForm(FlaskForm):
 class EditProfileForm(FlaskForm):
     """Form to edit profile."""
     
-    username = StringField('Username', validators=[DataRequired()])
-    email = StringField('E-mail', validators=[DataRequired()])
+    username = StringField('Username', validators=[DataRequired(), not_reserved])
+    email = StringField('E-mail', validators=[DataRequired(), not_reserved])
     image_url = StringField('(Optional) Profile image URL')
     header_image_url = StringField('(Optional) Header image URL')
+    image = FileField('(Optional) Upload a profile image',
+                      validators=[FileAllowed(IMAGE_EXTENSIONS, 'Images only!')])
+    header_image = FileField('(Optional) Upload a header image',
+                             validators=[FileAllowed(IMAGE_EXTENSIONS, 'Images only!')])
     bio = TextAreaField('Bio', )
     password = PasswordField('Password')
@@ -1,3 +1,14 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select, update
+
+from jobs import handler
+from models import (db, User, Message, Follows, Likes, Repost, MessageTag,
+                    Mention, Notification, NotificationEvent)
+
+# how far back recent_messages looks before giving up and reading every
+# partition
+RECENT_WINDOWS = (timedelta(days=31), timedelta(days=366))
 
 
 def collect_follower_messages(user):
@@ -6,4 +17,129 @@ def collect_follower_messages(user):
     for follower in followers:
         for msg in follower.messages:
             messages.append(msg)
-    return messages
\ No newline at end of file
+    return messages
+
+
+def recent_messages(criterion, limit, columns=None, session=None):
+    """The `limit` newest messages matching `criterion`, newest first; with
+    `columns`, rows of just those columns instead of Message instances.
+    `session` defaults to db.session (see shards.py for the others).
+
+    Messages are partitioned by month (see partitions.py), and a query
+    bounded by timestamp only reads the partitions in range. Most pages
+    fill up from the last month or year, so those are tried first, and
+    only a page that doesn't reads the rest.
+    """
+
+    query = (session or db.session).query(*(columns or [Message]))
+    query = query.filter(criterion).order_by(Message.timestamp.desc())
+    now = datetime.utcnow()
+
+    for window in RECENT_WINDOWS:
+        messages = query.filter(Message.timestamp >= now - window).limit(limit).all()
+        if len(messages) == limit:
+            return messages
+
+    return query.limit(limit).all()
+
+
+def followed_ids(user):
+    """Subquery of the ids of the users `user` follows."""
+
+    return (db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user.id))
+
+
+def delete_message_rows(message_ids):
+    """Delete the likes, reposts, tags, mentions and notifications of
+    `message_ids` (a list or a subquery). The database doesn't cascade
+    these for us; see Likes.message_id."""
+
+    for model in (Likes, Repost, MessageTag, Mention, NotificationEvent):
+        (model.query
+         .filter(model.message_id.in_(message_ids))
+         .delete(synchronize_session=False))
+
+    # the unread ones come off their users' counts (see notifications.py)
+    gone = (delete(Notification)
+            .where(Notification.message_id.in_(message_ids),
+                   Notification.read_at.is_(None))
+            .returning(Notification.user_id)
+            .cte('gone'))
+    counts = (select(gone.c.user_id, func.count().label('unread'))
+              .group_by(gone.c.user_id)
+              .subquery())
+    db.session.execute(
+        update(User)
+        .where(User.id == counts.c.user_id)
+        .values(unread_notifications=func.greatest(
+            User.unread_notifications - counts.c.unread, 0))
+        .execution_options(synchronize_session=False))
+    (Notification.query
+     .filter(Notification.message_id.in_(message_ids))
+     .delete(synchronize_session=False))
+
+
+@handler('purge_user')
+def purge_user(payload):
+    """Job: delete a user and everything they posted."""
+
+    # shards imports this module
+    from shards import purge_user_shard
+
+    user_id = payload['user_id']
+    delete_message_rows(db.session.query(Message.id)
+                        .filter(Message.user_id == user_id))
+    # messages on another shard go with the user's row there
+    sharded_ids = purge_user_shard(user_id)
+    if sharded_ids:
+        delete_message_rows(sharded_ids)
+    # the database cascades the rest: messages, follows, likes, mentions
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+
+
+def message_page_version(message_id):
+    """Cheap validator for a message's page, or None if there's no such
+    message: its id and timestamp plus its author's id and profile version,
+    and last, the id of its thread (see threads.thread_page_version).
+    """
+
+    return (db.session
+            .query(Message.id, Message.timestamp, User.id, User.profile_version,
+                   func.coalesce(Message.thread_id, Message.id))
+            .join(User, Message.user_id == User.id)
+            .filter(Message.id == message_id)
+            .first())
+
+
+def profile_page_version(user_id):
+    """Cheap validator for a user's profile page, or None if there's no such
+    user.
+
+    Besides the profile version this covers everything the page counts or
+    lists: messages (count and newest id), following, followers and likes.
+    """
+
+    def count(column, *criteria):
+        return (db.session.query(func.count(column))
+                .filter(*criteria)
+                .scalar_subquery())
+
+    newest_message_id = (db.session.query(func.max(Message.id))
+                         .filter(Message.user_id == User.id)
+                         .scalar_subquery())
+
+    return (db.session
+            .query(
+                User.id,
+                User.profile_version,
+                count(Message.id, Message.user_id == User.id),
+                newest_message_id,
+                count(Follows.user_being_followed_id,
+                      Follows.user_following_id == User.id),
+                count(Follows.user_following_id,
+                      Follows.user_being_followed_id == User.id),
+                count(Likes.id, Likes.user_id == User.id),
+            )
+            .filter(User.id == user_id)
+            .first())
@@ -0,0 +1,104 @@
+"""HTTP cache policies and conditional GET support.
+
+Every response gets the "don't cache this" headers unless its view picks
+another policy with `set_cache_policy` (or the `cache_policy` decorator).
+Views that can tell cheaply whether a page changed call `not_modified`
+with the page's validator parts *before* loading or rendering anything,
+and return its 304 response when the client's copy is still current.
+"""
+
+from functools import wraps
+from hashlib import sha1
+
+from flask import g, make_response, request, session
+
+NO_STORE = 'no-store'
+PRIVATE = 'private'
+PUBLIC = 'public'
+
+
+def set_cache_policy(policy, max_age=0, immutable=False):
+    """Use `policy` (NO_STORE, PRIVATE or PUBLIC) for this response.
+
+    `immutable` promises the content at this URL never changes, so caches
+    don't even revalidate it until `max_age` runs out.
+    """
+
+    g.cache_policy = (policy, max_age, immutable)
+
+
+def cache_policy(policy, max_age=0, immutable=False):
+    """Decorator version of `set_cache_policy` for a whole view."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            set_cache_policy(policy, max_age, immutable)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def is_shareable():
+    """Would the page for this request look the same to everyone?
+
+    That's only true for anonymous visitors with no flashed messages
+    waiting to be shown.
+    """
+
+    return not g.get('user') and '_flashes' not in session
+
+
+def make_etag(*parts):
+    """A strong ETag for a page described by `parts`."""
+
+    return sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def not_modified(*parts):
+    """Set this response's ETag from `parts`.
+
+    Returns an empty 304 response if the client sent that ETag in
+    If-None-Match, else None (and the view should render as usual).
+    """
+
+    g.etag = make_etag(*parts)
+
+    if request.if_none_match.contains_weak(g.etag):
+        return make_response('', 304)
+    return None
+
+
+def apply_cache_policy(resp):
+    """Set the caching headers on `resp` for the current request's policy."""
+
+    policy, max_age, immutable = g.get('cache_policy', (NO_STORE, 0, False))
+
+    # error pages and anything that sets a cookie stay out of caches
+    if resp.status_code not in (200, 304):
+        policy = NO_STORE
+    elif policy == PUBLIC and session.modified:
+        policy = PRIVATE
+
+    if policy == NO_STORE:
+        resp.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        resp.headers['Pragma'] = 'no-cache'
+        resp.headers['Expires'] = '0'
+        return resp
+
+    if policy == PUBLIC:
+        resp.cache_control.public = True
+        # pages differ for logged in users; immutable files never do
+        if not immutable:
+            resp.vary.add('Cookie')
+    else:
+        resp.cache_control.private = True
+
+    resp.cache_control.max_age = max_age
+    resp.cache_control.immutable = immutable or None
+    resp.cache_control.no_cache = not max_age or None
+
+    if 'etag' in g:
+        resp.set_etag(g.etag)
+
+    return resp
@@ -0,0 +1,192 @@
+"""Uploaded avatars and header images.
+
+An upload is decoded once and resized into fixed variants (VARIANTS) on
+a pool of IMAGE_WORKERS threads, and the variants are stored under
+IMAGE_DIR by the SHA-256 of the uploaded file:
+
+    <IMAGE_DIR>/<digest>/thumb.jpg
+
+so the same file uploaded twice (or by two users) is processed and
+stored once. A stored file never changes, so /media/ serves them with a
+one-year immutable Cache-Control.
+
+`User.image_url` and `header_image_url` hold the URL of an image's main
+variant; templates pick the variant they need with the `image_src`
+filter, which leaves URLs that aren't uploads (defaults, hot links) to
+`asset_src`.
+
+Pillow is only imported once there's an image to process, so it costs
+workers nothing at startup.
+"""
+
+import hashlib
+import io
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import abort, current_app, send_from_directory
+
+from assets import ONE_YEAR, asset_src
+from http_caching import PUBLIC, set_cache_policy
+
+MEDIA_PREFIX = '/media/'
+
+# name: (width, height); thumbs are shown at 48px in timelines, cards at
+# 70px on user cards and 200px on profiles (all doubled for hi-dpi)
+VARIANTS = {
+    'thumb': (96, 96),
+    'card': (400, 400),
+    'header': (1500, 500),
+}
+
+# kind of image: (variants made for it, the one stored on the user)
+KINDS = {
+    'avatar': (('thumb', 'card'), 'card'),
+    'header': (('header',), 'header'),
+}
+
+MEDIA_URL_RE = re.compile(r'^/media/([0-9a-f]{64})/([a-z]+)\.jpg$')
+
+
+class InvalidImage(ValueError):
+    """The upload isn't an image we can read."""
+
+
+def media_url(digest, variant):
+    return f"{MEDIA_PREFIX}{digest}/{variant}.jpg"
+
+
+def decode(data, max_size, max_pixels):
+    """Decode `data` to an RGB image, upright, at least `max_size` big
+    where the original is (decoding smaller where the format allows).
+    Images of more than `max_pixels` are refused."""
+
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > max_pixels:
+            raise InvalidImage(f"{image.width}x{image.height} is too big")
+        image.draft('RGB', max_size)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError,
+            SyntaxError) as e:
+        raise InvalidImage(str(e))
+
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def write_variant(image, size, path):
+    """Crop and scale `image` to `size` and save it to `path` as a JPEG."""
+
+    from PIL import Image, ImageOps
+
+    variant = ImageOps.fit(image, size, Image.LANCZOS)
+
+    tmp = f"{path}.{os.getpid()}.{id(variant)}.tmp"
+    variant.save(tmp, 'JPEG', quality=85, optimize=True, progressive=True)
+    # another request storing the same upload may get there first; both
+    # wrote the same bytes, so whichever replace lands last is fine
+    os.replace(tmp, path)
+
+
+def store_image(data, kind):
+    """Store the uploaded `data` as an image of `kind` ('avatar' or
+    'header'); returns the URL to save on the user."""
+
+    images = current_app.extensions['images']
+    variants, main = KINDS[kind]
+
+    digest = hashlib.sha256(data).hexdigest()
+    directory = os.path.join(images['dir'], digest)
+    missing = [name for name in variants
+               if not os.path.exists(os.path.join(directory, f"{name}.jpg"))]
+
+    if missing:
+        largest = (max(VARIANTS[name][0] for name in missing),
+                   max(VARIANTS[name][1] for name in missing))
+        image = decode(data, largest, images['max_pixels'])
+        os.makedirs(directory, exist_ok=True)
+
+        futures = [images['pool'].submit(write_variant, image, VARIANTS[name],
+                                         os.path.join(directory, f"{name}.jpg"))
+                   for name in missing]
+        for future in futures:
+            future.result()
+
+    return media_url(digest, main)
+
+
+def store_upload(field, kind):
+    """Store the file uploaded through form `field`, if there is one.
+
+    Returns its URL, or None if nothing was uploaded or it isn't an image
+    (in which case the field gets an error).
+    """
+
+    if not field.data:
+        return None
+
+    try:
+        return store_image(field.data.read(), kind)
+    except InvalidImage:
+        field.errors.append("That file isn't an image we can read.")
+        return None
+
+
+def image_src(url, variant):
+    """Template filter: `url`, switched to `variant` if it's an upload."""
+
+    match = MEDIA_URL_RE.match(url or '')
+    if match:
+        return media_url(match.group(1), variant)
+    return asset_src(url)
+
+
+def serve_media(digest, variant):
+    """Serve a stored image variant."""
+
+    if not re.fullmatch(r'[0-9a-f]{64}', digest) or variant not in VARIANTS:
+        abort(404)
+
+    directory = os.path.join(current_app.extensions['images']['dir'], digest)
+    resp = send_from_directory(directory, f"{variant}.jpg",
+                               mimetype='image/jpeg')
+
+    set_cache_policy(PUBLIC, max_age=ONE_YEAR, immutable=True)
+    return resp
+
+
+def init_images(app):
+    """Set up image uploads and serving for `app`.
+
+    IMAGE_DIR is where uploads are stored, IMAGE_WORKERS the number of
+    threads resizing them, and IMAGE_MAX_PIXELS the largest image that
+    will be decoded (anything bigger is refused as a possible
+    decompression bomb).
+
+    You should call this in your Flask app.
+    """
+
+    app.config.setdefault('IMAGE_DIR', os.path.join(app.root_path, 'media'))
+    app.config.setdefault('IMAGE_WORKERS', 4)
+    app.config.setdefault('IMAGE_MAX_PIXELS', 50_000_000)
+    if app.config['MAX_CONTENT_LENGTH'] is None:
+        app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
+    app.extensions['images'] = dict(
+        dir=app.config['IMAGE_DIR'],
+        max_pixels=app.config['IMAGE_MAX_PIXELS'],
+        pool=ThreadPoolExecutor(app.config['IMAGE_WORKERS'],
+                                thread_name_prefix='images'),
+    )
+
+    app.add_url_rule('/media/<digest>/<variant>.jpg', 'media', serve_media)
+    app.jinja_env.filters['image_src'] = image_src
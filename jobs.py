@@ -0,0 +1,374 @@
+"""Durable background jobs.
+
+Work that doesn't have to finish before a response (indexing a message,
+purging a deleted account) is enqueued as a row in the jobs table, in
+the same transaction as the request's other writes, so a job exists
+exactly when the change that asked for it was committed. After
+committing, the view calls `wake_workers()`.
+
+Handlers are registered by kind with the `handler` decorator and get the
+job's payload (a JSON-able dict). A handler's writes are committed
+together with marking its job done, so a job whose worker dies half way
+is rolled back and runs again from the start. A handler that raises is
+retried after an exponential backoff (JOBS_BACKOFF seconds, doubling per
+attempt, with jitter, up to JOBS_BACKOFF_MAX) until it has run
+max_attempts times; then the job is marked failed, with its last error.
+
+Jobs go in one of LANES; workers always take the next due job of the
+highest priority lane first. An idempotency key makes enqueueing the
+same work twice a no-op, for as long as the job row is kept (see
+`prune`).
+
+Who runs jobs:
+
+- by default, JOBS_THREADS threads in each web worker, woken up as jobs
+  are enqueued, and polling every JOBS_POLL_INTERVAL seconds for retries
+  and jobs enqueued elsewhere;
+- set JOBS_THREADS to 0 and run dedicated workers instead with
+
+      python jobs.py work --threads 4 --processes 2
+
+- with JOBS_EAGER (which defaults to TESTING), `wake_workers()` runs the
+  due jobs right away, in the request.
+
+Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any
+number of them can share the queue. A job left running for longer than
+JOBS_TIMEOUT (its worker crashed) is put back in the queue, or marked
+failed if that was its last attempt.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Job
+
+LANES = ('high', 'default', 'low')
+
+HANDLERS = {}
+
+logger = logging.getLogger(__name__)
+
+
+def handler(kind, max_attempts=5):
+    """Register the decorated function as the handler of jobs of `kind`,
+    tried up to `max_attempts` times.
+
+    The handler is called with the job's payload. It shouldn't commit; its
+    changes are committed along with the job being marked done.
+    """
+
+    def register(func):
+        HANDLERS[kind] = (func, max_attempts)
+        return func
+    return register
+
+
+def enqueue(kind, payload=None, key=None, lane='default', delay=0):
+    """Add a job of `kind` to the queue, to run `delay` seconds from now.
+
+    This only adds it to the session: commit, then call wake_workers().
+    If a job with the same `key` already exists, nothing is added.
+    """
+
+    _, max_attempts = HANDLERS[kind]
+
+    db.session.execute(
+        insert(Job)
+        .values(kind=kind, payload=payload or {}, key=key,
+                priority=LANES.index(lane), max_attempts=max_attempts,
+                run_at=datetime.utcnow() + timedelta(seconds=delay))
+        .on_conflict_do_nothing(index_elements=['key']))
+
+
+def backoff(attempts, config):
+    """Seconds to wait before retrying a job that failed `attempts` times."""
+
+    delay = min(config['JOBS_BACKOFF'] * 2 ** (attempts - 1),
+                config['JOBS_BACKOFF_MAX'])
+    return delay * random.uniform(0.5, 1)
+
+
+def claim():
+    """Take the next due job off the queue and mark it running; returns
+    its id, or None if there's nothing to do."""
+
+    now = datetime.utcnow()
+    job = (Job.query
+           .filter(Job.status == 'queued', Job.run_at <= now)
+           .order_by(Job.priority, Job.run_at, Job.id)
+           .with_for_update(skip_locked=True)
+           .first())
+
+    if job is None:
+        db.session.commit()
+        return None
+
+    job.status = 'running'
+    job.locked_at = now
+    job.attempts += 1
+    db.session.commit()
+
+    return job.id
+
+
+def run_job(job_id):
+    """Run a claimed job and record how it went."""
+
+    job = Job.query.get(job_id)
+    func, _ = HANDLERS[job.kind]
+    payload = job.payload
+
+    try:
+        func(payload)
+    except Exception:
+        db.session.rollback()
+        logger.exception('job %s (%s) failed', job_id, payload)
+
+        job = Job.query.get(job_id)
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=backoff(job.attempts, current_app.config))
+        job.locked_at = None
+        db.session.commit()
+        return False
+
+    job.status = 'done'
+    job.finished_at = datetime.utcnow()
+    job.locked_at = None
+    db.session.commit()
+    return True
+
+
+def run_next():
+    """Claim and run the next due job; returns False if there was none."""
+
+    job_id = claim()
+    if job_id is None:
+        return False
+    run_job(job_id)
+    return True
+
+
+def run_pending(limit=None):
+    """Run due jobs until there are none left (or `limit` have run);
+    returns how many ran."""
+
+    ran = 0
+    while (limit is None or ran < limit) and run_next():
+        ran += 1
+    return ran
+
+
+def requeue_stale(timeout):
+    """Put jobs that have been running for over `timeout` seconds back in
+    the queue, or mark them failed if that was their last attempt (a job
+    that takes its worker down with it every time would otherwise run
+    forever); returns how many there were."""
+
+    now = datetime.utcnow()
+    stale = Job.query.filter(Job.status == 'running',
+                             Job.locked_at < now - timedelta(seconds=timeout))
+
+    failed = (stale
+              .filter(Job.attempts >= Job.max_attempts)
+              .update(dict(status='failed', locked_at=None, finished_at=now,
+                           last_error=f"timed out after {timeout} seconds"),
+                      synchronize_session=False))
+    requeued = stale.update(dict(status='queued', locked_at=None),
+                            synchronize_session=False)
+    db.session.commit()
+    return failed + requeued
+
+
+def prune(older_than):
+    """Delete jobs that finished more than `older_than` seconds ago, which
+    frees their keys; returns how many there were."""
+
+    pruned = (Job.query
+              .filter(Job.status.in_(['done', 'failed']),
+                      Job.finished_at < datetime.utcnow() - timedelta(seconds=older_than))
+              .delete(synchronize_session=False))
+    db.session.commit()
+    return pruned
+
+
+##############################################################################
+# Workers
+
+
+class Worker:
+    """Runs jobs for `app` on `threads` threads of this process."""
+
+    def __init__(self, app, threads):
+        self.app = app
+        self.threads = threads
+        self.pid = os.getpid()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for n in range(self.threads):
+            thread = threading.Thread(target=self.run, name=f"jobs-{n}",
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+
+    def run(self):
+        config = self.app.config
+
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    if run_next():
+                        continue
+                    requeue_stale(config['JOBS_TIMEOUT'])
+                except Exception:
+                    # the database went away, most likely; wait for it
+                    db.session.rollback()
+                    logger.exception('jobs worker error')
+                finally:
+                    db.session.remove()
+
+                self._wake.wait(config['JOBS_POLL_INTERVAL'])
+                self._wake.clear()
+
+
+def wake_workers():
+    """Tell this process's workers there's work, starting them if need be;
+    call after committing enqueued jobs. With JOBS_EAGER, run the due
+    jobs now instead."""
+
+    app = current_app._get_current_object()
+
+    # looked up now rather than in init_jobs: tests turn TESTING on after
+    # the app is made
+    eager = app.config['JOBS_EAGER']
+    if app.testing if eager is None else eager:
+        run_pending()
+    elif app.config['JOBS_THREADS']:
+        start_worker(app).wake()
+
+
+def start_worker(app):
+    """This process's Worker for `app`, started if it isn't yet.
+
+    A forked worker process doesn't inherit its parent's threads, so it
+    gets a Worker of its own.
+    """
+
+    jobs = app.extensions['jobs']
+
+    with jobs['lock']:
+        worker = jobs['worker']
+        if worker is None or worker.pid != os.getpid():
+            worker = jobs['worker'] = Worker(app, app.config['JOBS_THREADS'])
+            worker.start()
+
+    return worker
+
+
+def init_jobs(app):
+    """Set up background jobs for `app`.
+
+    JOBS_THREADS is how many threads run jobs in each web worker (0 to
+    leave them to `python jobs.py work`), JOBS_POLL_INTERVAL how often
+    idle workers check for jobs, JOBS_TIMEOUT how long a job can run
+    before it's presumed lost, JOBS_BACKOFF and JOBS_BACKOFF_MAX the first
+    and longest retry delays in seconds, and JOBS_EAGER runs jobs in the
+    request that enqueued them (the default when TESTING).
+
+    You should call this in your Flask app.
+    """
+
+    app.config.setdefault('JOBS_THREADS', 2)
+    app.config.setdefault('JOBS_POLL_INTERVAL', 5)
+    app.config.setdefault('JOBS_TIMEOUT', 10 * 60)
+    app.config.setdefault('JOBS_BACKOFF', 10)
+    app.config.setdefault('JOBS_BACKOFF_MAX', 60 * 60)
+    app.config.setdefault('JOBS_EAGER', None)
+
+    app.extensions['jobs'] = dict(worker=None, lock=threading.Lock())
+
+
+def work(threads):
+    """Run jobs on `threads` threads until interrupted (one process of
+    `python jobs.py work`)."""
+
+    from app import create_app
+
+    app = create_app(dict(JOBS_THREADS=threads))
+    worker = Worker(app, threads)
+    worker.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run background jobs')
+    parser.add_argument('command', choices=['work', 'run', 'prune'])
+    parser.add_argument('--threads', type=int, default=4,
+                        help='threads per worker process')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='worker processes')
+    parser.add_argument('--days', type=int, default=7,
+                        help='prune jobs finished this many days ago')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'work':
+        if args.processes == 1:
+            work(args.threads)
+            return
+        # each process makes its own app, so no connections are shared
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=work, args=(args.threads,))
+                     for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        return
+
+    from app import app
+
+    with app.app_context():
+        if args.command == 'run':
+            count = run_pending()
+        else:
+            count = prune(args.days * 24 * 60 * 60)
+    print(f"done: {count} jobs", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    # handlers register themselves with the `jobs` module, which as a
+    # script this isn't
+    import jobs
+    jobs.main()
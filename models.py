@@ -8,6 +8,18 @@ from flask_sqlalchemy import SQLAlchemy
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# digits each message id takes up in a thread path (see Message.path)
+PATH_WIDTH = 10
+
+
+def path_segment(message_id):
+    return f"{message_id:0{PATH_WIDTH}d}"
+
+# a closed account's username and email until it's purged (see
+# User.deactivate); nobody can sign up with or change to either
+DELETED_USERNAME_PREFIX = '~'
+DELETED_EMAIL_DOMAIN = 'deleted.invalid'
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -42,10 +54,17 @@ class Likes(db.Model):
         db.ForeignKey('users.id', ondelete='cascade')
     )
 
+    # no foreign key to messages: it's partitioned, and its primary key
+    # includes the timestamp (see partitions.py), so deleting a message
+    # deletes its likes explicitly (see delete_message_rows)
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+        db.Index('ix_likes_message_id', 'message_id'),
     )
 
 
@@ -94,6 +113,31 @@ class User(db.Model):
         nullable=False,
     )
 
+    # bumped on every profile edit, so anything rendered from the profile
+    # (cached message fragments, for one) can tell it's out of date
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # how many of the user's notifications are unread, kept up to date as
+    # they're added and read (see notifications.py), so the navbar shows it
+    # without counting them
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # set when the account is deleted; the row itself goes once the
+    # purge_user job has run (see User.deactivate)
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -113,7 +157,9 @@ class User(db.Model):
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        primaryjoin="User.id == Likes.user_id",
+        secondaryjoin="foreign(Likes.message_id) == Message.id",
     )
 
     def __repr__(self):
@@ -150,6 +196,26 @@ class User(db.Model):
         db.session.add(user)
         return user
 
+    def deactivate(self):
+        """Close the account right away, ahead of the purge_user job that
+        deletes it and everything it posted: it can't log in any more, and
+        its username and email are free for someone else to sign up with.
+        """
+
+        self.username = f"{DELETED_USERNAME_PREFIX}{self.id}"
+        self.email = f"{self.id}@{DELETED_EMAIL_DOMAIN}"
+        self.password = ''
+        self.deleted_at = datetime.utcnow()
+
+    @staticmethod
+    def is_reserved(field, value):
+        """Is `value` kept for closed accounts as a `field` ('username' or
+        'email')?"""
+
+        if field == 'username':
+            return value.startswith(DELETED_USERNAME_PREFIX)
+        return value.lower().endswith(f"@{DELETED_EMAIL_DOMAIN}")
+
     @classmethod
     def authenticate(cls, username, password):
         """Find user with `username` and `password`.
@@ -161,7 +227,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -179,6 +245,7 @@ class Message(db.Model):
     id = db.Column(
         db.Integer,
         primary_key=True,
+        autoincrement=True,
     )
 
     text = db.Column(
@@ -186,10 +253,13 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # the table is partitioned by month of timestamp, and Postgres wants
+    # the partition key in the primary key
     timestamp = db.Column(
         db.DateTime,
+        primary_key=True,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -198,8 +268,428 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # the message this one replies to; no foreign key, like
+    # Likes.message_id
+    parent_id = db.Column(
+        db.Integer,
+    )
+
+    # the message at the top of a reply's thread
+    thread_id = db.Column(
+        db.Integer,
+    )
+
+    # a reply's ids from the top of its thread down to its own, each
+    # zero-padded (path_segment) and joined by dots, so a thread sorted by
+    # path lists every reply after its parent, depth first. Compared byte
+    # by byte, which the default collations don't do with punctuation.
+    path = db.Column(
+        db.Text(collation='C'),
+    )
+
     user = db.relationship('User', overlaps='messages')
 
+    __table_args__ = (
+        # profile pages and timelines read a user's messages newest first
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+        # a conversation is a range of paths in one thread (see threads.py);
+        # with the id alongside, a thread's replies are counted off the
+        # index alone
+        db.Index('ix_messages_thread_id_path', 'thread_id', 'path',
+                 postgresql_include=['id'],
+                 postgresql_where=db.text('thread_id IS NOT NULL')),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
+    # ids are unique on their own; only the table needs the timestamp in
+    # its key
+    __mapper_args__ = {'primary_key': [id]}
+
+    @property
+    def thread_root_id(self):
+        """The top of this message's thread: a message that isn't a reply
+        starts its own."""
+
+        return self.thread_id or self.id
+
+    @property
+    def thread_path(self):
+        return self.path or path_segment(self.id)
+
+    @property
+    def depth(self):
+        """How many replies down its thread this message is."""
+
+        return self.thread_path.count('.')
+
+    def reply_fields(self, reply_id):
+        """The thread columns of reply `reply_id` to this message."""
+
+        return dict(parent_id=self.id, thread_id=self.thread_root_id,
+                    path=f"{self.thread_path}.{path_segment(reply_id)}")
+
+
+class Repost(db.Model):
+    """A user putting a message on their followers' home timelines (see
+    reposts.py)."""
+
+    __tablename__ = 'reposts'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # no foreign key, like Likes.message_id
+    message_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+        # home timelines read the reposts of the users followed newest
+        # first, and then summarize each message's
+        db.Index('ix_reposts_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_reposts_message_id', 'message_id'),
+    )
+
+
+class NotificationEvent(db.Model):
+    """Something that happened to a user that they're told about: a new
+    follower or a like. Only ever added (see notifications.py)."""
+
+    __tablename__ = 'notification_events'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # who's told
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # who did it
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # 'follow' or 'like'
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # the message liked; no foreign key, like Likes.message_id
+    message_id = db.Column(
+        db.Integer,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_notification_events_user_id_id', 'user_id', 'id'),
+        # notify looks up an actor's earlier events
+        db.Index('ix_notification_events_user_id_actor_id', 'user_id',
+                 'actor_id', 'kind', 'message_id'),
+    )
+
+
+class Notification(db.Model):
+    """The events of one kind about one thing (a user's followers, likes
+    of one message) since the user last read their notifications, as one
+    entry in their inbox."""
+
+    __tablename__ = 'notifications'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # what events are grouped by: 'follow', or 'like:<message id>'
+    key = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+    )
+
+    # the last few users behind it, newest first, and how many in all
+    actor_ids = db.Column(
+        db.ARRAY(db.Integer),
+        nullable=False,
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    read_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        # events are added to the unread notification for their key, if
+        # there is one
+        db.Index('ix_notifications_unread_key', 'user_id', 'key', unique=True,
+                 postgresql_where=db.text('read_at IS NULL')),
+        # the inbox lists the most recently updated first
+        db.Index('ix_notifications_user_id_updated_at', 'user_id',
+                 'updated_at', 'id'),
+    )
+
+
+class MessageTag(db.Model):
+    """A #hashtag used in a message."""
+
+    __tablename__ = 'message_tags'
+
+    # no foreign key, like Likes.message_id
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # copied from the message, so a tag's timeline can be read newest
+    # first straight off the index
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_message_tags_tag_timestamp', 'tag', 'timestamp',
+                 'message_id'),
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a message."""
+
+    __tablename__ = 'mentions'
+
+    # no foreign key, like Likes.message_id
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # copied from the message, like MessageTag.timestamp
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_mentions_user_id_timestamp', 'user_id', 'timestamp',
+                 'message_id'),
+    )
+
+
+class MessageArchive(db.Model):
+    """A month of messages moved out of the database into a file."""
+
+    __tablename__ = 'message_archives'
+
+    # the shard the partition was on (see shards.py)
+    shard = db.Column(
+        db.Integer,
+        primary_key=True,
+        default=0,
+    )
+
+    partition = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    path = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    rows = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # lets a lookup by message id skip archives that can't hold it
+    min_id = db.Column(
+        db.Integer,
+    )
+
+    max_id = db.Column(
+        db.Integer,
+    )
+
+    archived_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class Job(db.Model):
+    """A piece of deferred work, waiting to run or done (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    # index into jobs.LANES; lower runs first
+    priority = db.Column(
+        db.SmallInteger,
+        nullable=False,
+        default=1,
+    )
+
+    # queued, running, done or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    # a job enqueued with the key of an existing one isn't added again
+    key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        # workers take the next due job of the highest priority lane
+        db.Index('ix_jobs_queued', 'priority', 'run_at', 'id',
+                 postgresql_where=db.text("status = 'queued'")),
+    )
+
+
+class UserShard(db.Model):
+    """Which shard holds a user's messages (see shards.py). Users without
+    a row are on the main database."""
+
+    __tablename__ = 'user_shards'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.SmallInteger,
+        nullable=False,
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -207,7 +697,10 @@ def connect_db(app):
     You should call this in your Flask app.
     """
 
-    db.app = app
+    # the first app connected is the one used outside an app context
+    # (scripts, and the tests' module-level db.drop_all())
+    if db.app is None:
+        db.app = app
     db.init_app(app)
     # db.drop_all()
     # db.create_all()
\ No newline at end of file
@@ -0,0 +1,233 @@
+"""Notifications: new followers and likes.
+
+Everything a user is told about is added to notification_events as it
+happens, and never changed after. Each event is also added to the user's
+unread notification for the same thing (their followers, or the likes of
+one message), in the same upsert that would create it, so the inbox reads
+"A and 12 others liked your warble" off one row, with the newest few
+actors and how many there were in all. Once the inbox has been read, the
+next event starts a new notification.
+
+users.unread_notifications counts the unread notifications. It goes up
+by one when an upsert creates one and down by however many reading the
+inbox marks read, each in the same transaction as the change it counts,
+so the navbar shows it from the logged in user's row, which is loaded
+anyway, and nothing ever counts notifications to draw a page. If it's
+ever off, `python notifications.py recount` sets it from the table.
+"""
+
+import argparse
+from datetime import datetime
+
+from flask import Blueprint, abort, flash, g, redirect, render_template, request
+from sqlalchemy import func, literal_column, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+
+from api import ApiError, decode_cursor, encode_cursor
+from caching import user_cards
+from models import db, User, Notification, NotificationEvent
+from shards import message_rows
+
+notifications = Blueprint('notifications', __name__,
+                          url_prefix='/notifications')
+
+PAGE_SIZE = 50
+# actors named on a notification; the rest are counted
+SHOWN_ACTORS = 3
+
+
+def notification_key(kind, message_id=None):
+    """What events are grouped by: all of a user's new followers are one
+    notification, the likes of each message another."""
+
+    return kind if message_id is None else f"{kind}:{message_id}"
+
+
+def notify(user_id, actor_id, kind, message_id=None):
+    """Tell user `user_id` that `actor_id` followed them or liked their
+    message `message_id`. Call this in the transaction adding the new
+    Follows or Likes row, and only if it was new; nobody's told about what
+    they do themselves."""
+
+    if user_id == actor_id:
+        return
+
+    key = notification_key(kind, message_id)
+    table = Notification.__table__
+
+    # an actor with an earlier event on the unread notification (liking
+    # again after unliking, say) isn't counted twice, however many others
+    # came since
+    repeat = db.session.execute(
+        select(NotificationEvent.id)
+        .join(Notification, Notification.user_id == NotificationEvent.user_id)
+        .where(NotificationEvent.user_id == user_id,
+               NotificationEvent.actor_id == actor_id,
+               NotificationEvent.kind == kind,
+               NotificationEvent.message_id.is_not_distinct_from(message_id),
+               Notification.key == key,
+               Notification.read_at.is_(None),
+               NotificationEvent.created_at >= Notification.created_at)
+        .limit(1)).first() is not None
+
+    now = datetime.utcnow()
+    db.session.add(NotificationEvent(user_id=user_id, actor_id=actor_id,
+                                     kind=kind, message_id=message_id,
+                                     created_at=now))
+
+    statement = insert(table).values(
+        user_id=user_id, key=key, kind=kind,
+        message_id=message_id, actor_ids=[actor_id], actor_count=1,
+        created_at=now, updated_at=now)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.key],
+        index_where=table.c.read_at.is_(None),
+        set_=dict(
+            actor_count=table.c.actor_count + (0 if repeat else 1),
+            actor_ids=func.array_prepend(
+                actor_id, func.array_remove(table.c.actor_ids, actor_id),
+                type_=table.c.actor_ids.type)[1:SHOWN_ACTORS],
+            updated_at=statement.excluded.updated_at,
+        ),
+    ).returning(literal_column('xmax = 0'))
+
+    created = db.session.execute(statement).scalar()
+    if created:
+        db.session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(unread_notifications=User.unread_notifications + 1)
+            .execution_options(synchronize_session=False))
+
+
+def mark_read(user):
+    """Mark all of `user`'s notifications read."""
+
+    marked = db.session.execute(
+        update(Notification)
+        .where(Notification.user_id == user.id,
+               Notification.read_at.is_(None))
+        .values(read_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)).rowcount
+    if not marked:
+        return
+
+    # the notifications are locked first here as in notify, so the two
+    # can't deadlock
+    db.session.execute(
+        update(User)
+        .where(User.id == user.id)
+        .values(unread_notifications=func.greatest(
+            User.unread_notifications - marked, 0))
+        .execution_options(synchronize_session=False))
+
+
+def recount_unread():
+    """Set every user's unread_notifications from their notifications."""
+
+    counts = (select(Notification.user_id, func.count().label('unread'))
+              .where(Notification.read_at.is_(None))
+              .group_by(Notification.user_id)
+              .subquery())
+    db.session.execute(
+        update(User)
+        .values(unread_notifications=func.coalesce(
+            select(counts.c.unread)
+            .where(counts.c.user_id == User.id)
+            .scalar_subquery(), 0))
+        .execution_options(synchronize_session=False))
+
+
+class InboxEntry:
+    """A notification as the inbox shows it: the first few actors as
+    UserCards, how many others there were, and the message liked (a
+    MessageRow, None if it's gone)."""
+
+    __slots__ = ('id', 'kind', 'actors', 'others', 'message', 'updated_at',
+                 'unread')
+
+    def __init__(self, row, cards, messages):
+        self.id = row.id
+        self.kind = row.kind
+        self.actors = [cards[actor_id] for actor_id in row.actor_ids
+                       if actor_id in cards]
+        self.others = row.actor_count - len(self.actors)
+        self.message = messages.get(row.message_id)
+        self.updated_at = row.updated_at
+        self.unread = row.read_at is None
+
+
+def inbox(user, cursor=None, limit=PAGE_SIZE):
+    """A page of `user`'s InboxEntries, most recently updated first, after
+    `cursor` (the next_cursor of the previous page). Returns (entries,
+    next_cursor)."""
+
+    query = (select(Notification.id, Notification.kind,
+                    Notification.message_id, Notification.actor_ids,
+                    Notification.actor_count, Notification.updated_at,
+                    Notification.read_at)
+             .where(Notification.user_id == user.id))
+
+    if cursor:
+        try:
+            before = decode_cursor(cursor, [datetime, int])
+        except ApiError:
+            abort(400)
+        query = query.where(tuple_(Notification.updated_at, Notification.id)
+                            < tuple_(*before))
+
+    rows = db.session.execute(
+        query
+        .order_by(Notification.updated_at.desc(), Notification.id.desc())
+        .limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1].updated_at, rows[-1].id])
+
+    cards = user_cards(actor_id for row in rows for actor_id in row.actor_ids)
+    messages = message_rows({row.message_id for row in rows
+                             if row.message_id is not None})
+    return [InboxEntry(row, cards, messages) for row in rows], next_cursor
+
+
+@notifications.route('')
+def show_inbox():
+    """Show the logged in user's notifications, and mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    entries, next_cursor = inbox(g.user, request.args.get('cursor'))
+    mark_read(g.user)
+    db.session.commit()
+
+    return render_template('users/notifications.html', entries=entries,
+                           next_cursor=next_cursor)
+
+
+def init_notifications(app):
+    """Set up /notifications for `app`.
+
+    You should call this in your Flask app.
+    """
+
+    app.register_blueprint(notifications)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain notifications')
+    parser.add_argument('command', choices=['recount'])
+    parser.parse_args(argv)
+
+    from app import app  # noqa: F401 (connects the database)
+
+    recount_unread()
+    db.session.commit()
+    print("done")
+
+
+if __name__ == '__main__':
+    main()
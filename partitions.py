@@ -0,0 +1,344 @@
+"""Monthly partitions of the messages table, and archiving old ones.
+
+`messages` is partitioned by RANGE (timestamp), one partition per
+calendar month named messages_<year>_<month>, plus messages_default for
+rows no month partition covers yet. A query filtered on timestamp (see
+functions.recent_messages) only reads the partitions in range.
+
+Creating the table creates the default partition and month partitions
+up to PARTITIONS_AHEAD months from now. Run
+
+    python partitions.py ensure
+
+from cron to keep creating months ahead, and
+
+    python partitions.py split
+
+to move any rows that landed in the default partition (old imports,
+seeded data) into month partitions of their own.
+
+    python partitions.py archive --older-than 12
+
+exports each month partition older than 12 months to a gzipped JSON
+lines file under ARCHIVE_DIR, records it in message_archives, then
+detaches and drops it. All three commands work on every shard (see
+shards.py); the archives of all of them are recorded in the main
+database. Archived messages no longer show up on any
+timeline, but /messages/<id> still finds them by scanning the archive
+file whose id range covers them (see find_archived_message). Their
+likes, tags and mentions are left in place.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+from datetime import date, datetime
+
+from sqlalchemy import event, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, User, Message, MessageArchive
+
+DEFAULT_PARTITION = 'messages_default'
+PARTITIONS_AHEAD = 2
+
+PARTITION_RE = re.compile(r'^messages_(\d{4})_(\d{2})$')
+
+
+def month_start(value):
+    """The first day of the month of `value` (a date or datetime)."""
+
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, n):
+    """The first day of the month `n` months after `month`."""
+
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"messages_{month.year:04d}_{month.month:02d}"
+
+
+def partition_months(connection):
+    """The months that have a partition, oldest first."""
+
+    names = connection.execute(text(
+        """SELECT c.relname FROM pg_inherits i
+           JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = 'messages'::regclass""")).scalars()
+
+    return sorted(date(int(match.group(1)), int(match.group(2)), 1)
+                  for match in map(PARTITION_RE.match, names) if match)
+
+
+def create_partition(connection, month):
+    """Create the partition for `month`, moving its rows out of the default
+    partition.
+
+    Postgres won't create a partition over rows that are sitting in the
+    default partition, so the new table is filled and attached in the
+    caller's transaction instead.
+    """
+
+    name = partition_name(month)
+    start, end = month, add_months(month, 1)
+
+    connection.execute(text(
+        f"CREATE TABLE {name} (LIKE messages INCLUDING DEFAULTS)"))
+    connection.execute(text(
+        f"""WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION}
+                WHERE timestamp >= :start AND timestamp < :end
+                RETURNING *)
+            INSERT INTO {name} SELECT * FROM moved"""),
+        dict(start=start, end=end))
+    connection.execute(text(
+        f"""ALTER TABLE messages ATTACH PARTITION {name}
+            FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"""))
+
+
+def ensure_partitions(connection, first, last):
+    """Make sure every month from `first` to `last` (dates or datetimes)
+    has a partition; returns the months created."""
+
+    existing = set(partition_months(connection))
+    created = []
+
+    month, last = month_start(first), month_start(last)
+    while month <= last:
+        if month not in existing:
+            create_partition(connection, month)
+            created.append(month)
+        month = add_months(month, 1)
+
+    return created
+
+
+def split_default(connection):
+    """Give every month with rows in the default partition a partition of
+    its own; returns the months created."""
+
+    months = connection.execute(text(
+        f"""SELECT DISTINCT date_trunc('month', timestamp)
+            FROM {DEFAULT_PARTITION}""")).scalars()
+
+    created = []
+    for month in sorted(months):
+        created.extend(ensure_partitions(connection, month, month))
+    return created
+
+
+@event.listens_for(Message.__table__, 'after_create')
+def create_initial_partitions(target, connection, **kw):
+    connection.execute(text(
+        f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF messages DEFAULT"))
+
+    this_month = month_start(datetime.utcnow())
+    ensure_partitions(connection, this_month,
+                      add_months(this_month, PARTITIONS_AHEAD))
+
+
+##############################################################################
+# Archiving
+
+
+def export_partition(connection, name, path):
+    """Write every row of partition `name` to `path` as gzipped JSON lines,
+    in id order. Returns (rows, min_id, max_id)."""
+
+    rows, min_id, max_id = 0, None, None
+    result = (connection
+              .execution_options(stream_results=True)
+              .execute(text(f"SELECT id, text, timestamp, user_id, parent_id,"
+                            f" thread_id, path FROM {name} ORDER BY id")))
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(tmp, 'wt', encoding='UTF-8') as out:
+        for row in result:
+            out.write(json.dumps(dict(id=row.id, text=row.text,
+                                      timestamp=row.timestamp.isoformat(),
+                                      user_id=row.user_id,
+                                      parent_id=row.parent_id,
+                                      thread_id=row.thread_id,
+                                      path=row.path)))
+            out.write('\n')
+            rows += 1
+            min_id = row.id if min_id is None else min_id
+            max_id = row.id
+    os.replace(tmp, path)
+
+    return rows, min_id, max_id
+
+
+def drop_partition(connection, name):
+    connection.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+    connection.execute(text(f"DROP TABLE {name}"))
+
+
+def archive_name(shard, name):
+    """What partition `name` of `shard` is archived as: its own name on the
+    main database, prefixed with the shard on the others."""
+
+    return name if shard == 0 else f"shard{shard}_{name}"
+
+
+def archive_partitions(older_than, directory, now=None):
+    """Archive every month partition, on every shard, that ended more than
+    `older_than` months before `now`, into `directory`. Returns the
+    archived partitions' archive_names.
+
+    Each partition is exported before anything is changed, then recorded,
+    detached and dropped, so a failed run leaves it where it was and can
+    just be run again. On the main database that's one transaction; the
+    other shards' partitions are recorded (in the main database) before
+    they're dropped, so a message is never in neither place.
+    """
+
+    # shards imports this module
+    from shards import shard_count, shard_engine
+
+    cutoff = add_months(month_start(now or datetime.utcnow()), -older_than)
+    os.makedirs(directory, exist_ok=True)
+
+    archived = []
+    for shard in range(shard_count()):
+        engine = shard_engine(shard)
+
+        with engine.begin() as connection:
+            split_default(connection)
+            months = [month for month in partition_months(connection)
+                      if add_months(month, 1) <= cutoff]
+
+        for month in months:
+            name = partition_name(month)
+            path = os.path.abspath(os.path.join(
+                directory, f"{archive_name(shard, name)}.jsonl.gz"))
+
+            with engine.connect() as connection:
+                rows, min_id, max_id = export_partition(connection, name, path)
+
+            record = insert(MessageArchive.__table__).values(
+                shard=shard, partition=name, path=path, rows=rows,
+                min_id=min_id, max_id=max_id, archived_at=datetime.utcnow())
+            record = record.on_conflict_do_update(
+                index_elements=['shard', 'partition'],
+                set_={column: record.excluded[column] for column
+                      in ('path', 'rows', 'min_id', 'max_id', 'archived_at')})
+
+            if shard == 0:
+                with engine.begin() as connection:
+                    connection.execute(record)
+                    drop_partition(connection, name)
+            else:
+                with db.engine.begin() as main:
+                    main.execute(record)
+                with engine.begin() as connection:
+                    drop_partition(connection, name)
+
+            archived.append(archive_name(shard, name))
+
+    return archived
+
+
+def find_archived_message(message_id):
+    """An archived message, or None.
+
+    This reads through the archive files, from any shard, whose id range
+    covers `message_id`, so it's slow, and only meant for the odd link to an old
+    message. The message is returned detached from the session, with its
+    author and its place in its thread, so it renders like any other
+    (replies that are still live included) but is never saved.
+    """
+
+    archives = (MessageArchive.query
+                .filter(MessageArchive.min_id <= message_id,
+                        MessageArchive.max_id >= message_id)
+                .all())
+
+    for archive in archives:
+        with gzip.open(archive.path, 'rt', encoding='UTF-8') as lines:
+            for line in lines:
+                row = json.loads(line)
+                if row['id'] < message_id:
+                    continue
+                if row['id'] > message_id:
+                    break
+
+                user = User.query.get(row['user_id'])
+                if user is None:
+                    return None
+
+                # archives from before threads have no thread columns
+                msg = Message(id=row['id'], text=row['text'],
+                              timestamp=datetime.fromisoformat(row['timestamp']),
+                              user_id=row['user_id'],
+                              parent_id=row.get('parent_id'),
+                              thread_id=row.get('thread_id'),
+                              path=row.get('path'))
+                # not msg.user = user: the backref would add msg to the
+                # session, and the next flush would insert it
+                set_committed_value(msg, 'user', user)
+                return msg
+
+    return None
+
+
+def init_partitions(app):
+    """Set up message archiving for `app`.
+
+    ARCHIVE_DIR is where `python partitions.py archive` writes archived
+    partitions.
+
+    You should call this in your Flask app.
+    """
+
+    app.config.setdefault('ARCHIVE_DIR', os.path.join(app.root_path, 'archive'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage message partitions')
+    parser.add_argument('command', choices=['ensure', 'split', 'archive'])
+    parser.add_argument('--ahead', type=int, default=PARTITIONS_AHEAD,
+                        help='months ahead to create partitions for')
+    parser.add_argument('--older-than', type=int, default=12,
+                        help='archive partitions older than this many months')
+    parser.add_argument('--dir', help='where to write archives '
+                                      '(default: ARCHIVE_DIR)')
+    args = parser.parse_args(argv)
+
+    from app import app
+    # shards imports this module
+    from shards import shard_count, shard_engine
+
+    with app.app_context():
+        if args.command == 'archive':
+            names = archive_partitions(args.older_than,
+                                       args.dir or app.config['ARCHIVE_DIR'])
+        else:
+            names = []
+            for shard in range(shard_count()):
+                with shard_engine(shard).begin() as connection:
+                    if args.command == 'ensure':
+                        this_month = month_start(datetime.utcnow())
+                        created = ensure_partitions(
+                            connection, this_month,
+                            add_months(this_month, args.ahead))
+                    else:
+                        created = split_default(connection)
+                names.extend(archive_name(shard, partition_name(month))
+                             for month in created)
+
+    for name in names:
+        print(name, file=sys.stderr)
+    print(f"done: {len(names)} partitions")
+
+
+if __name__ == '__main__':
+    main()
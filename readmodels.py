@@ -0,0 +1,208 @@
+"""Read models for list pages.
+
+Timelines, profiles and user listings show a few columns of each message
+or user and never change them. Loading them as Message and User
+instances still builds each one's instance state, puts it in the
+session's identity map and tracks it for changes, for objects that are
+thrown away once the page is rendered.
+
+The classes here hold only the columns a list page shows, in
+`__slots__` (so no per-instance __dict__ either), and are filled from
+Core queries that select only those columns. They're read-only
+snapshots: views that change anything load the ORM models as before.
+
+`python bench.py --only "list pages orm" "list pages read models"`
+compares the two, in render time and peak memory per page.
+"""
+
+from flask import g
+from sqlalchemy import func, select
+
+from functions import recent_messages
+from models import db, User, Message, Follows, Likes
+
+
+class ReadModel:
+    """Base for read models.
+
+    A subclass lists the columns it reads in `columns`, and names an
+    attribute for each, in the same order, in `__slots__`.
+    """
+
+    __slots__ = ()
+    columns = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} #{self.id}>"
+
+    @classmethod
+    def select(cls):
+        return select(*cls.columns)
+
+    @classmethod
+    def all(cls, statement):
+        """Run `statement` (from cls.select()) and wrap every row."""
+
+        return [cls(*row) for row in db.session.execute(statement)]
+
+
+class MessageRow(ReadModel):
+    """A message in a list of messages."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id')
+    columns = (Message.id, Message.text, Message.timestamp, Message.user_id)
+
+
+class UserRow(ReadModel):
+    """A user in a list of users."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+    columns = (User.id, User.username, User.image_url, User.header_image_url,
+               User.bio)
+
+
+def _count(column, *criteria):
+    return select(func.count(column)).where(*criteria).scalar_subquery()
+
+
+class Profile(ReadModel):
+    """A user's profile header: who they are and how many messages,
+    follows, followers and likes they have."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+                 'location', 'message_count', 'following_count',
+                 'follower_count', 'like_count')
+    columns = (User.id, User.username, User.image_url, User.header_image_url,
+               User.bio, User.location,
+               _count(Message.id, Message.user_id == User.id),
+               _count(Follows.user_being_followed_id,
+                      Follows.user_following_id == User.id),
+               _count(Follows.user_following_id,
+                      Follows.user_being_followed_id == User.id),
+               _count(Likes.id, Likes.user_id == User.id))
+
+
+def user_profile(user_id):
+    """`user_id`'s Profile, or None if there's no such user (or their
+    account has been deleted)."""
+
+    found = Profile.all(Profile.select().where(User.id == user_id,
+                                               User.deleted_at.is_(None)))
+    return found[0] if found else None
+
+
+def recent_message_rows(criterion, limit, session=None):
+    """Like functions.recent_messages, as MessageRows."""
+
+    return [MessageRow(*row) for row in
+            recent_messages(criterion, limit, MessageRow.columns, session)]
+
+
+def stream_message_rows(criterion, chunk_size, limit=None, session=None):
+    """The `limit` (default: all) newest MessageRows matching `criterion`,
+    fetched from a server-side cursor `chunk_size` rows at a time.
+    `session` defaults to db.session.
+
+    Nothing is read until the result is iterated.
+    """
+
+    statement = (MessageRow.select()
+                 .where(criterion)
+                 .order_by(Message.timestamp.desc())
+                 .limit(limit)
+                 .execution_options(stream_results=True,
+                                    max_row_buffer=chunk_size))
+
+    for row in (session or db.session).execute(statement):
+        yield MessageRow(*row)
+
+
+def liked_message_rows(user_id):
+    """The messages `user_id` likes, newest first."""
+
+    return MessageRow.all(MessageRow.select()
+                          .join(Likes, Likes.message_id == Message.id)
+                          .where(Likes.user_id == user_id)
+                          .order_by(Message.timestamp.desc()))
+
+
+def following_rows(user_id):
+    """The users `user_id` follows."""
+
+    return UserRow.all(UserRow.select()
+                       .join(Follows, Follows.user_being_followed_id == User.id)
+                       .where(Follows.user_following_id == user_id,
+                              User.deleted_at.is_(None))
+                       .order_by(User.id))
+
+
+def follower_rows(user_id):
+    """The users following `user_id`."""
+
+    return UserRow.all(UserRow.select()
+                       .join(Follows, Follows.user_following_id == User.id)
+                       .where(Follows.user_being_followed_id == user_id,
+                              User.deleted_at.is_(None))
+                       .order_by(User.id))
+
+
+def user_rows(search=None):
+    """Every user, or those whose username contains `search`."""
+
+    statement = (UserRow.select()
+                 .where(User.deleted_at.is_(None))
+                 .order_by(User.id))
+    if search:
+        statement = statement.where(User.username.like(f"%{search}%"))
+    return UserRow.all(statement)
+
+
+##############################################################################
+# The viewer
+#
+# List pages mark which messages the logged in user likes and which users
+# they follow. These sets of ids are read once per request, rather than
+# loading g.user.likes and g.user.following in full.
+
+
+def liked_message_ids():
+    """Ids of the messages the logged in user likes (empty if logged out)."""
+
+    if 'liked_message_ids' not in g:
+        g.liked_message_ids = set(db.session.execute(
+            select(Likes.message_id).where(Likes.user_id == g.user.id)
+        ).scalars()) if g.user else set()
+    return g.liked_message_ids
+
+
+def followed_user_ids():
+    """Ids of the users the logged in user follows (empty if logged out)."""
+
+    if 'followed_user_ids' not in g:
+        g.followed_user_ids = set(db.session.execute(
+            select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == g.user.id)
+        ).scalars()) if g.user else set()
+    return g.followed_user_ids
+
+
+def init_readmodels(app):
+    """Make the viewer's liked and followed ids available to `app`'s
+    templates.
+
+    You should call this in your Flask app.
+    """
+
+    app.jinja_env.globals['liked_message_ids'] = liked_message_ids
+    app.jinja_env.globals['followed_user_ids'] = followed_user_ids
+
+    # g outlives the request when it runs in an app context pushed
+    # beforehand (as in tests); the next request mustn't see these
+    @app.teardown_request
+    def forget_viewer_ids(exc):
+        g.pop('liked_message_ids', None)
+        g.pop('followed_user_ids', None)
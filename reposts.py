@@ -0,0 +1,233 @@
+"""Reposts ("rewarbles"), and the home timeline they show up on.
+
+A repost puts a message on the reposter's followers' home timelines. The
+home timeline is two streams, both newest first: the messages posted by
+the users followed, and their reposts. Each is read a batch at a time
+off its index, and the two are merged by time as they're read.
+
+A message is shown once, where it last appeared: at the newest repost of
+it by someone followed, or if there's none, where it was posted. Several
+followed users reposting it make one entry, "reposted by A, B and 3
+others". Which appearance is the newest, how many followed users
+reposted it and who the first of them were all come from one grouped
+query per batch, over the reposts of that batch's messages. So however
+many times a message was reposted, its reposts are counted in the
+database and never loaded.
+
+Pages are keyset paginated on the (time, kind, id) of the appearance an
+entry is shown at, which never changes. Posting or reposting while
+someone reads their timeline only adds entries above the page they're
+on. A message reposted again after it was shown moves up to the top,
+and its older appearance is skipped further down, so paging on never
+shows it twice or skips anything else.
+"""
+
+import heapq
+from datetime import datetime
+from itertools import islice
+
+from flask import abort, g
+from sqlalchemy import func, select, true, tuple_
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg
+
+from api import ApiError, decode_cursor, encode_cursor
+from caching import user_cards
+from models import db, Message, Repost
+from readmodels import MessageRow
+from shards import each_shard, message_rows
+
+PAGE_SIZE = 100
+BATCH_SIZE = 50
+# reposters named on an entry; the rest are counted
+SHOWN_REPOSTERS = 2
+
+# at the same moment, a post sorts above a repost
+REPOST, POST = 0, 1
+
+
+class TimelineEntry(MessageRow):
+    """A message on a home timeline, with the followed users who reposted
+    it: the first few as UserCards in `reposters`, and how many in all in
+    `repost_count`."""
+
+    __slots__ = ('reposters', 'repost_count')
+
+    def __init__(self, message, reposters=(), repost_count=0):
+        for name in MessageRow.__slots__:
+            setattr(self, name, getattr(message, name))
+        self.reposters = reposters
+        self.repost_count = repost_count
+
+
+def before(time_column, id_column, kind, cursor):
+    """Criterion for the rows of `kind` whose (time, kind, id) comes after
+    `cursor`'s, newest first."""
+
+    if cursor is None:
+        return true()
+
+    time, cursor_kind, cursor_id = cursor
+    if kind == cursor_kind:
+        return tuple_(time_column, id_column) < tuple_(time, cursor_id)
+    if kind < cursor_kind:
+        return time_column <= time
+    return time_column < time
+
+
+def posts(user_ids, cursor, limit):
+    """The next `limit` (key, MessageRow)s posted by `user_ids`, from every
+    shard."""
+
+    rows = each_shard(MessageRow.select()
+                      .where(Message.user_id.in_(user_ids),
+                             before(Message.timestamp, Message.id, POST, cursor))
+                      .order_by(Message.timestamp.desc(), Message.id.desc())
+                      .limit(limit))
+
+    keyed = [((row.timestamp, POST, row.id), MessageRow(*row)) for row in rows]
+    keyed.sort(reverse=True, key=lambda item: item[0])
+    return keyed[:limit]
+
+
+def reposts(user_ids, cursor, limit):
+    """The next `limit` (key, Repost row)s by `user_ids`."""
+
+    rows = db.session.execute(
+        select(Repost.id, Repost.timestamp, Repost.message_id)
+        .where(Repost.user_id.in_(user_ids),
+               before(Repost.timestamp, Repost.id, REPOST, cursor))
+        .order_by(Repost.timestamp.desc(), Repost.id.desc())
+        .limit(limit))
+
+    return [((row.timestamp, REPOST, row.id), row) for row in rows]
+
+
+def stream(fetch, user_ids, cursor, batch_size):
+    """Everything `fetch` finds after `cursor`, newest first, read
+    `batch_size` at a time."""
+
+    while True:
+        batch = fetch(user_ids, cursor, batch_size)
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        cursor = batch[-1][0]
+
+
+def repost_summaries(message_ids, user_ids):
+    """{message id: (newest repost key, count, first reposter ids)} for
+    the reposts of `message_ids` by `user_ids`."""
+
+    newest_first = (Repost.timestamp.desc(), Repost.id.desc())
+    reposter_ids = array_agg(aggregate_order_by(Repost.user_id, *newest_first))
+    repost_ids = array_agg(aggregate_order_by(Repost.id, *newest_first))
+
+    rows = db.session.execute(
+        select(Repost.message_id, func.max(Repost.timestamp), repost_ids[1],
+               func.count(), reposter_ids[1:SHOWN_REPOSTERS])
+        .where(Repost.message_id.in_(message_ids),
+               Repost.user_id.in_(user_ids))
+        .group_by(Repost.message_id))
+
+    return {message_id: ((timestamp, REPOST, repost_id), count, first)
+            for message_id, timestamp, repost_id, count, first in rows}
+
+
+class HomeTimeline:
+    """A page of the home timeline of a user following `user_ids`, after
+    `cursor` (the (time, kind, id) key next_cursor encodes).
+
+    Iterating it reads the page, lazily, as TimelineEntries; once it's
+    been read `next_cursor` is set, unless it was the last page.
+    """
+
+    def __init__(self, user_ids, cursor=None, limit=PAGE_SIZE,
+                 batch_size=BATCH_SIZE):
+        self.user_ids = list(user_ids)
+        self.cursor = cursor
+        self.limit = limit
+        self.batch_size = batch_size
+        self.next_cursor = None
+
+    def entries(self, batch):
+        """The TimelineEntries for the (key, row)s in `batch` that are
+        their message's newest appearance."""
+
+        message_ids = {row.id if key[1] == POST else row.message_id
+                       for key, row in batch}
+        summaries = repost_summaries(message_ids, self.user_ids)
+
+        bodies = {row.id: row for key, row in batch if key[1] == POST}
+        bodies.update(message_rows(message_ids.difference(bodies)))
+
+        cards = user_cards(user_id for _, _, first in summaries.values()
+                           for user_id in first)
+
+        for key, row in batch:
+            message_id = row.id if key[1] == POST else row.message_id
+            newest, count, first = summaries.get(message_id, (key, 0, ()))
+            message = bodies.get(message_id)
+            # the message may have been deleted since it was reposted
+            if key != newest or message is None:
+                continue
+            yield key, TimelineEntry(
+                message, [cards[user_id] for user_id in first if user_id in cards],
+                count)
+
+    def __iter__(self):
+        if not self.user_ids:
+            return
+
+        merged = heapq.merge(
+            stream(posts, self.user_ids, self.cursor, self.batch_size),
+            stream(reposts, self.user_ids, self.cursor, self.batch_size),
+            reverse=True, key=lambda item: item[0])
+
+        shown = 0
+        while True:
+            batch = list(islice(merged, self.batch_size))
+            if not batch:
+                return
+            for key, entry in self.entries(batch):
+                yield entry
+                shown += 1
+                if shown == self.limit:
+                    self.next_cursor = encode_cursor(list(key))
+                    return
+
+
+def home_timeline(user_ids, cursor=None, limit=PAGE_SIZE,
+                  batch_size=BATCH_SIZE):
+    """The HomeTimeline page of `user_ids` after `cursor` (a next_cursor
+    string, or None for the first page)."""
+
+    if cursor:
+        try:
+            cursor = tuple(decode_cursor(cursor, [datetime, int, int]))
+        except ApiError:
+            abort(400)
+    return HomeTimeline(user_ids, cursor or None, limit, batch_size)
+
+
+def reposted_message_ids():
+    """Ids of the messages the logged in user reposted (empty if logged
+    out); like readmodels.liked_message_ids."""
+
+    if 'reposted_message_ids' not in g:
+        g.reposted_message_ids = set(db.session.execute(
+            select(Repost.message_id).where(Repost.user_id == g.user.id)
+        ).scalars()) if g.user else set()
+    return g.reposted_message_ids
+
+
+def init_reposts(app):
+    """Make the viewer's reposted ids available to `app`'s templates.
+
+    You should call this in your Flask app.
+    """
+
+    app.jinja_env.globals['reposted_message_ids'] = reposted_message_ids
+
+    @app.teardown_request
+    def forget_reposted_ids(exc):
+        g.pop('reposted_message_ids', None)
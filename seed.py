@@ -1,8 +1,9 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
+from app import app, db  # noqa: F401 (app connects the database)
 from models import User, Message, Follows
+from partitions import split_default
 
 
 db.drop_all()
@@ -17,4 +18,8 @@ with open('generator/messages.csv') as messages:
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+# the sample messages are old, so they all start out in the default
+# partition
+split_default(db.session.connection())
+
 db.session.commit()
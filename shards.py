@@ -0,0 +1,664 @@
+"""Sharding messages across databases by their author.
+
+The main database (SQLALCHEMY_DATABASE_URI) is shard 0, and every URL
+in SHARD_URLS adds a shard after it. All of a user's messages live on
+one shard. Everything else stays in the main database: the users table
+(logins, and unique usernames and emails), follows, likes, jobs, and the
+user_shards directory, which says where each user's messages are. Users
+without a directory row are on shard 0. So a single database, the
+default, is the plain unsharded app.
+
+New users are placed on shard `id % number of shards` at signup, and
+stay there until moved. Each shard has its own users table. The rows in
+it only anchor the foreign keys of that shard's messages, so they are
+placeholders: an id and made-up values, and never anyone's real details.
+
+Routed by author:
+
+- users_show reads the profile's messages from the user's shard;
+- messages_add writes to the poster's shard;
+- messages_destroy and messages_show find the message on whichever
+  shard has it.
+
+The homepage timeline asks every shard for its newest messages by the
+followed users, all at once, and merges the pages by timestamp (see
+timeline_rows, and reposts.py, which reads it a batch at a time). A
+reply is posted on its author's shard like any other message, so a
+conversation is read from every shard at once the same way (see
+threads.py).
+
+Everything else that shows messages looks them up by id on every shard
+at once (each_shard, message_rows): tag and mention timelines, likes
+pages, the API's message lists, exports and the batch endpoint. A new
+message is indexed for tags and mentions whichever shard it's on.
+
+Message ids must not collide between shards, because likes refer to
+messages by id alone. So shard n's ids all leave a remainder of n when
+divided by ID_STRIDE (which limits the app to ID_STRIDE shards). Set up
+new shards, or re-space the ids after adding one, with
+
+    python shards.py init
+
+Move a user with `python shards.py move <user id> <shard>`. Run
+`python shards.py rebalance` to move users from the busiest shards to
+the quietest until their message counts are within --tolerance of each
+other. `python shards.py status` shows where things stand.
+"""
+
+import argparse
+import heapq
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import create_engine, delete, func, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from functions import message_page_version
+from models import db, User, Message, Likes, UserShard
+from partitions import split_default
+from readmodels import (MessageRow, liked_message_rows, recent_message_rows,
+                        stream_message_rows, user_profile)
+
+ID_STRIDE = 16
+
+# the tables each shard has
+SHARD_TABLES = [User.__table__, Message.__table__]
+
+MOVE_BATCH_SIZE = 1000
+
+
+def shard_count():
+    return 1 + len(current_app.extensions['shards']['engines'])
+
+
+def is_sharded():
+    return shard_count() > 1
+
+
+def shard_engine(shard):
+    """The engine for `shard`; shard 0 is db.engine."""
+
+    if shard == 0:
+        return db.engine
+    return current_app.extensions['shards']['engines'][shard - 1]
+
+
+def user_shard(user_id, lock=False):
+    """The shard holding `user_id`'s messages.
+
+    With `lock`, the user's directory row is locked FOR SHARE until the
+    session's transaction ends, so they can't be moved meanwhile (see
+    move_user).
+    """
+
+    if not is_sharded():
+        return 0
+
+    query = db.session.query(UserShard.shard).filter(UserShard.user_id == user_id)
+    if lock:
+        query = query.with_for_update(read=True)
+    return query.scalar() or 0
+
+
+def user_shards(user_ids):
+    """`user_ids` grouped by shard, as {shard: [user id, ...]}."""
+
+    user_ids = set(user_ids)
+    if not is_sharded():
+        return {0: list(user_ids)} if user_ids else {}
+
+    placed = dict(db.session
+                  .query(UserShard.user_id, UserShard.shard)
+                  .filter(UserShard.user_id.in_(user_ids)))
+
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(placed.get(user_id, 0), []).append(user_id)
+    return by_shard
+
+
+def add_placeholder_user(connection, user_id):
+    """Give `user_id` a row in a shard's users table, if it has none."""
+
+    connection.execute(
+        insert(User.__table__)
+        .values(id=user_id, username=f"~{user_id}",
+                email=f"{user_id}@shard.invalid", password='')
+        .on_conflict_do_nothing(index_elements=['id']))
+
+
+def place_user(user_id):
+    """Pick a shard for a newly signed up user, and record it; returns the
+    shard. Commits."""
+
+    shard = user_id % shard_count()
+
+    if shard:
+        with shard_engine(shard).begin() as connection:
+            add_placeholder_user(connection, user_id)
+        db.session.add(UserShard(user_id=user_id, shard=shard))
+        db.session.commit()
+
+    return shard
+
+
+##############################################################################
+# Messages
+
+
+def shard_message(row, user=None):
+    """A Message for a row read off a shard, detached from the session,
+    with `user` (if given) as its author."""
+
+    msg = Message(**row._mapping)
+    if user is not None:
+        # not msg.user = user: the backref would add msg to the session
+        set_committed_value(msg, 'user', user)
+    return msg
+
+
+def next_message_id(connection):
+    return connection.scalar(select(func.nextval('messages_id_seq')))
+
+
+def add_message(user, text, parent=None):
+    """Post `text` as `user`, on their shard, in reply to `parent` (a
+    Message, from any shard) if given; returns the Message.
+
+    On the main database the message is only added to the session: commit
+    it. On any other shard it's committed right away, and returned
+    detached from the session. Either way, `user` can't be moved to another
+    shard until the session's transaction ends.
+
+    A reply's path ends in its own id, so its id is taken from the
+    shard's sequence before it's inserted.
+    """
+
+    shard = user_shard(user.id, lock=True)
+
+    if shard == 0:
+        msg = Message(text=text)
+        if parent is not None:
+            msg.id = next_message_id(db.session)
+            for name, value in parent.reply_fields(msg.id).items():
+                setattr(msg, name, value)
+        user.messages.append(msg)
+        db.session.flush()
+        return msg
+
+    with shard_engine(shard).begin() as connection:
+        values = dict(text=text, user_id=user.id)
+        if parent is not None:
+            values['id'] = next_message_id(connection)
+            values.update(parent.reply_fields(values['id']))
+        row = connection.execute(
+            insert(Message.__table__)
+            .values(**values)
+            .returning(*Message.__table__.c)).one()
+    return shard_message(row, user)
+
+
+def find_message(message_id):
+    """(shard, Message) for `message_id`, or (None, None) if no shard has
+    it.
+
+    Messages on shards other than the main database are returned detached
+    from the session, with their author loaded.
+    """
+
+    msg = Message.query.get(message_id)
+    if msg is not None:
+        return 0, msg
+
+    # the shard it was posted on comes first; it may have moved since
+    shards = sorted(range(1, shard_count()),
+                    key=lambda shard: shard != message_id % ID_STRIDE)
+    for shard in shards:
+        with shard_engine(shard).connect() as connection:
+            row = connection.execute(
+                select(Message.__table__).where(Message.id == message_id)).first()
+        if row is not None:
+            return shard, shard_message(row, User.query.get(row.user_id))
+
+    return None, None
+
+
+def delete_message(shard, msg):
+    """Delete `msg`, found on `shard` by find_message. On the main
+    database it's deleted in the session: commit it."""
+
+    if shard == 0:
+        db.session.delete(msg)
+        return
+
+    with shard_engine(shard).begin() as connection:
+        connection.execute(delete(Message.__table__)
+                           .where(Message.id == msg.id))
+
+
+def each_shard(statement):
+    """Rows of `statement` run on every shard at once, as one list."""
+
+    if not is_sharded():
+        return db.session.execute(statement).all()
+
+    engines = [shard_engine(shard) for shard in range(shard_count())]
+
+    def fetch(engine):
+        with Session(engine) as session:
+            return session.execute(statement).all()
+
+    pool = current_app.extensions['shards']['pool']
+    return [row for rows in pool.map(fetch, engines) for row in rows]
+
+
+def message_rows(message_ids, between=None):
+    """{id: MessageRow} for `message_ids`, from every shard. `between`, an
+    (oldest, newest) pair of timestamps, keeps the lookups to the
+    partitions that can hold them."""
+
+    if not message_ids:
+        return {}
+
+    statement = MessageRow.select().where(Message.id.in_(message_ids))
+    if between is not None:
+        statement = statement.where(Message.timestamp.between(*between))
+    return {row.id: MessageRow(*row) for row in each_shard(statement)}
+
+
+def user_message_rows(user_id, limit):
+    """`user_id`'s `limit` newest messages, as MessageRows, from their
+    shard."""
+
+    shard = user_shard(user_id)
+    if shard == 0:
+        return recent_message_rows(Message.user_id == user_id, limit)
+
+    with Session(shard_engine(shard)) as session:
+        return recent_message_rows(Message.user_id == user_id, limit, session)
+
+
+def stream_user_message_rows(user_id, limit, chunk_size):
+    """Like user_message_rows, but read off a server-side cursor on the
+    user's shard `chunk_size` rows at a time, as they're iterated."""
+
+    shard = user_shard(user_id)
+    if shard == 0:
+        yield from stream_message_rows(Message.user_id == user_id, chunk_size,
+                                       limit)
+        return
+
+    with Session(shard_engine(shard)) as session:
+        yield from stream_message_rows(Message.user_id == user_id, chunk_size,
+                                       limit, session)
+
+
+def timeline_rows(user_ids, limit):
+    """The `limit` newest messages by any of `user_ids`, as MessageRows.
+
+    Each shard holding some of those users is asked for its `limit`
+    newest messages by them, all shards at once, and the pages are merged
+    newest first.
+    """
+
+    by_shard = user_shards(user_ids)
+    engines = {shard: shard_engine(shard) for shard in by_shard}
+
+    def fetch(shard):
+        with Session(engines[shard]) as session:
+            return recent_message_rows(Message.user_id.in_(by_shard[shard]),
+                                       limit, session)
+
+    pages = current_app.extensions['shards']['pool'].map(fetch, by_shard)
+    merged = heapq.merge(*pages, key=lambda msg: (msg.timestamp, msg.id),
+                         reverse=True)
+    return list(islice(merged, limit))
+
+
+def sharded_liked_message_rows(user_id):
+    """Like readmodels.liked_message_rows, with the messages from every
+    shard."""
+
+    if not is_sharded():
+        return liked_message_rows(user_id)
+
+    liked = db.session.execute(
+        select(Likes.message_id).where(Likes.user_id == user_id)).scalars()
+    return sorted(message_rows(list(liked)).values(),
+                  key=lambda row: (row.timestamp, row.id), reverse=True)
+
+
+def sharded_message_page_version(message_id):
+    """A functions.message_page_version for a message on any shard."""
+
+    version = message_page_version(message_id)
+    if version is not None or not is_sharded():
+        return version
+
+    found = each_shard(select(Message.id, Message.timestamp, Message.user_id,
+                              func.coalesce(Message.thread_id, Message.id))
+                       .where(Message.id == message_id))
+    if not found:
+        return None
+    message_id, timestamp, user_id, thread_id = found[0]
+    profile_version = db.session.execute(
+        select(User.profile_version).where(User.id == user_id)).scalar()
+    if profile_version is None:
+        return None
+    return (message_id, timestamp, user_id, profile_version, thread_id)
+
+
+def message_stats(user_id):
+    """(count, newest id) of `user_id`'s messages, on their shard."""
+
+    with shard_engine(user_shard(user_id)).connect() as connection:
+        return tuple(connection.execute(
+            select(func.count(Message.id), func.max(Message.id))
+            .where(Message.user_id == user_id)).one())
+
+
+def sharded_user_profile(user_id):
+    """Like readmodels.user_profile, counting messages on the user's shard."""
+
+    profile = user_profile(user_id)
+    if profile is not None and user_shard(user_id):
+        profile.message_count, _ = message_stats(user_id)
+    return profile
+
+
+def sharded_profile_page_version(version):
+    """A functions.profile_page_version with the message count and newest
+    id taken from the user's shard."""
+
+    if version is None or not user_shard(version[0]):
+        return version
+    return (*version[:2], *message_stats(version[0]), *version[4:])
+
+
+def purge_user_shard(user_id):
+    """Delete `user_id`'s messages, if they're on another shard than the
+    main database, and their ids; part of the purge_user job."""
+
+    shard = user_shard(user_id)
+    if shard == 0:
+        return []
+
+    with shard_engine(shard).begin() as connection:
+        # the placeholder row's cascade takes the messages with it
+        message_ids = connection.execute(
+            select(Message.id).where(Message.user_id == user_id)).scalars().all()
+        connection.execute(delete(User.__table__).where(User.id == user_id))
+    return message_ids
+
+
+##############################################################################
+# Moving users
+
+
+def copy_messages(user_id, source, target):
+    """Copy `user_id`'s messages from shard `source` to `target`, leaving
+    any already there alone; returns how many were read."""
+
+    copied = 0
+
+    with shard_engine(source).connect() as reading, \
+            shard_engine(target).begin() as writing:
+        if target:
+            add_placeholder_user(writing, user_id)
+
+        result = (reading
+                  .execution_options(stream_results=True)
+                  .execute(select(Message.__table__)
+                           .where(Message.user_id == user_id)))
+        while True:
+            rows = result.fetchmany(MOVE_BATCH_SIZE)
+            if not rows:
+                break
+            writing.execute(insert(Message.__table__)
+                            .values([dict(row._mapping) for row in rows])
+                            .on_conflict_do_nothing())
+            copied += len(rows)
+
+        # rows from months the target has no partition for yet landed in
+        # its default partition
+        split_default(writing)
+
+    return copied
+
+
+def move_user(user_id, target):
+    """Move `user_id`'s messages to shard `target`; returns how many moved.
+
+    The user's directory row is locked while their messages are copied,
+    which holds up their posting (see add_message) but not reading. Only
+    once the directory says `target` are the messages deleted from the
+    old shard, so a move that fails half way can just be run again.
+    """
+
+    if not 0 <= target < shard_count():
+        raise ValueError(f"no shard {target}")
+    if db.session.query(User.id).filter(User.id == user_id).first() is None:
+        raise ValueError(f"no user {user_id}")
+
+    source = user_shard(user_id)
+    if source == target:
+        return 0
+
+    # a directory row to lock, even for a user on the main database
+    db.session.execute(insert(UserShard)
+                       .values(user_id=user_id, shard=source)
+                       .on_conflict_do_nothing())
+    db.session.commit()
+
+    (db.session.query(UserShard)
+     .filter(UserShard.user_id == user_id)
+     .with_for_update()
+     .one())
+    moved = copy_messages(user_id, source, target)
+    (db.session.query(UserShard)
+     .filter(UserShard.user_id == user_id)
+     .update(dict(shard=target)))
+    db.session.commit()
+
+    # anything posted by a request that looked the shard up before the
+    # directory row existed
+    copy_messages(user_id, source, target)
+
+    with shard_engine(source).begin() as connection:
+        if source:
+            connection.execute(delete(User.__table__).where(User.id == user_id))
+        else:
+            connection.execute(delete(Message.__table__)
+                               .where(Message.user_id == user_id))
+
+    return moved
+
+
+def shard_loads():
+    """{shard: {user id: message count}} of every user with messages."""
+
+    loads = {}
+    for shard in range(shard_count()):
+        with shard_engine(shard).connect() as connection:
+            counts = connection.execute(
+                select(Message.user_id, func.count())
+                .group_by(Message.user_id))
+            loads[shard] = dict(counts.all())
+    return loads
+
+
+def plan_rebalance(loads, tolerance):
+    """Moves, as (user id, from shard, to shard), that bring every shard's
+    message count within `tolerance` of the others' where they can.
+
+    `loads` is {shard: {user id: message count}}. Each move takes a user
+    from the busiest shard to the quietest, picking the user who narrows
+    the gap between them the most.
+    """
+
+    users = {shard: dict(counts) for shard, counts in loads.items()}
+    totals = {shard: sum(counts.values()) for shard, counts in users.items()}
+    moves = []
+
+    while len(totals) > 1:
+        busiest = max(totals, key=totals.get)
+        quietest = min(totals, key=totals.get)
+        gap = totals[busiest] - totals[quietest]
+        if gap <= tolerance:
+            break
+
+        # moving n messages leaves a gap of |gap - 2n|; only moves that
+        # shrink it help
+        candidates = [(abs(gap - 2 * count), user_id)
+                      for user_id, count in users[busiest].items()
+                      if 0 < count < gap]
+        if not candidates:
+            break
+        _, user_id = min(candidates)
+
+        count = users[busiest].pop(user_id)
+        users[quietest][user_id] = count
+        totals[busiest] -= count
+        totals[quietest] += count
+        moves.append((user_id, busiest, quietest))
+
+    return moves
+
+
+def rebalance(tolerance, progress=None):
+    """Move users until the shards' message counts are within
+    `tolerance` of each other (as near as whole users allow); returns the
+    moves made. `progress`, if given, is called with each move."""
+
+    moves = plan_rebalance(shard_loads(), tolerance)
+    for user_id, source, target in moves:
+        move_user(user_id, target)
+        if progress:
+            progress(user_id, source, target)
+    return moves
+
+
+##############################################################################
+# Setting up shards
+
+
+def create_database(url):
+    """Create the database at `url` if it doesn't exist yet."""
+
+    url = make_url(url)
+    maintenance = create_engine(url.set(database='postgres'),
+                                isolation_level='AUTOCOMMIT')
+    try:
+        with maintenance.connect() as connection:
+            exists = connection.execute(
+                text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                dict(name=url.database)).scalar()
+            if not exists:
+                connection.execute(text(f'CREATE DATABASE "{url.database}"'))
+    finally:
+        maintenance.dispose()
+
+
+def prepare_shards():
+    """Create the shards' tables, and space out every shard's message ids
+    (see ID_STRIDE) from past the highest id on any shard.
+
+    Run it with no messages being posted: ids handed out meanwhile could
+    collide.
+    """
+
+    engines = [shard_engine(shard) for shard in range(shard_count())]
+
+    for engine in engines[1:]:
+        db.metadata.create_all(bind=engine, tables=SHARD_TABLES)
+
+    highest = 0
+    for engine in engines:
+        with engine.connect() as connection:
+            highest = max(highest, connection.execute(
+                select(func.coalesce(func.max(Message.id), 0))).scalar())
+
+    for shard, engine in enumerate(engines):
+        first = (highest // ID_STRIDE + 1) * ID_STRIDE + shard
+        with engine.begin() as connection:
+            connection.execute(text(
+                f"ALTER SEQUENCE messages_id_seq INCREMENT BY {ID_STRIDE}"
+                f" RESTART WITH {first}"))
+
+
+def drop_shards():
+    """Drop the shards' tables (not the main database's)."""
+
+    for shard in range(1, shard_count()):
+        db.metadata.drop_all(bind=shard_engine(shard), tables=SHARD_TABLES)
+
+
+def init_shards(app):
+    """Set up the shards in SHARD_URLS for `app`.
+
+    You should call this in your Flask app, after connect_db.
+    """
+
+    app.config.setdefault('SHARD_URLS', [])
+
+    urls = app.config['SHARD_URLS']
+    if len(urls) >= ID_STRIDE:
+        raise ValueError(f"at most {ID_STRIDE} shards are supported")
+
+    # engines don't connect until they're used, nor does the pool start
+    # threads
+    engines = [create_engine(url) for url in urls]
+    app.extensions['shards'] = dict(
+        engines=engines,
+        pool=ThreadPoolExecutor(len(engines) + 1, thread_name_prefix='shards'),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage message shards')
+    parser.add_argument('command',
+                        choices=['init', 'status', 'move', 'rebalance'])
+    parser.add_argument('user_id', type=int, nargs='?',
+                        help='user to move')
+    parser.add_argument('shard', type=int, nargs='?',
+                        help='shard to move them to')
+    parser.add_argument('--tolerance', type=int, default=1000,
+                        help='message counts rebalance leaves alone')
+    args = parser.parse_args(argv)
+
+    from app import app
+
+    with app.app_context():
+        if args.command == 'init':
+            for url in app.config['SHARD_URLS']:
+                create_database(url)
+            prepare_shards()
+            print(f"done: {shard_count()} shards")
+
+        elif args.command == 'status':
+            for shard, counts in shard_loads().items():
+                print(f"shard {shard}: {len(counts)} users, "
+                      f"{sum(counts.values())} messages")
+
+        elif args.command == 'move':
+            if args.user_id is None or args.shard is None:
+                parser.error('move needs a user id and a shard')
+            try:
+                moved = move_user(args.user_id, args.shard)
+            except ValueError as e:
+                parser.error(str(e))
+            print(f"done: {moved} messages")
+
+        else:
+            moves = rebalance(args.tolerance, progress=lambda *move: print(
+                "moved user %s from shard %s to %s" % move, file=sys.stderr))
+            print(f"done: {len(moves)} users")
+
+
+if __name__ == '__main__':
+    main()
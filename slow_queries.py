@@ -0,0 +1,221 @@
+"""Slow query log.
+
+Every statement the app's engine runs is timed. One that takes longer
+than SLOW_QUERY_THRESHOLD milliseconds is logged (as a warning on this
+module's logger) with:
+
+- the shapes of its bound parameters: their types, and the lengths of
+  strings and lists, but never their values;
+- the route that ran it ("GET /users/<int:user_id>"), or for work outside
+  a request, the thread's name ("jobs-0");
+- for a sample of them (SLOW_QUERY_EXPLAIN_RATE, from 0 to 1), its
+  EXPLAIN plan, run on the same connection right after the statement.
+  With SLOW_QUERY_EXPLAIN_ANALYZE the plan is an EXPLAIN (ANALYZE,
+  BUFFERS), which runs the statement again; either way only SELECTs are
+  explained, so nothing is ever written twice.
+
+The last SLOW_QUERY_LOG_SIZE slow queries of each worker are kept in
+memory, newest first on /admin/slow-queries, which only the users listed
+in ADMINS can see.
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from itertools import islice
+
+from flask import (Blueprint, current_app, flash, g, has_request_context,
+                   redirect, render_template, request)
+from sqlalchemy import event
+
+from models import db
+
+admin = Blueprint('admin', __name__, url_prefix='/admin')
+
+EXPLAIN_SAVEPOINT = 'slow_query_explain'
+
+logger = logging.getLogger(__name__)
+
+
+class SlowQuery:
+    """One slow statement."""
+
+    __slots__ = ('statement', 'parameters', 'duration_ms', 'route', 'plan',
+                 'recorded_at')
+
+    def __init__(self, statement, parameters, duration_ms, route, plan=None):
+        self.statement = statement
+        self.parameters = parameters
+        self.duration_ms = duration_ms
+        self.route = route
+        self.plan = plan
+        self.recorded_at = datetime.utcnow()
+
+
+class SlowQueryLog:
+    """The most recent `maxlen` slow queries, oldest dropped first."""
+
+    def __init__(self, maxlen):
+        self._queries = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._queries)
+
+    def add(self, query):
+        with self._lock:
+            self._queries.append(query)
+
+    def recent(self, limit=None):
+        """The newest `limit` (or all) queries, newest first."""
+
+        with self._lock:
+            return list(islice(reversed(self._queries), limit))
+
+    def clear(self):
+        with self._lock:
+            self._queries.clear()
+
+
+def value_shape(value):
+    """What `value` is, without what it says: 'str[12]', 'int', 'None'."""
+
+    if value is None:
+        return 'None'
+    if isinstance(value, (str, bytes, list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+def parameter_shapes(parameters, executemany=False):
+    """The shapes of a statement's bound `parameters` (a dict or a
+    sequence, or a list of those with `executemany`)."""
+
+    if executemany:
+        rows = len(parameters)
+        first = parameter_shapes(parameters[0]) if rows else None
+        return dict(rows=rows, first=first)
+    if isinstance(parameters, dict):
+        return {name: value_shape(value) for name, value in parameters.items()}
+    return [value_shape(value) for value in parameters or ()]
+
+
+def current_route():
+    """Where the running statement came from."""
+
+    if has_request_context():
+        rule = request.url_rule
+        return f"{request.method} {rule.rule if rule else request.path}"
+    return threading.current_thread().name
+
+
+def explain(connection, statement, parameters, analyze):
+    """The plan of `statement`, explained on `connection` (a DBAPI one).
+
+    Inside a transaction the EXPLAIN runs in a savepoint, so if it fails
+    the transaction carries on as if it had never run.
+    """
+
+    in_transaction = not getattr(connection, 'autocommit', False)
+    options = '(ANALYZE, BUFFERS) ' if analyze else ''
+
+    explain_cursor = connection.cursor()
+    try:
+        if in_transaction:
+            explain_cursor.execute(f"SAVEPOINT {EXPLAIN_SAVEPOINT}")
+        try:
+            explain_cursor.execute(f"EXPLAIN {options}{statement}", parameters)
+            plan = '\n'.join(row[0] for row in explain_cursor.fetchall())
+        except Exception:
+            if in_transaction:
+                explain_cursor.execute(
+                    f"ROLLBACK TO SAVEPOINT {EXPLAIN_SAVEPOINT}")
+            raise
+        finally:
+            if in_transaction:
+                explain_cursor.execute(f"RELEASE SAVEPOINT {EXPLAIN_SAVEPOINT}")
+    finally:
+        explain_cursor.close()
+
+    return plan
+
+
+def explainable(statement, context):
+    return (not context.executemany
+            and statement.lstrip()[:6].upper() == 'SELECT')
+
+
+def watch_engine(engine, app):
+    """Time every statement `engine` runs, logging the slow ones to
+    `app`'s slow query log."""
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        context._slow_query_start = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        duration_ms = (time.perf_counter() - context._slow_query_start) * 1000
+        config = app.config
+        if duration_ms < config['SLOW_QUERY_THRESHOLD']:
+            return
+
+        query = SlowQuery(statement, parameter_shapes(parameters, executemany),
+                          round(duration_ms, 3), current_route())
+
+        if (explainable(statement, context)
+                and random.random() < config['SLOW_QUERY_EXPLAIN_RATE']):
+            try:
+                query.plan = explain(conn.connection, statement, parameters,
+                                     config['SLOW_QUERY_EXPLAIN_ANALYZE'])
+            except Exception:
+                logger.exception('could not explain slow query')
+
+        logger.warning('slow query (%.1f ms) from %s: %s %s', query.duration_ms,
+                       query.route, statement, query.parameters)
+        app.extensions['slow_queries'].add(query)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+@admin.route('/slow-queries')
+def slow_queries():
+    """The worker's most recent slow queries, for ADMINS only."""
+
+    if not g.user or g.user.username not in current_app.config['ADMINS']:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    config = current_app.config
+    return render_template('admin/slow_queries.html',
+                           queries=current_app.extensions['slow_queries'].recent(),
+                           threshold=config['SLOW_QUERY_THRESHOLD'])
+
+
+def init_slow_queries(app):
+    """Set up the slow query log for `app`, on its database engine.
+
+    SLOW_QUERY_THRESHOLD is how many milliseconds make a query slow,
+    SLOW_QUERY_EXPLAIN_RATE the share of slow SELECTs whose plan is
+    captured, SLOW_QUERY_EXPLAIN_ANALYZE whether those plans are EXPLAIN
+    ANALYZEd, and SLOW_QUERY_LOG_SIZE how many slow queries each worker
+    keeps for /admin/slow-queries.
+
+    You should call this in your Flask app, after connect_db.
+    """
+
+    app.config.setdefault('ADMINS', ())
+    app.config.setdefault('SLOW_QUERY_THRESHOLD', 100)
+    app.config.setdefault('SLOW_QUERY_EXPLAIN_RATE', 0.1)
+    app.config.setdefault('SLOW_QUERY_EXPLAIN_ANALYZE', False)
+    app.config.setdefault('SLOW_QUERY_LOG_SIZE', 200)
+
+    app.extensions['slow_queries'] = SlowQueryLog(app.config['SLOW_QUERY_LOG_SIZE'])
+
+    # making the engine doesn't connect to the database
+    watch_engine(db.get_engine(app), app)
+    app.register_blueprint(admin)
@@ -0,0 +1,41 @@
+"""Streamed template rendering.
+
+`render_template` builds the whole page before sending any of it; with
+long timelines that makes the time to first byte the full render time.
+`stream_template` instead sends the page as Jinja renders it, so the
+header and sidebar go out at once and message items follow in chunks as
+they're read: a profile's messages off a server-side cursor (see
+`shards.stream_user_message_rows`), the homepage's a batch of
+STREAM_CHUNK_SIZE at a time (see `reposts.HomeTimeline`). Pages passed a
+list have already read everything, and gain nothing.
+"""
+
+from flask import (Response, current_app, get_flashed_messages,
+                   render_template, stream_with_context)
+
+
+def stream_template(template_name, **context):
+    """Like `render_template`, but returns a streamed response."""
+
+    app = current_app._get_current_object()
+
+    # the session is saved before the body is sent, so flashed messages
+    # have to be popped now rather than when the template gets to them
+    get_flashed_messages()
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+
+    stream = template.stream(context)
+    stream.enable_buffering(app.config['STREAM_BUFFER_SIZE'])
+
+    return Response(stream_with_context(stream), mimetype='text/html')
+
+
+def render_page(template_name, **context):
+    """Render a page, streaming it when the app is in streaming mode."""
+
+    if current_app.config['STREAM_TEMPLATES']:
+        return stream_template(template_name, **context)
+
+    return render_template(template_name, **context)
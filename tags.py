@@ -0,0 +1,231 @@
+"""#hashtags and @mentions.
+
+Messages are scanned for tags and mentions by a job enqueued when
+they're posted (see jobs.py), and the results stored in message_tags and
+mentions, each indexed by (tag or user, timestamp), so /tags/<tag> and
+/mentions/<username> read a page of their timeline straight off an
+index.
+
+Messages from before those tables existed can be indexed with:
+
+    python tags.py backfill
+"""
+
+import argparse
+import re
+import sys
+from datetime import datetime
+
+from flask import abort
+from markupsafe import Markup, escape
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from api import ApiError, decode_cursor, encode_cursor
+from jobs import handler
+from models import db, User, Message, MessageTag, Mention
+from shards import find_message, message_rows, shard_count, shard_engine
+
+PAGE_SIZE = 50
+BACKFILL_BATCH_SIZE = 1000
+
+# a sigil that doesn't follow a word character, then up to 50 of them
+LINK_RE = re.compile(r'(?<![\w#@])([#@])(\w{1,50})(?!\w)')
+
+
+def extract_links(text):
+    """The tags (lowercased) and mentioned usernames in `text`, as sets."""
+
+    tags, usernames = set(), set()
+    for sigil, name in LINK_RE.findall(text):
+        if sigil == '#':
+            tags.add(name.lower())
+        else:
+            usernames.add(name)
+    return tags, usernames
+
+
+def linkify(text):
+    """Template filter: `text`, escaped, with its tags and mentions linked
+    to their timelines."""
+
+    parts = []
+    pos = 0
+
+    for match in LINK_RE.finditer(text):
+        sigil, name = match.groups()
+        href = f"/tags/{name.lower()}" if sigil == '#' else f"/mentions/{name}"
+
+        parts.append(escape(text[pos:match.start()]))
+        parts.append(Markup('<a href="{}">{}</a>').format(href, match.group(0)))
+        pos = match.end()
+
+    parts.append(escape(text[pos:]))
+    return Markup('').join(parts)
+
+
+##############################################################################
+# Indexing
+
+
+def index_messages(messages):
+    """Store the tags and mentions of `messages`, (id, text, timestamp)
+    tuples. Rows that already exist are left alone, so it's safe to index a
+    message again.
+
+    Mentions of usernames nobody has are skipped. Call db.session.commit()
+    afterwards.
+    """
+
+    tag_rows = []
+    mentioned = []
+
+    for message_id, text, timestamp in messages:
+        tags, usernames = extract_links(text)
+        tag_rows.extend(dict(message_id=message_id, tag=tag, timestamp=timestamp)
+                        for tag in tags)
+        mentioned.extend((message_id, username, timestamp)
+                         for username in usernames)
+
+    mention_rows = []
+    if mentioned:
+        user_ids = dict(db.session
+                        .query(User.username, User.id)
+                        .filter(User.username.in_({username for _, username, _
+                                                   in mentioned})))
+        mention_rows = [dict(message_id=message_id, user_id=user_ids[username],
+                             timestamp=timestamp)
+                        for message_id, username, timestamp in mentioned
+                        if username in user_ids]
+
+    for model, rows in ((MessageTag, tag_rows), (Mention, mention_rows)):
+        if rows:
+            db.session.execute(insert(model).values(rows).on_conflict_do_nothing())
+
+
+def index_message(msg):
+    """Store the tags and mentions of `msg`, which has to be flushed."""
+
+    index_messages([(msg.id, msg.text, msg.timestamp)])
+
+
+@handler('index_message')
+def index_message_job(payload):
+    """Job: index a newly posted message, on whichever shard it is,
+    unless it's been deleted since."""
+
+    _, msg = find_message(payload['message_id'])
+    if msg is not None:
+        index_message(msg)
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE, progress=None):
+    """Index every message on every shard, `batch_size` at a time.
+
+    Messages are read in id order, a batch per query and a transaction
+    per batch, so the job never holds much in memory or locks anything for
+    long, and can be stopped and run again. Returns the number of messages
+    read; `progress`, if given, is called with the running total.
+    """
+
+    total = 0
+
+    for shard in range(shard_count()):
+        last_id = 0
+        while True:
+            with shard_engine(shard).connect() as connection:
+                batch = connection.execute(
+                    select(Message.id, Message.text, Message.timestamp)
+                    .where(Message.id > last_id)
+                    .order_by(Message.id)
+                    .limit(batch_size)).all()
+            if not batch:
+                break
+
+            index_messages(batch)
+            db.session.commit()
+
+            last_id = batch[-1].id
+            total += len(batch)
+            if progress:
+                progress(total)
+
+    return total
+
+
+##############################################################################
+# Timelines
+
+
+def timeline_page(model, criterion, cursor=None, limit=PAGE_SIZE):
+    """A page of MessageRows from `model` (MessageTag or Mention) rows
+    matching `criterion`, newest first.
+
+    The page of ids comes off `model`'s index, and the messages are then
+    looked up by id on every shard, within the page's timestamps.
+
+    `cursor` is the next_cursor of the previous page. Returns (messages,
+    next_cursor), with next_cursor None on the last page.
+    """
+
+    query = (db.session.query(model.message_id, model.timestamp)
+             .filter(criterion))
+
+    if cursor:
+        try:
+            before = decode_cursor(cursor, [datetime, int])
+        except ApiError:
+            abort(400)
+        query = query.filter(tuple_(model.timestamp, model.message_id)
+                             < tuple_(*before))
+
+    rows = (query
+            .order_by(model.timestamp.desc(), model.message_id.desc())
+            .limit(limit + 1)
+            .all())
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1].timestamp, rows[-1].message_id])
+
+    found = message_rows([row.message_id for row in rows],
+                         (rows[-1].timestamp, rows[0].timestamp) if rows else None)
+    return [found[row.message_id] for row in rows
+            if row.message_id in found], next_cursor
+
+
+def tag_timeline(tag, cursor=None, limit=PAGE_SIZE):
+    return timeline_page(MessageTag, MessageTag.tag == tag.lower(), cursor, limit)
+
+
+def mentions_timeline(user, cursor=None, limit=PAGE_SIZE):
+    return timeline_page(Mention, Mention.user_id == user.id, cursor, limit)
+
+
+def init_tags(app):
+    """Add the `linkify` filter to `app`'s templates.
+
+    You should call this in your Flask app.
+    """
+
+    app.jinja_env.filters['linkify'] = linkify
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Index #tags and @mentions')
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    from app import app
+
+    with app.app_context():
+        total = backfill(args.batch_size,
+                         progress=lambda n: print(f"indexed {n} messages",
+                                                  file=sys.stderr))
+    print(f"done: {total} messages")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Tests JSON API"""
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import app
+
+db.drop_all()
+
+class ApiTestCase(TestCase):
+    """Test views for the JSON API."""
+
+    def login_for_test(self):
+        """Logs a user into the test enviornment"""
+        self.client.post('/login',
+                        data = dict(username="testuser1", password="HASHED_PASSWORD", form='')
+                        )
+    
+    @classmethod
+    def setUpClass(self):
+        """Create test client, adds sample data."""
+        db.create_all() 
+        
+        u1 = User.signup(
+            email="test1@test.com",
+            username="testuser1",
+            password="HASHED_PASSWORD",
+            image_url='null'
+        )
+        
+        u2 = User.signup(
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD",
+            image_url='null'
+        )
+        db.session.commit()
+        
+        for day in range(1, 6):
+            db.session.add(Message(text=f"Message{day}",
+                                   timestamp=f"12/0{day}/2021",
+                                   user_id=2))
+        db.session.add(Follows(user_being_followed_id=2, user_following_id=1))
+        db.session.commit()
+        
+        db.session.add(Likes(user_id=1, message_id=3))
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(self):
+        """Cleans up test **DB** after tests are complete"""
+        db.session.rollback()
+        db.drop_all()
+        
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+    
+    def tearDown(self):
+        self.client.post('/logout')
+        
+        
+        
+    ##############################################################################
+    
+    
+    
+    def test_timeline(self):
+        """Tests paging through the timeline"""
+        
+        ### Tests when not logged in ###
+        resp = self.client.get('/api/v1/timeline')
+        
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.json, {'error': 'Access unauthorized.'})
+        
+        ### Tests when logged in ###
+        self.login_for_test()
+        
+        resp = self.client.get('/api/v1/timeline?limit=3')
+        page1 = resp.json
+        
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([m['text'] for m in page1['data']],
+                         ['Message5', 'Message4', 'Message3'])
+        self.assertEqual(page1['data'][0]['username'], 'testuser2')
+        self.assertEqual(page1['data'][0]['timestamp'], '2021-12-05T00:00:00')
+        
+        resp = self.client.get(f"/api/v1/timeline?limit=3&cursor={page1['next_cursor']}")
+        page2 = resp.json
+        
+        self.assertEqual([m['text'] for m in page2['data']],
+                         ['Message2', 'Message1'])
+        self.assertIsNone(page2['next_cursor'])
+        
+        ### Tests bad cursors ###
+        resp = self.client.get('/api/v1/timeline?cursor=nope')
+        
+        self.assertEqual(resp.status_code, 400)
+        
+        
+        
+    ##############################################################################
+    
+    
+    
+    def test_field_selection(self):
+        """Tests picking fields with ?fields="""
+        resp = self.client.get('/api/v1/users/2/messages?limit=1&fields=id,text')
+        
+        self.assertEqual(resp.json['data'], [{'id': 5, 'text': 'Message5'}])
+        
+        resp = self.client.get('/api/v1/users/2/messages?fields=id,password')
+        
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json, {'error': 'Unknown fields: password'})
+        
+        
+        
+    ##############################################################################
+    
+    
+    
+    def test_user_profile(self):
+        """Tests the user profile endpoint"""
+        resp = self.client.get('/api/v1/users/1')
+        data = resp.json['data']
+        
+        self.assertEqual(data['username'], 'testuser1')
+        self.assertEqual(data['following_count'], 1)
+        self.assertEqual(data['followers_count'], 0)
+        self.assertEqual(data['likes_count'], 1)
+        self.assertNotIn('email', data)
+        self.assertNotIn('password', data)
+        
+        ### Tests for non existent user ###
+        resp = self.client.get('/api/v1/users/60')
+        
+        self.assertEqual(resp.status_code, 404)
+        
+        
+        
+    ##############################################################################
+    
+    
+    
+    def test_follows_and_likes(self):
+        """Tests the following, followers and likes lists"""
+        
+        ### Tests when not logged in ###
+        resp = self.client.get('/api/v1/users/1/following')
+        
+        self.assertEqual(resp.status_code, 401)
+        
+        ### Tests when logged in ###
+        self.login_for_test()
+        
+        resp = self.client.get('/api/v1/users/1/following?fields=username')
+        
+        self.assertEqual(resp.json['data'], [{'username': 'testuser2'}])
+        
+        resp = self.client.get('/api/v1/users/2/followers?fields=id')
+        
+        self.assertEqual(resp.json['data'], [{'id': 1}])
+        
+        resp = self.client.get('/api/v1/users/1/likes?fields=text')
+        
+        self.assertEqual(resp.json['data'], [{'text': 'Message3'}])
+        
+        resp = self.client.get('/api/v1/users/60/likes')
+        
+        self.assertEqual(resp.status_code, 404)
+        
+        
+        
+    ##############################################################################
+    
+    
+    
+    def test_batch(self):
+        """Tests applying many likes and follows in one request"""
+        
+        ### Tests when not logged in ###
+        resp = self.client.post('/api/v1/batch', json=dict(operations=[]))
+        
+        self.assertEqual(resp.status_code, 401)
+        
+        ### Tests when logged in ###
+        self.login_for_test()
+        
+        resp = self.client.post('/api/v1/batch', json=dict(operations=[
+            dict(op='unlike', message_id=1),
+            dict(op='like', message_id=1),
+            dict(op='unlike', message_id=3),
+            dict(op='follow', user_id=2),
+            dict(op='follow', user_id=1),
+            dict(op='like', message_id=60),
+            dict(op='poke', user_id=2),
+        ]))
+        results = [r['status'] for r in resp.json['results']]
+        
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(results, ['superseded', 'ok', 'ok', 'unchanged',
+                                   'invalid', 'not_found', 'invalid'])
+        
+        liked = {like.message_id for like in Likes.query.filter_by(user_id=1)}
+        
+        self.assertEqual(liked, {1})
+        
+        ### Puts the likes back for the other tests ###
+        resp = self.client.post('/api/v1/batch', json=dict(operations=[
+            dict(op='unlike', message_id=1),
+            dict(op='like', message_id=3),
+        ]))
+        
+        self.assertEqual([r['status'] for r in resp.json['results']], ['ok', 'ok'])
+        
+        ### Tests malformed batches ###
+        resp = self.client.post('/api/v1/batch', json=dict(ops=[]))
+        
+        self.assertEqual(resp.status_code, 400)
+        
+        for body in ([dict(op='like', message_id=1)], 'operations', 1):
+            resp = self.client.post('/api/v1/batch', json=body)
+            
+            self.assertEqual(resp.status_code, 400)
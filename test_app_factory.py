@@ -0,0 +1,115 @@
+"""App factory tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_app_factory.py
+
+import gc
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import event
+
+from caching import CLEARED_ON_DROP, clear_dropped
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+import app as app_module
+from app import CURR_USER_KEY, app, create_app, warm_up
+
+db.drop_all()
+
+# nothing listens here, so any attempt to connect fails
+UNREACHABLE_DATABASE_URL = "postgresql://nobody@127.0.0.1:9/nowhere"
+
+
+class AppFactoryTestCase(TestCase):
+    """Tests making and warming up apps."""
+
+    @classmethod
+    def setUpClass(self):
+        db.create_all()
+        User.signup(email="test1@test.com", username="testuser1",
+                    password="HASHED_PASSWORD", image_url='null')
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(self):
+        """Cleans up test **DB** after tests are complete"""
+        db.session.rollback()
+        db.drop_all()
+
+    def test_no_connection_at_startup(self):
+        """Making an app doesn't connect to the database"""
+        other = create_app(dict(SQLALCHEMY_DATABASE_URI=UNREACHABLE_DATABASE_URL))
+
+        # pages that don't query still work...
+        resp = other.test_client().get('/login')
+        self.assertEqual(resp.status_code, 200)
+
+        # ...and the first query is the first connection attempt
+        with other.app_context():
+            self.assertIn('9/nowhere', str(db.engine.url))
+            with self.assertRaises(Exception):
+                db.engine.connect()
+
+    def test_separate_apps(self):
+        """Apps made with different config don't share settings, state
+        or sessions"""
+        other = create_app(dict(SECRET_KEY='another secret',
+                                STREAM_TEMPLATES=True, TESTING=True))
+
+        self.assertIsNot(other, app)
+        self.assertTrue(other.config['STREAM_TEMPLATES'])
+        self.assertFalse(app.config['STREAM_TEMPLATES'])
+        self.assertIsNot(other.extensions['trending'], app.extensions['trending'])
+
+        client = other.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        resp = client.get('/users/1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.is_streamed)
+        self.assertIn('@testuser1', resp.get_data(as_text=True))
+
+        # each app streams by its own config
+        with patch.object(app_module, 'stream_user_message_rows',
+                          wraps=app_module.stream_user_message_rows) as stream:
+            client.get('/users/1').get_data()
+            self.assertEqual(stream.call_count, 1)
+            app.test_client().get('/users/1').get_data()
+            self.assertEqual(stream.call_count, 1)
+
+        # the other app's session cookie means nothing to the default app
+        cookie = next(iter(client.cookie_jar)).value
+        default_client = app.test_client()
+        default_client.set_cookie('localhost', app.session_cookie_name, cookie)
+        self.assertNotIn('Logout', default_client.get('/').get_data(as_text=True))
+        self.assertIn('Logout', client.get('/').get_data(as_text=True))
+
+    def test_warm_up(self):
+        """Warming up opens pooled connections and compiles templates"""
+        other = create_app(dict(WARM_CONNECTIONS=3, JOBS_THREADS=0))
+        warm_up(other)
+
+        with other.app_context():
+            self.assertEqual(db.engine.pool.checkedin(), 3)
+        self.assertIn('home.html',
+                      [name for _, name in other.jinja_env.cache.keys()])
+
+    def test_apps_dont_pile_up(self):
+        """Making apps adds no listeners, and their caches go with them"""
+        caches = len(CLEARED_ON_DROP)
+        other = create_app(dict(TESTING=True))
+        self.assertEqual(len(CLEARED_ON_DROP), caches + 3)
+        self.assertTrue(event.contains(db.metadata, 'after_drop', clear_dropped))
+
+        other.extensions['fragment_cache'].set('stale', 'markup')
+        clear_dropped()
+        self.assertIsNone(other.extensions['fragment_cache'].get('stale'))
+
+        del other
+        gc.collect()
+        self.assertEqual(len(CLEARED_ON_DROP), caches)
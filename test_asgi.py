@@ -0,0 +1,105 @@
+"""Tests the asyncio serving mode"""
+import os
+import asyncio
+from unittest import TestCase
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+from asgi import application, build_environ, fetch
+
+db.drop_all()
+
+class AsgiTestCase(TestCase):
+    """Test pages served through the ASGI app."""
+
+    def get(self, path, **kwargs):
+        return self.loop.run_until_complete(fetch(application, path, **kwargs))
+
+    def session_cookie(self, user_id):
+        """A signed session cookie for a logged in user"""
+        serializer = app.session_interface.get_signing_serializer(app)
+        value = serializer.dumps({CURR_USER_KEY: user_id})
+        return ('Cookie', f"{app.session_cookie_name}={value}")
+
+    @classmethod
+    def setUpClass(self):
+        """Create test client, adds sample data."""
+        db.create_all()
+
+        for n in (1, 2):
+            User.signup(
+                email=f"test{n}@test.com",
+                username=f"testuser{n}",
+                password="HASHED_PASSWORD",
+                image_url='null'
+            )
+        db.session.commit()
+
+        for day in range(1, 6):
+            db.session.add(Message(text=f"Message{day}",
+                                   timestamp=f"12/0{day}/2021",
+                                   user_id=2))
+        db.session.add(Follows(user_being_followed_id=2, user_following_id=1))
+        db.session.commit()
+
+        self.loop = asyncio.new_event_loop()
+
+    @classmethod
+    def tearDownClass(self):
+        """Cleans up test **DB** after tests are complete"""
+        self.loop.run_until_complete(application.engine.dispose())
+        self.loop.close()
+        db.session.rollback()
+        db.drop_all()
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_routing(self):
+        def endpoint(method, path):
+            scope = dict(method=method, path=path, query_string=b'',
+                         headers=[])
+            return application.endpoint(build_environ(scope, b''))
+
+        self.assertEqual(endpoint('GET', '/'), 'homepage')
+        self.assertEqual(endpoint('GET', '/users/2'), 'users_show')
+        self.assertEqual(endpoint('POST', '/messages/new'), 'messages_add')
+        self.assertIsNone(endpoint('GET', '/nowhere'))
+
+    def test_concurrent_timelines(self):
+        cookie = self.session_cookie(1)
+
+        async def fetch_all():
+            return await asyncio.gather(*[fetch(application, '/', headers=[cookie])
+                                          for _ in range(20)])
+
+        for status, headers, body in self.loop.run_until_complete(fetch_all()):
+            self.assertEqual(status, 200)
+            self.assertIn(b'Message5', body)
+            self.assertIn(b'@testuser2', body)
+
+    def test_pages(self):
+        status, headers, body = self.get('/users/2')
+        self.assertEqual(status, 200)
+        self.assertIn(b'Message3', body)
+
+        status, headers, body = self.get('/users?q=testuser')
+        self.assertEqual(status, 200)
+        self.assertIn(b'@testuser1', body)
+
+        status, headers, body = self.get('/users/999')
+        self.assertEqual(status, 404)
+
+    def test_threaded_routes(self):
+        cookie = self.session_cookie(2)
+
+        status, headers, body = self.get(
+            '/messages/new', method='POST', body=b'text=Served+by+a+thread',
+            headers=[cookie, ('Content-Type', 'application/x-www-form-urlencoded')])
+        self.assertEqual(status, 302)
+
+        status, headers, body = self.get('/users/2', headers=[cookie])
+        self.assertIn(b'Served by a thread', body)
@@ -0,0 +1,88 @@
+"""Static asset build and serving tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import app
+from assets import build, STATIC_DIR
+
+
+class AssetsTestCase(TestCase):
+    """Tests fingerprinting, precompression and serving of assets."""
+
+    @classmethod
+    def setUpClass(self):
+        """Builds a copy of the static folder."""
+        self.static_dir = os.path.join(tempfile.mkdtemp(), 'static')
+        shutil.copytree(STATIC_DIR, self.static_dir,
+                        ignore=shutil.ignore_patterns('dist'))
+        self.manifest = build(self.static_dir)
+
+        self.original_static_folder = app.static_folder
+        self.original_assets = app.extensions['assets']
+        app.static_folder = self.static_dir
+        app.extensions['assets'] = dict(
+            manifest=self.manifest,
+            files=frozenset(self.manifest.values()),
+        )
+
+    @classmethod
+    def tearDownClass(self):
+        """Puts the app's own static folder back."""
+        app.static_folder = self.original_static_folder
+        app.extensions['assets'] = self.original_assets
+        shutil.rmtree(os.path.dirname(self.static_dir))
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_build(self):
+        """Files are fingerprinted, compressed and referenced by hash"""
+        css = self.manifest['stylesheets/style.css']
+        dist = os.path.join(self.static_dir, 'dist')
+
+        self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.exists(os.path.join(dist, css + '.gz')))
+        self.assertFalse(os.path.exists(os.path.join(
+            dist, self.manifest['images/warbler-hero.jpg'] + '.gz')))
+
+        with open(os.path.join(dist, css)) as f:
+            self.assertIn(f"/assets/{self.manifest['images/nav-bg.png']}",
+                          f.read())
+
+    def test_serve_asset(self):
+        """Assets are served immutable, precompressed when accepted"""
+        url = f"/assets/{self.manifest['stylesheets/style.css']}"
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+        self.assertTrue(resp.status_code == 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('text/css', resp.headers['Content-Type'])
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertNotIn('Cookie', resp.headers['Vary'])
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'identity'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn('.navbar', resp.get_data(as_text=True))
+
+        resp = self.client.get('/assets/stylesheets/style.css')
+
+        self.assertTrue(resp.status_code == 404)
+
+    def test_templates_use_fingerprints(self):
+        """Pages link the fingerprinted stylesheet"""
+        resp = self.client.get('/login')
+        html = resp.get_data(as_text=True)
+
+        self.assertIn(f"/assets/{self.manifest['stylesheets/style.css']}", html)
@@ -0,0 +1,136 @@
+"""Availability check tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import app
+from availability import BloomFilter, is_taken, taken_fields
+
+db.drop_all()
+
+
+class AvailabilityTestCase(TestCase):
+    """Tests the Bloom filter backed username and email checks."""
+
+    def setUp(self):
+        db.create_all()
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+
+        User.signup(email="test1@test.com", username="testuser1",
+                    password="HASHED_PASSWORD", image_url='null')
+        db.session.commit()
+        self.index = app.extensions['availability']
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000)
+        words = [f"word{n}" for n in range(1000)]
+        for word in words:
+            bloom.add(word)
+
+        self.assertTrue(all(word in bloom for word in words))
+        false_positives = sum(f"other{n}" in bloom for n in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_lookups(self):
+        with app.app_context():
+            self.assertTrue(is_taken('username', "testuser1"))
+            self.assertFalse(is_taken('username', "testuser2"))
+            self.assertEqual(taken_fields("testuser2", "test1@test.com"),
+                             ['email'])
+            self.assertEqual(self.index.last_id, 1)
+
+            # a user added by another worker is read in on the next refresh
+            db.session.execute(User.__table__.insert().values(
+                username="testuser3", email="test3@test.com", password="x"))
+            db.session.commit()
+            self.assertFalse(self.index.might_be_taken('username', "testuser3"))
+            self.index.refresh()
+            self.assertTrue(is_taken('username', "testuser3"))
+
+            # one added here is in the filter as soon as it's flushed
+            User.signup(email="test4@test.com", username="testuser4",
+                        password="HASHED_PASSWORD", image_url='null')
+            db.session.commit()
+            self.assertTrue(self.index.might_be_taken('email', "test4@test.com"))
+
+    def test_counting(self):
+        bloom = BloomFilter(1000)
+        self.assertTrue(bloom.add("word"))
+        self.assertFalse(bloom.add("word"))
+        self.assertEqual(bloom.count, 1)
+
+        with app.app_context():
+            self.index.rebuild()
+            count = self.index.filter.count
+
+            # profile edits don't add anything; renames add the new name
+            user = User.query.one()
+            user.bio = "Hello"
+            user.profile_version += 1
+            db.session.commit()
+            self.assertEqual(self.index.filter.count, count)
+            user.username = "renamed"
+            db.session.commit()
+            self.assertEqual(self.index.filter.count, count + 1)
+
+    def test_one_rebuild_at_a_time(self):
+        with app.app_context():
+            self.index.rebuild()
+            old = self.index.filter
+            self.index.built_at -= self.index.rebuild_interval
+
+            # while another thread is rebuilding, lookups use the old filter
+            with self.index._lock:
+                self.index.refresh()
+            self.assertIs(self.index.filter, old)
+
+            self.index.refresh()
+            new = self.index.filter
+            self.assertIsNot(new, old)
+            # and the next one finds it's been done
+            self.index.refresh()
+            self.assertIs(self.index.filter, new)
+
+    def test_api(self):
+        resp = self.client.get('/api/v1/availability?username=testuser1'
+                               '&email=new@test.com')
+        self.assertEqual(resp.json['data'], dict(
+            username=dict(value="testuser1", available=False),
+            email=dict(value="new@test.com", available=True)))
+
+        self.assertEqual(self.client.get('/api/v1/availability').status_code,
+                         400)
+
+    def test_signup(self):
+        with patch('models.bcrypt.generate_password_hash') as generate:
+            resp = self.client.post('/signup', data=dict(
+                username="testuser1", email="other@test.com",
+                password="password"))
+            html = resp.get_data(as_text=True)
+            self.assertIn("Username already taken", html)
+            generate.assert_not_called()
+
+            resp = self.client.post('/signup', data=dict(
+                username="other", email="test1@test.com", password="password"))
+            self.assertIn("Email already taken", resp.get_data(as_text=True))
+            generate.assert_not_called()
+
+        resp = self.client.post('/signup', data=dict(
+            username="testuser2", email="test2@test.com", password="password"))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(User.query.count(), 2)
@@ -0,0 +1,44 @@
+"""Benchmark suite tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bench.py
+
+from unittest import TestCase
+
+from bench import compare_results
+
+
+class CompareResultsTestCase(TestCase):
+    """Tests the baseline comparison of benchmark results."""
+
+    baseline = {
+        '1000': {
+            'homepage render': dict(median_ms=50.0),
+            'User.is_following': dict(median_ms=1.0),
+        }
+    }
+
+    def test_within_threshold(self):
+        """Slowdowns up to the threshold are not regressions"""
+        current = {'1000': {'homepage render': dict(median_ms=59.0)}}
+
+        self.assertEqual(compare_results(current, self.baseline, 20), [])
+
+    def test_regression(self):
+        """Slowdowns past the threshold are reported"""
+        current = {'1000': {'homepage render': dict(median_ms=70.0),
+                            'User.is_following': dict(median_ms=0.5)}}
+
+        regressions = compare_results(current, self.baseline, 20)
+
+        self.assertEqual(len(regressions), 1)
+        self.assertEqual(regressions[0]['benchmark'], 'homepage render')
+        self.assertEqual(regressions[0]['change_pct'], 40.0)
+
+    def test_missing_entries_ignored(self):
+        """Sizes and benchmarks without a baseline are skipped"""
+        current = {'100000': {'homepage render': dict(median_ms=500.0)},
+                   '1000': {'list_users search': dict(median_ms=5.0)}}
+
+        self.assertEqual(compare_results(current, self.baseline, 20), [])
@@ -0,0 +1,226 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_caching.py
+
+import os
+import threading
+from unittest import TestCase
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+from caching import (LRUCache, SharedCache, make_cache_server, message_fragment,
+                     user_cards, with_authors)
+
+db.drop_all()
+
+
+class LRUCacheTestCase(TestCase):
+    """Tests the LRU cache."""
+
+    def test_eviction(self):
+        """Least recently used entries are evicted first"""
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_delete(self):
+        """Deleted and missing keys return the default"""
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.delete('a')
+        cache.delete('missing')
+
+        self.assertEqual(cache.get('a', 'nope'), 'nope')
+
+    def test_get_many(self):
+        """Batched gets return only the cached keys"""
+        cache = LRUCache(maxsize=2)
+        cache.set_many({'a': 1, 'b': 2, 'c': 3})
+
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'b': 2, 'c': 3})
+
+    def test_ttl(self):
+        """Entries set with a ttl expire after it"""
+        cache = LRUCache()
+        cache.set('a', 1, ttl=0)
+        cache.set_many({'b': 2, 'c': 3}, ttl=60)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'b': 2, 'c': 3})
+        self.assertEqual(len(cache), 2)
+
+    def test_cleared_on_drop(self):
+        """Dropping the tables clears the cache"""
+        cache = app.extensions['fragment_cache']
+        cache.set('stale', 'markup')
+
+        db.create_all()
+        db.drop_all()
+
+        self.assertIsNone(cache.get('stale'))
+
+
+class SharedCacheTestCase(TestCase):
+    """Tests the client for a cache server."""
+
+    @classmethod
+    def setUpClass(self):
+        """Starts a cache server on a free port."""
+        server = make_cache_server(('localhost', 0), b'test', maxsize=10)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.address = server.address
+
+    def test_round_trip(self):
+        """Values set by one client are seen by another"""
+        writer = SharedCache(self.address, b'test')
+        reader = SharedCache(self.address, b'test')
+
+        writer.set_many({1: ('a', 1), 2: ('b', 2)})
+        self.assertEqual(reader.get_many([1, 2, 3]), {1: ('a', 1), 2: ('b', 2)})
+
+        reader.delete(1)
+        self.assertIsNone(writer.get(1))
+        self.assertEqual(len(writer), 1)
+
+    def test_unavailable(self):
+        """Without a server the cache acts empty"""
+        cache = SharedCache(('localhost', 1), b'test')
+        cache.set('a', 1)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_many(['a']), {})
+
+
+class UserCardTestCase(TestCase):
+    """Tests the user card cache."""
+
+    @classmethod
+    def setUpClass(self):
+        """Adds sample data."""
+        db.create_all()
+
+        User.signup(
+            email="test1@test.com",
+            username="testuser1",
+            password="HASHED_PASSWORD",
+            image_url='null'
+        )
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(self):
+        """Cleans up test **DB** after tests are complete"""
+        db.session.rollback()
+        db.drop_all()
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.extensions['user_cards'].clear()
+
+    def test_cards(self):
+        """Cards are loaded once, and missing users are left out"""
+        with app.test_request_context():
+            cards = user_cards([1, 999])
+            self.assertEqual(list(cards), [1])
+            self.assertEqual(cards[1].username, 'testuser1')
+
+            self.assertEqual(app.extensions['user_cards'].get_many([1]), cards)
+
+    def test_profile_invalidates(self):
+        """Editing a profile drops the user's card"""
+        with app.test_request_context():
+            user_cards([1])
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        client.post('/users/profile', data=dict(username='testuser1',
+                                                email='test1@test.com',
+                                                image_url='/new.png',
+                                                password='HASHED_PASSWORD'))
+
+        self.assertIsNone(app.extensions['user_cards'].get(1))
+        with app.test_request_context():
+            self.assertEqual(user_cards([1])[1].image_url, '/new.png')
+
+    def test_authors(self):
+        """Messages are paired with their authors' cards, and skipped when
+        the author is gone"""
+        messages = [Message(id=1, text="Hi", user_id=1),
+                    Message(id=2, text="Gone", user_id=999)]
+        with app.test_request_context():
+            paired = list(with_authors(messages))
+
+        self.assertEqual([(msg.text, card.username) for msg, card in paired],
+                         [("Hi", 'testuser1')])
+
+
+class MessageFragmentTestCase(TestCase):
+    """Tests the cached message fragments."""
+
+    @classmethod
+    def setUpClass(self):
+        """Adds sample data."""
+        db.create_all()
+
+        u1 = User.signup(
+            email="test1@test.com",
+            username="testuser1",
+            password="HASHED_PASSWORD",
+            image_url='null'
+        )
+        db.session.commit()
+
+        db.session.add(Message(text="Message1", timestamp='12/02/2021',
+                               user_id=u1.id))
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(self):
+        """Cleans up test **DB** after tests are complete"""
+        db.session.rollback()
+        db.drop_all()
+
+    def test_fragment_reused(self):
+        """A fragment is rendered once and then served from the cache"""
+        msg = Message.query.first()
+        cache = app.extensions['fragment_cache']
+        cache.clear()
+
+        with app.test_request_context():
+            html = message_fragment(msg)
+            self.assertIn('@testuser1', html)
+            self.assertIn('<p>Message1</p>', html)
+            self.assertEqual(len(cache), 1)
+
+            self.assertIs(message_fragment(msg), html)
+            self.assertEqual(len(cache), 1)
+
+    def test_profile_edit_invalidates(self):
+        """A new profile version makes the author's fragments re-render"""
+        msg = Message.query.first()
+
+        with app.test_request_context():
+            message_fragment(msg)
+
+            msg.user.username = 'renamed'
+            msg.user.profile_version += 1
+            db.session.commit()
+
+            self.assertIn('@renamed', message_fragment(msg))
+
+        msg.user.username = 'testuser1'
+        msg.user.profile_version += 1
+        db.session.commit()
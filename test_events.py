@@ -0,0 +1,111 @@
+"""Tests live timeline events"""
+import os
+from unittest import TestCase
+from models import db, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import app
+from events import Hub
+
+db.drop_all()
+
+class HubTestCase(TestCase):
+    """Test the in-process publish/subscribe hub."""
+
+    def test_dispatch(self):
+        hub = Hub(queue_size=10)
+        sub = hub.subscribe(['user:1', 'user:2'])
+
+        hub.dispatch('user:1', 'a')
+        hub.dispatch('user:3', 'b')
+        hub.dispatch('user:2', 'c')
+        self.assertEqual(sub.get(timeout=0), 'a')
+        self.assertEqual(sub.get(timeout=0), 'c')
+        self.assertIsNone(sub.get(timeout=0))
+
+        sub.close()
+        self.assertEqual(hub.subscriber_count('user:1'), 0)
+
+    def test_overflow(self):
+        hub = Hub(queue_size=2)
+        sub = hub.subscribe(['user:1'])
+
+        for n in range(5):
+            hub.dispatch('user:1', n)
+
+        self.assertTrue(sub.overflowed)
+        self.assertEqual(sub.get(timeout=0), 0)
+        self.assertEqual(sub.get(timeout=0), 1)
+        self.assertIsNone(sub.get(timeout=0))
+
+
+class EventStreamTestCase(TestCase):
+    """Test the SSE timeline endpoint."""
+
+    def login_for_test(self, client, username):
+        """Logs a user into the test enviornment"""
+        client.post('/login',
+                    data = dict(username=username, password="HASHED_PASSWORD", form='')
+                    )
+
+    @classmethod
+    def setUpClass(self):
+        """Create test client, adds sample data."""
+        db.create_all()
+
+        for n in (1, 2, 3):
+            User.signup(
+                email=f"test{n}@test.com",
+                username=f"testuser{n}",
+                password="HASHED_PASSWORD",
+                image_url='null'
+            )
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=2, user_following_id=1))
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(self):
+        """Cleans up test **DB** after tests are complete"""
+        db.session.rollback()
+        db.drop_all()
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['EVENTS_KEEPALIVE'] = 0.1
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['EVENTS_KEEPALIVE'] = 15
+
+    def test_requires_login(self):
+        resp = self.client.get('/stream/timeline')
+        self.assertEqual(resp.status_code, 401)
+
+    def test_timeline_events(self):
+        self.login_for_test(self.client, 'testuser1')
+        resp = self.client.get('/stream/timeline', buffered=False)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+
+        stream = iter(resp.response)
+        self.assertTrue(next(stream).startswith(b'retry:'))
+        self.assertEqual(next(stream), b': keepalive\n\n')
+
+        # testuser1 follows testuser2 but not testuser3
+        for username in ('testuser3', 'testuser2'):
+            with app.test_client() as author:
+                self.login_for_test(author, username)
+                author.post('/messages/new', data=dict(text=f"from {username}"))
+
+        event = next(stream).decode()
+        self.assertIn('event: messages_add', event)
+        self.assertIn('"user_id": 2', event)
+
+        events = app.extensions['events']
+        self.assertEqual(events['hub'].subscriber_count('user:2'), 1)
+        resp.close()
+        self.assertEqual(events['hub'].subscriber_count('user:2'), 0)
@@ -0,0 +1,117 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+import io
+import json
+import os
+import zipfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+
+db.drop_all()
+
+
+class ExportTestCase(TestCase):
+    """Tests /users/export."""
+
+    @classmethod
+    def setUpClass(self):
+        """Adds sample data."""
+        db.create_all()
+
+        for n in (1, 2):
+            User.signup(
+                email=f"test{n}@test.com",
+                username=f"testuser{n}",
+                password="HASHED_PASSWORD",
+                image_url='null'
+            )
+        db.session.commit()
+
+        for day in range(1, 6):
+            db.session.add(Message(text=f"Message{day}",
+                                   timestamp=f"12/0{day}/2021",
+                                   user_id=1))
+        db.session.add(Message(text="Theirs", timestamp="12/06/2021", user_id=2))
+        db.session.add(Follows(user_being_followed_id=2, user_following_id=1))
+        db.session.commit()
+        db.session.add(Likes(user_id=1, message_id=6))
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(self):
+        """Cleans up test **DB** after tests are complete"""
+        db.session.rollback()
+        db.drop_all()
+
+    def get(self, url):
+        """The response to `url`, closed like a server would once it's read"""
+        with self.client.get(url) as resp:
+            resp.get_data()
+        return resp
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['EXPORT_WRITE_SIZE'] = 100
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def test_ndjson(self):
+        resp = self.get('/users/export')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertIn('warbler-testuser1.ndjson',
+                      resp.headers['Content-Disposition'])
+
+        records = [json.loads(line) for line in resp.get_data().splitlines()]
+        self.assertEqual(records[0]['section'], 'profile')
+        self.assertEqual(records[0]['email'], 'test1@test.com')
+        self.assertNotIn('password', records[0])
+
+        sections = [record['section'] for record in records]
+        self.assertEqual(sections.count('messages'), 5)
+        self.assertEqual([record['text'] for record in records
+                          if record['section'] == 'likes'], ['Theirs'])
+        self.assertEqual([record['username'] for record in records
+                          if record['section'] == 'following'], ['testuser2'])
+        self.assertNotIn('followers', sections)
+
+    def test_zip(self):
+        resp = self.get('/users/export?format=zip')
+        self.assertEqual(resp.mimetype, 'application/zip')
+
+        with zipfile.ZipFile(io.BytesIO(resp.data)) as archive:
+            self.assertEqual(archive.namelist(), [
+                'profile.ndjson', 'messages.ndjson', 'likes.ndjson',
+                'following.ndjson', 'followers.ndjson'])
+            messages = archive.read('messages.ndjson').splitlines()
+            self.assertEqual(json.loads(messages[0])['text'], 'Message1')
+            self.assertEqual(archive.read('followers.ndjson'), b'')
+
+    def test_limits(self):
+        self.assertEqual(self.get('/users/export?format=tar').status_code, 400)
+
+        # exports hold their slot until they're closed
+        app.config['EXPORT_WRITE_SIZE'] = 1
+        running = [self.client.get('/users/export', buffered=False)
+                   for _ in range(app.config['EXPORT_CONCURRENCY'])]
+        resp = self.get('/users/export')
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn('Retry-After', resp.headers)
+
+        for resp in running:
+            resp.close()
+        self.assertEqual(self.get('/users/export').status_code, 200)
+
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+        self.assertEqual(self.get('/users/export').status_code, 302)
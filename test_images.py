@@ -0,0 +1,112 @@
+"""Image upload tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from PIL import Image
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+from images import image_src
+
+db.drop_all()
+
+
+def make_image(size=(800, 600), color='red', format='PNG'):
+    """An uploadable image file"""
+    data = io.BytesIO()
+    Image.new('RGB', size, color).save(data, format)
+    data.seek(0)
+    return data
+
+
+class ImagesTestCase(TestCase):
+    """Tests resizing, storing and serving uploaded images."""
+
+    @classmethod
+    def setUpClass(self):
+        """Stores uploads in a temporary directory."""
+        db.create_all()
+
+        self.image_dir = tempfile.mkdtemp()
+        self.original_dir = app.extensions['images']['dir']
+        app.extensions['images']['dir'] = self.image_dir
+
+    @classmethod
+    def tearDownClass(self):
+        """Cleans up test **DB** and uploads after tests are complete"""
+        app.extensions['images']['dir'] = self.original_dir
+        shutil.rmtree(self.image_dir)
+        db.session.rollback()
+        db.drop_all()
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+
+    def signup(self, n, image):
+        return self.client.post('/signup', data=dict(
+            username=f"testuser{n}", email=f"test{n}@test.com",
+            password="HASHED_PASSWORD", image=(image, 'me.png')))
+
+    def test_upload(self):
+        resp = self.signup(1, make_image())
+        self.assertEqual(resp.status_code, 302)
+
+        user = User.query.filter_by(username='testuser1').one()
+        self.assertRegex(user.image_url, r'^/media/[0-9a-f]{64}/card\.jpg$')
+
+        resp = self.client.get(image_src(user.image_url, 'thumb'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertNotIn('Cookie', resp.headers.get('Vary', ''))
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (96, 96))
+
+        # the same picture again is stored once
+        stored = os.listdir(self.image_dir)
+        self.signup(2, make_image())
+        other = User.query.filter_by(username='testuser2').one()
+        self.assertEqual(other.image_url, user.image_url)
+        self.assertEqual(os.listdir(self.image_dir), stored)
+
+    def test_header(self):
+        self.signup(3, make_image(color='blue'))
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = User.query.filter_by(username='testuser3').one().id
+
+        self.client.post('/users/profile', data=dict(
+            username='testuser3', email='test3@test.com',
+            password='HASHED_PASSWORD',
+            header_image=(make_image((3000, 2000), 'green', 'JPEG'), 'h.jpg')))
+
+        user = User.query.filter_by(username='testuser3').one()
+        self.assertRegex(user.header_image_url, r'^/media/[0-9a-f]{64}/header\.jpg$')
+        resp = self.client.get(user.header_image_url)
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (1500, 500))
+
+    def test_invalid(self):
+        resp = self.signup(4, io.BytesIO(b'not an image'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("isn&#39;t an image", resp.get_data(as_text=True))
+        self.assertIsNone(User.query.filter_by(username='testuser4').first())
+
+        self.assertEqual(self.client.get('/media/abc/thumb.jpg').status_code, 404)
+
+    def test_image_src(self):
+        digest = 'a' * 64
+        self.assertEqual(image_src(f"/media/{digest}/card.jpg", 'thumb'),
+                         f"/media/{digest}/thumb.jpg")
+        self.assertEqual(image_src('http://example.com/me.png', 'thumb'),
+                         'http://example.com/me.png')
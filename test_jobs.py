@@ -0,0 +1,231 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+import os
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+from jobs import (Worker, enqueue, handler, requeue_stale, run_next,
+                  run_pending)
+
+db.drop_all()
+
+ran = []
+
+
+@handler('test_record')
+def record(payload):
+    ran.append(payload['name'])
+
+
+@handler('test_fail', max_attempts=2)
+def fail(payload):
+    # written, then rolled back with the failed attempt
+    db.session.add(User(email='nobody@test.com', username='nobody',
+                        password='HASHED_PASSWORD'))
+    db.session.flush()
+    raise RuntimeError('nope')
+
+
+class JobsTestCase(TestCase):
+    """Tests the job queue and its workers."""
+
+    def setUp(self):
+        db.create_all()
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        del ran[:]
+
+        # jobs run in an app context, as they would in a worker
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        db.session.rollback()
+        db.drop_all()
+
+    def test_lanes_and_keys(self):
+        enqueue('test_record', dict(name='low'), lane='low')
+        enqueue('test_record', dict(name='default'), key='once')
+        enqueue('test_record', dict(name='again'), key='once')
+        enqueue('test_record', dict(name='high'), lane='high')
+        enqueue('test_record', dict(name='later'), delay=60)
+        db.session.commit()
+
+        self.assertEqual(run_pending(), 3)
+        self.assertEqual(ran, ['high', 'default', 'low'])
+        self.assertEqual(Job.query.filter_by(status='done').count(), 3)
+        self.assertEqual(Job.query.filter_by(status='queued').count(), 1)
+
+        # the key is still taken by the finished job
+        enqueue('test_record', dict(name='again'), key='once')
+        db.session.commit()
+        self.assertEqual(run_pending(), 0)
+
+    def test_retries(self):
+        enqueue('test_fail')
+        db.session.commit()
+
+        self.assertTrue(run_next())
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn('RuntimeError: nope', job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertIsNone(User.query.filter_by(username='nobody').first())
+
+        # not due again until the backoff is over
+        self.assertFalse(run_next())
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        self.assertTrue(run_next())
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+    def test_stale(self):
+        enqueue('test_record', dict(name='lost'))
+        db.session.commit()
+
+        job = Job.query.one()
+        job.status = 'running'
+        job.locked_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+
+        self.assertEqual(run_pending(), 0)
+        self.assertEqual(requeue_stale(60), 1)
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(ran, ['lost'])
+
+        # one that took its worker down on its last attempt isn't retried
+        enqueue('test_fail', key='crashing')
+        db.session.commit()
+        job = Job.query.filter_by(key='crashing').one()
+        job.status = 'running'
+        job.attempts = job.max_attempts
+        job.locked_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+
+        self.assertEqual(requeue_stale(60), 1)
+        job = Job.query.filter_by(key='crashing').one()
+        self.assertEqual((job.status, job.locked_at), ('failed', None))
+        self.assertIn('timed out', job.last_error)
+
+    def test_worker(self):
+        worker = Worker(app, 3)
+        worker.start()
+        try:
+            for n in range(10):
+                enqueue('test_record', dict(name=n))
+            db.session.commit()
+            worker.wake()
+
+            deadline = time.time() + 10
+            while len(ran) < 10 and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            worker.stop()
+
+        self.assertEqual(sorted(ran), list(range(10)))
+        db.session.expire_all()
+        self.assertEqual(Job.query.filter_by(status='done').count(), 10)
+
+    def test_routes(self):
+        client = app.test_client()
+        client.post('/signup', data=dict(username='testuser1',
+                                         email='test1@test.com',
+                                         password='HASHED_PASSWORD'))
+        user_id = User.query.filter_by(username='testuser1').one().id
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        client.post('/messages/new', data=dict(text="Hello #jobs"))
+        msg = Message.query.filter_by(text="Hello #jobs").one()
+        self.assertEqual(Job.query.filter_by(key=f"index_message:{msg.id}")
+                         .one().status, 'done')
+
+        client.post('/users/delete')
+        self.assertEqual(Job.query.filter_by(key=f"purge_user:{user_id}")
+                         .one().status, 'done')
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(user_id))
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_account_closed_before_purge(self):
+        app.config['JOBS_EAGER'] = False
+        app.config['JOBS_THREADS'] = 0
+        try:
+            client, other = app.test_client(), app.test_client()
+            client.post('/signup', data=dict(username='testuser1',
+                                             email='test1@test.com',
+                                             password='HASHED_PASSWORD'))
+            user_id = User.query.filter_by(username='testuser1').one().id
+            with other.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            friend = app.test_client()
+            friend.post('/signup', data=dict(username='testuser2',
+                                             email='test2@test.com',
+                                             password='HASHED_PASSWORD'))
+            friend_id = User.query.filter_by(username='testuser2').one().id
+            friend.post(f'/users/follow/{user_id}')
+            client.post(f'/users/follow/{friend_id}')
+
+            client.post('/users/delete')
+        finally:
+            app.config['JOBS_EAGER'] = None
+            app.config['JOBS_THREADS'] = 2
+
+        # the job hasn't run, but the account is already gone
+        self.assertEqual(Job.query.filter_by(key=f"purge_user:{user_id}")
+                         .one().status, 'queued')
+        self.assertFalse(User.authenticate('testuser1', 'HASHED_PASSWORD'))
+        self.assertIn('href="/login"', other.get('/').get_data(as_text=True))
+        self.assertEqual(other.get(f'/users/{user_id}').status_code, 404)
+
+        # nor is it among anyone's follows
+        for page in ('following', 'followers'):
+            html = friend.get(f'/users/{friend_id}/{page}').get_data(as_text=True)
+            self.assertNotIn(f'@~{user_id}', html)
+            data = friend.get(f'/api/v1/users/{friend_id}/{page}').json['data']
+            self.assertEqual(data, [])
+
+        # and its username and email can be signed up with again
+        resp = client.post('/signup', data=dict(username='testuser1',
+                                                email='test1@test.com',
+                                                password='HASHED_PASSWORD'))
+        self.assertEqual(resp.status_code, 302)
+
+    def test_closed_account_names_reserved(self):
+        client, squatter = app.test_client(), app.test_client()
+        client.post('/signup', data=dict(username='testuser1',
+                                         email='test1@test.com',
+                                         password='HASHED_PASSWORD'))
+        user_id = User.query.filter_by(username='testuser1').one().id
+
+        # the username and email the account will have once closed can't
+        # be signed up with first
+        resp = squatter.post('/signup', data=dict(
+            username=f"~{user_id}", email=f"{user_id}@Deleted.invalid",
+            password='HASHED_PASSWORD'))
+        html = resp.get_data(as_text=True)
+        self.assertIn("That username is reserved.", html)
+        self.assertIn("That e-mail is reserved.", html)
+        self.assertEqual(User.query.count(), 1)
+
+        resp = squatter.get(f"/api/v1/availability?username=~{user_id}")
+        self.assertFalse(resp.json['data']['username']['available'])
+
+        # so closing it always works
+        resp = client.post('/users/delete')
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNone(db.session.get(User, user_id))
@@ -221,4 +221,30 @@ class UserModelTestCase(TestCase):
         self.assertIn('404 Not Found', html)
         self.assertTrue(resp.status_code == 404)
         
-        
\ No newline at end of file
+        
+    ##############################################################################
+    
+    
+    
+    def test_show_message_conditional_get(self):
+        """Tests ETags and cache headers on the show message view"""
+
+        ### Tests when not logged in ###
+        resp = self.client.get('/messages/1')
+        etag = resp.headers['ETag']
+        
+        self.assertTrue(resp.status_code == 200)
+        self.assertIn('public', resp.headers['Cache-Control'])
+        
+        resp = self.client.get('/messages/1', headers={'If-None-Match': etag})
+        
+        self.assertTrue(resp.status_code == 304)
+        self.assertEqual(resp.get_data(as_text=True), '')
+        
+        ### Tests when logged in ###
+        self.login_for_test()
+        resp = self.client.get('/messages/1', headers={'If-None-Match': etag})
+        
+        self.assertTrue(resp.status_code == 200)
+        self.assertIn('private', resp.headers['Cache-Control'])
+        self.assertNotIn('ETag', resp.headers)
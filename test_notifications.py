@@ -0,0 +1,150 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Notification, NotificationEvent
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+from notifications import recount_unread
+
+db.drop_all()
+
+
+class NotificationsTestCase(TestCase):
+    """Tests aggregating follows and likes into notifications, and the
+    unread count."""
+
+    def setUp(self):
+        db.create_all()
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+
+        users = [User.signup(email=f"test{n}@test.com", username=f"testuser{n}",
+                             password="HASHED_PASSWORD", image_url='null')
+                 for n in range(1, 7)]
+        db.session.commit()
+        self.author, *self.others = [user.id for user in users]
+
+        messages = [Message(text=f"Warble {n}", user_id=self.author)
+                    for n in range(2)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.message_ids = [msg.id for msg in messages]
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def like(self, user_id, message_id):
+        self.login(user_id)
+        self.client.post(f"/users/add_like/{message_id}")
+
+    def follow(self, user_id, followed_id):
+        self.login(user_id)
+        self.client.post(f"/users/follow/{followed_id}")
+
+    def unread(self):
+        return db.session.query(User.unread_notifications).filter(
+            User.id == self.author).scalar()
+
+    def test_aggregation(self):
+        first, second = self.message_ids
+        for user_id in self.others:
+            self.like(user_id, first)
+        self.like(self.others[0], second)
+        self.follow(self.others[0], self.author)
+        self.follow(self.others[1], self.author)
+        # nobody's told about their own likes
+        self.like(self.author, second)
+
+        self.assertEqual(NotificationEvent.query.count(), 8)
+        self.assertEqual(self.unread(), 3)
+
+        likes = Notification.query.filter_by(key=f"like:{first}").one()
+        self.assertEqual(likes.actor_count, 5)
+        # the newest first
+        self.assertEqual(likes.actor_ids, self.others[:1:-1])
+
+        # nor is one who's no longer among the newest
+        self.login(self.others[0])
+        self.client.post(f"/users/unlike/{first}")
+        self.like(self.others[0], first)
+        likes = Notification.query.filter_by(key=f"like:{first}").one()
+        self.assertEqual((likes.actor_count, likes.actor_ids[0]),
+                         (5, self.others[0]))
+
+        # liking again after unliking isn't counted twice
+        self.like(self.others[-1], second)
+        self.client.post(f"/users/unlike/{second}")
+        self.like(self.others[-1], second)
+        likes = Notification.query.filter_by(key=f"like:{second}").one()
+        self.assertEqual((likes.actor_count, likes.actor_ids),
+                         (2, [self.others[-1], self.others[0]]))
+
+        # follows and likes from the API are notified too
+        self.login(self.others[2])
+        self.client.post('/api/v1/batch', json=dict(operations=[
+            dict(op='follow', user_id=self.author),
+            dict(op='like', message_id=second),
+        ]))
+        follows = Notification.query.filter_by(key="follow").one()
+        self.assertEqual(follows.actor_count, 3)
+        self.assertEqual(self.unread(), 3)
+
+        recount_unread()
+        self.assertEqual(self.unread(), 3)
+
+    def test_inbox(self):
+        for user_id in self.others:
+            self.like(user_id, self.message_ids[0])
+        self.follow(self.others[0], self.author)
+
+        self.login(self.author)
+        html = self.client.get('/users/1').get_data(as_text=True)
+        self.assertIn('<span class="badge badge-primary">2</span>', html)
+
+        html = self.client.get('/notifications').get_data(as_text=True)
+        self.assertIn('>@testuser4</a> and 2 others liked', html)
+        self.assertIn("Warble 0", html)
+        self.assertIn('>@testuser2</a> followed you', html)
+        # the page shows them unread, and marks them read
+        self.assertEqual(html.count('notification unread'), 2)
+        self.assertIn('id="notifications-link"', html)
+        self.assertNotIn('badge-primary', html)
+        self.assertEqual(self.unread(), 0)
+
+        # the next follow starts a new notification
+        self.follow(self.others[1], self.author)
+        self.assertEqual(self.unread(), 1)
+        self.assertEqual(Notification.query.count(), 3)
+
+        self.login(self.author)
+        resp = self.client.get('/notifications?cursor=nonsense')
+        self.assertEqual(resp.status_code, 400)
+
+        resp = app.test_client().get('/notifications')
+        self.assertEqual(resp.location, "http://localhost/")
+
+    def test_deleted_message(self):
+        first, second = self.message_ids
+        self.like(self.others[0], first)
+        self.like(self.others[0], second)
+        self.assertEqual(self.unread(), 2)
+
+        self.login(self.author)
+        self.client.post(f"/messages/{first}/delete")
+        self.assertEqual(self.unread(), 1)
+        self.assertEqual(Notification.query.count(), 1)
+        self.assertEqual(NotificationEvent.query.count(), 1)
@@ -0,0 +1,132 @@
+"""Message partitioning and archiving tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import app
+from functions import recent_messages
+from partitions import (add_months, archive_partitions, month_start,
+                        partition_months, split_default)
+
+db.drop_all()
+
+
+class PartitionsTestCase(TestCase):
+    """Tests monthly partitions, pruning and archived messages."""
+
+    def setUp(self):
+        db.create_all()
+
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.archive_dir = tempfile.mkdtemp()
+
+        self.user = User.signup(email="test1@test.com", username="testuser1",
+                                password="HASHED_PASSWORD", image_url='null')
+        db.session.commit()
+        self.user_id = self.user.id
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+        db.session.rollback()
+        db.drop_all()
+
+    def add_message(self, text, timestamp):
+        msg = Message(text=text, timestamp=timestamp, user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+        return msg
+
+    def months(self):
+        return partition_months(db.session.connection())
+
+    def test_partitions(self):
+        this_month = month_start(datetime.utcnow())
+        self.assertEqual(self.months(), [this_month, add_months(this_month, 1),
+                                         add_months(this_month, 2)])
+
+        old = self.add_message("Old news", datetime(2021, 12, 1))
+        self.assertEqual(split_default(db.session.connection()),
+                         [datetime(2021, 12, 1).date()])
+        db.session.commit()
+        self.assertIn(datetime(2021, 12, 1).date(), self.months())
+        self.assertEqual(Message.query.get(old.id).text, "Old news")
+
+        # a recent page doesn't read the old partition
+        query = (Message.query
+                 .filter(Message.timestamp >= datetime.utcnow() - timedelta(days=31))
+                 .statement.compile(compile_kwargs=dict(literal_binds=True)))
+        plan = '\n'.join(db.session.execute(f"EXPLAIN {query}").scalars())
+        self.assertIn(f"messages_{this_month:%Y_%m}", plan)
+        self.assertNotIn("messages_2021_12", plan)
+
+        new = self.add_message("Fresh", datetime.utcnow())
+        self.assertEqual(recent_messages(Message.user_id == self.user.id, 1), [new])
+        self.assertEqual(recent_messages(Message.user_id == self.user.id, 5),
+                         [new, old])
+
+    def test_archive(self):
+        old = self.add_message("From the archive", datetime(2021, 12, 1))
+        new = self.add_message("Still here", datetime.utcnow())
+        db.session.add(Likes(user_id=self.user.id, message_id=old.id))
+        db.session.commit()
+        old_id, new_id = old.id, new.id
+        # detaching waits for every transaction reading messages
+        db.session.close()
+
+        with app.app_context():
+            archived = archive_partitions(12, self.archive_dir)
+        self.assertEqual(archived, ["messages_2021_12"])
+        self.assertEqual(os.listdir(self.archive_dir),
+                         ["messages_2021_12.jsonl.gz"])
+
+        self.assertIsNone(Message.query.get(old_id))
+        self.assertEqual([msg.id for msg in Message.query], [new_id])
+        self.assertEqual(User.query.get(self.user_id).likes, [])
+
+        resp = self.client.get(f"/messages/{old_id}")
+        self.assertEqual(resp.status_code, 200)
+        html = resp.get_data(as_text=True)
+        self.assertIn("From the archive", html)
+        self.assertIn("archived", html)
+        self.assertIn("@testuser1", html)
+
+        # the page's message was never added to the session
+        self.assertEqual(Message.query.count(), 1)
+
+        self.assertEqual(self.client.get(f"/messages/{new_id}").status_code, 200)
+        self.assertEqual(self.client.get("/messages/999").status_code, 404)
+
+        # an archived reply keeps its place in its thread
+        root = self.add_message("Old root", datetime(2021, 11, 1))
+        reply = self.add_message("Old reply", datetime(2021, 11, 2))
+        for name, value in root.reply_fields(reply.id).items():
+            setattr(reply, name, value)
+        late = self.add_message("Late reply", datetime.utcnow())
+        for name, value in reply.reply_fields(late.id).items():
+            setattr(late, name, value)
+        db.session.commit()
+        reply_id = reply.id
+        db.session.close()
+
+        with app.app_context():
+            self.assertEqual(archive_partitions(12, self.archive_dir),
+                             ["messages_2021_11"])
+        html = self.client.get(f"/messages/{reply_id}").get_data(as_text=True)
+        self.assertIn("Old reply", html)
+        self.assertIn("Late reply", html)
+
+        # running it again finds nothing more to archive
+        with app.app_context():
+            self.assertEqual(archive_partitions(12, self.archive_dir), [])
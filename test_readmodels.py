@@ -0,0 +1,105 @@
+"""Read model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_readmodels.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+from readmodels import (MessageRow, UserRow, user_profile, recent_message_rows,
+                        liked_message_rows, follower_rows, following_rows,
+                        user_rows)
+
+db.drop_all()
+
+
+class ReadModelsTestCase(TestCase):
+    """Tests the read models list pages are rendered from."""
+
+    def setUp(self):
+        db.create_all()
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+
+        users = [User.signup(email=f"test{n}@test.com", username=f"testuser{n}",
+                             password="HASHED_PASSWORD", image_url='null')
+                 for n in range(1, 4)]
+        db.session.commit()
+        self.u1, self.u2, self.u3 = [user.id for user in users]
+
+        now = datetime.utcnow()
+        messages = [Message(text=f"Warble {n}", user_id=self.u2,
+                            timestamp=now - timedelta(minutes=n))
+                    for n in range(3)]
+        db.session.add_all(messages)
+        db.session.add_all([
+            Follows(user_following_id=self.u1, user_being_followed_id=self.u2),
+            Follows(user_following_id=self.u3, user_being_followed_id=self.u2),
+        ])
+        db.session.commit()
+        self.message_ids = [msg.id for msg in messages]
+        db.session.add(Likes(user_id=self.u1, message_id=self.message_ids[1]))
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+
+    def test_rows(self):
+        with app.test_request_context():
+            db.session.expunge_all()
+
+            messages = recent_message_rows(Message.user_id == self.u2, 2)
+            self.assertEqual([msg.id for msg in messages], self.message_ids[:2])
+            self.assertIsInstance(messages[0], MessageRow)
+            self.assertFalse(hasattr(messages[0], '__dict__'))
+
+            self.assertEqual([msg.text for msg in liked_message_rows(self.u1)],
+                             ["Warble 1"])
+            self.assertEqual([user.id for user in follower_rows(self.u2)],
+                             [self.u1, self.u3])
+            self.assertEqual([user.username for user in following_rows(self.u1)],
+                             ["testuser2"])
+            self.assertEqual([user.id for user in user_rows("user3")], [self.u3])
+            self.assertIsInstance(user_rows()[0], UserRow)
+
+            profile = user_profile(self.u2)
+            self.assertEqual((profile.username, profile.message_count,
+                              profile.following_count, profile.follower_count,
+                              profile.like_count), ("testuser2", 3, 0, 2, 0))
+            self.assertIsNone(user_profile(999))
+
+            # nothing was loaded into the session
+            self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_pages(self):
+        resp = self.client.get(f"/users/{self.u2}/followers")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@testuser3", html)
+        # u1 follows u2 but not u3
+        self.assertIn(f'action="/users/stop-following/{self.u2}"', html)
+        self.assertIn(f'action="/users/follow/{self.u3}"', html)
+
+        resp = self.client.get(f"/users/{self.u1}/likes")
+        html = resp.get_data(as_text=True)
+        self.assertIn("Warble 1", html)
+        self.assertIn(f'action="/users/unlike/{self.message_ids[1]}"', html)
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn(f'<a href="/users/{self.u1}/following">1</a>', html)
+        self.assertIn(f'action="/users/add_like/{self.message_ids[0]}"', html)
+        self.assertIn(f'action="/users/unlike/{self.message_ids[1]}"', html)
+
+        self.assertEqual(self.client.get("/users/999/following").status_code, 404)
@@ -0,0 +1,131 @@
+"""Repost and home timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_reposts.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Repost
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+from reposts import home_timeline
+
+db.drop_all()
+
+
+class RepostsTestCase(TestCase):
+    """Tests reposting, and collapsing reposts on home timelines."""
+
+    def setUp(self):
+        db.create_all()
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+
+        users = [User.signup(email=f"test{n}@test.com", username=f"testuser{n}",
+                             password="HASHED_PASSWORD", image_url='null')
+                 for n in range(1, 8)]
+        db.session.commit()
+        self.viewer, self.author, *self.reposters = [user.id for user in users]
+        # the viewer follows everyone but testuser7
+        db.session.add_all([Follows(user_following_id=self.viewer,
+                                    user_being_followed_id=user_id)
+                            for user_id in [self.author, *self.reposters[:-1]]])
+
+        now = datetime.utcnow()
+        messages = [Message(text=f"Warble {n}", user_id=self.author,
+                            timestamp=now - timedelta(minutes=n))
+                    for n in range(10)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.message_ids = [msg.id for msg in messages]
+        self.followed = [self.author, *self.reposters[:-1]]
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+
+    def repost(self, user_id, message_id):
+        db.session.add(Repost(user_id=user_id, message_id=message_id))
+        db.session.commit()
+
+    def page(self, cursor=None, limit=3, batch_size=2):
+        timeline = home_timeline(self.followed, cursor, limit, batch_size)
+        entries = list(timeline)
+        return [entry.text for entry in entries], entries, timeline.next_cursor
+
+    def test_collapsing(self):
+        last = self.message_ids[-1]
+        for user_id in self.reposters:
+            self.repost(user_id, last)
+
+        with app.test_request_context():
+            texts, entries, _ = self.page(limit=2)
+            # once, at its newest repost by someone followed
+            self.assertEqual(texts, ["Warble 9", "Warble 0"])
+            self.assertEqual([card.username for card in entries[0].reposters],
+                             ["testuser6", "testuser5"])
+            self.assertEqual(entries[0].repost_count, 4)
+            self.assertEqual(entries[1].repost_count, 0)
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertEqual(html.count("<p>Warble 9</p>"), 1)
+        self.assertIn('>@testuser5</a> and 2 others', html)
+        self.assertIn(f'action="/messages/{self.message_ids[0]}/repost"', html)
+
+    def test_pagination_under_reposting(self):
+        with app.test_request_context():
+            first, _, cursor = self.page()
+            self.assertEqual(first, ["Warble 0", "Warble 1", "Warble 2"])
+
+            # meanwhile, one message already read and one not yet are
+            # reposted
+            self.repost(self.reposters[0], self.message_ids[1])
+            self.repost(self.reposters[0], self.message_ids[7])
+
+            second, _, cursor = self.page(cursor)
+            third, _, cursor = self.page(cursor)
+            fourth, _, cursor = self.page(cursor)
+            self.assertEqual(second, ["Warble 3", "Warble 4", "Warble 5"])
+            # Warble 7 moved to the top, and isn't shown again down here
+            self.assertEqual(third, ["Warble 6", "Warble 8", "Warble 9"])
+            self.assertEqual((fourth, cursor), ([], None))
+
+            self.assertEqual(self.page()[0],
+                             ["Warble 7", "Warble 1", "Warble 0"])
+
+            # a repost by someone not followed changes nothing
+            self.repost(self.reposters[-1], self.message_ids[5])
+            self.assertEqual(self.page(limit=4)[0],
+                             ["Warble 7", "Warble 1", "Warble 0", "Warble 2"])
+
+            self.assertEqual(list(home_timeline([])), [])
+
+    def test_routes(self):
+        message_id = self.message_ids[3]
+        resp = self.client.post(f"/messages/{message_id}/repost")
+        self.assertEqual(resp.location, f"http://localhost/messages/{message_id}")
+        self.client.post(f"/messages/{message_id}/repost")
+        self.assertEqual(Repost.query.filter_by(user_id=self.viewer).count(), 1)
+
+        self.client.post(f"/messages/{message_id}/unrepost")
+        self.assertEqual(Repost.query.count(), 0)
+
+        self.assertEqual(self.client.post("/messages/999/repost").status_code, 404)
+
+        # deleting a message deletes its reposts
+        self.repost(self.reposters[0], message_id)
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author
+        self.client.post(f"/messages/{message_id}/delete")
+        self.assertEqual(Repost.query.count(), 0)
+
+        self.assertEqual(self.client.get('/?cursor=nonsense').status_code, 400)
@@ -0,0 +1,260 @@
+"""Sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_shards.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import select, update
+
+from models import db, User, Message, Likes, Notification, UserShard
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app, create_app
+from partitions import archive_partitions
+from shards import (ID_STRIDE, create_database, drop_shards, find_message,
+                    move_user, plan_rebalance, prepare_shards, rebalance,
+                    shard_engine, shard_loads, stream_user_message_rows,
+                    timeline_rows, user_shard)
+
+db.drop_all()
+
+SHARD_URL = "postgresql:///twitter_db_test_shard1"
+
+
+class ShardsTestCase(TestCase):
+    """Tests routing messages to shards, and moving users between them."""
+
+    @classmethod
+    def setUpClass(self):
+        create_database(SHARD_URL)
+        self.app = create_app(dict(
+            SQLALCHEMY_DATABASE_URI=app.config['SQLALCHEMY_DATABASE_URI'],
+            SHARD_URLS=[SHARD_URL], TESTING=True, WTF_CSRF_ENABLED=False))
+
+    def setUp(self):
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        prepare_shards()
+
+        self.client = self.app.test_client()
+        self.user_ids = []
+        for n in range(1, 5):
+            self.client.post('/signup', data=dict(username=f"testuser{n}",
+                                                  email=f"test{n}@test.com",
+                                                  password="HASHED_PASSWORD"))
+            self.user_ids.append(
+                User.query.filter_by(username=f"testuser{n}").one().id)
+        # ids 1 to 4: the even ones on the main database, the odd on shard 1
+        self.u1, self.u2, self.u3, self.u4 = self.user_ids
+
+    def tearDown(self):
+        db.session.rollback()
+        drop_shards()
+        db.drop_all()
+        db.session.remove()
+        self.context.pop()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, user_id, text):
+        self.login(user_id)
+        self.client.post('/messages/new', data=dict(text=text))
+
+    def shard_texts(self, shard):
+        with shard_engine(shard).connect() as connection:
+            return sorted(connection.execute(
+                select(Message.text)).scalars())
+
+    def test_routing(self):
+        self.assertEqual([user_shard(user_id) for user_id in self.user_ids],
+                         [1, 0, 1, 0])
+
+        self.post(self.u1, "One")
+        self.post(self.u2, "Two")
+        self.post(self.u3, "Three")
+        self.assertEqual(self.shard_texts(0), ["Two"])
+        self.assertEqual(self.shard_texts(1), ["One", "Three"])
+
+        # each shard's ids leave its own remainder
+        shard, msg = find_message(
+            Message.query.filter_by(text="Two").one().id)
+        self.assertEqual((shard, msg.id % ID_STRIDE), (0, 0))
+        with shard_engine(1).connect() as connection:
+            one_id = connection.execute(
+                select(Message.id).where(Message.text == "One")).scalar()
+        shard, msg = find_message(one_id)
+        self.assertEqual((shard, msg.text, msg.user.username, one_id % ID_STRIDE),
+                         (1, "One", "testuser1", 1))
+
+        html = self.client.get(f"/users/{self.u1}").get_data(as_text=True)
+        self.assertIn("One", html)
+        self.assertIn(f'<a href="/users/{self.u1}">1</a>', html)
+        # and streamed off a cursor on the user's shard
+        self.assertEqual([msg.text for msg
+                          in stream_user_message_rows(self.u1, 100, 1)], ["One"])
+        self.assertIn("One", self.client.get(f"/messages/{one_id}")
+                                  .get_data(as_text=True))
+
+        # a timeline gathered from both shards, newest first
+        self.login(self.u4)
+        for user_id in (self.u1, self.u2, self.u3):
+            self.client.post(f"/users/follow/{user_id}")
+        self.assertEqual([msg.text for msg in timeline_rows(self.user_ids[:3], 2)],
+                         ["Three", "Two"])
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertLess(html.index("Three"), html.index("Two"))
+        self.assertLess(html.index("Two"), html.index("One"))
+
+        # likes and deletes find the message on its shard
+        self.client.post(f"/users/add_like/{one_id}")
+        self.assertEqual(Likes.query.filter_by(message_id=one_id).count(), 1)
+        self.login(self.u1)
+        self.client.post(f"/messages/{one_id}/delete")
+        self.assertEqual(self.shard_texts(1), ["Three"])
+        self.assertEqual(Likes.query.filter_by(message_id=one_id).count(), 0)
+
+        # deleting an account purges its shard too
+        self.login(self.u3)
+        self.client.post('/users/delete')
+        self.assertEqual(self.shard_texts(1), [])
+
+    def test_moving(self):
+        self.post(self.u1, "One")
+        self.post(self.u2, "Two")
+        self.post(self.u2, "Again")
+
+        self.assertEqual(move_user(self.u2, 1), 2)
+        self.assertEqual(user_shard(self.u2), 1)
+        self.assertEqual(self.shard_texts(0), [])
+        self.assertEqual(self.shard_texts(1), ["Again", "One", "Two"])
+        self.assertIn("Again", self.client.get(f"/users/{self.u2}")
+                                          .get_data(as_text=True))
+
+        # and back to the main database, where posting still works
+        self.assertEqual(move_user(self.u2, 0), 2)
+        self.post(self.u2, "Back")
+        self.assertEqual(self.shard_texts(0), ["Again", "Back", "Two"])
+        self.assertEqual(self.shard_texts(1), ["One"])
+        self.assertEqual(move_user(self.u2, 0), 0)
+
+        # rebalancing evens the shards out: 4 messages to 1, then 3 to 2
+        self.post(self.u4, "Four")
+        moves = rebalance(tolerance=1)
+        self.assertEqual(moves, [(self.u4, 0, 1)])
+        self.assertEqual({shard: sum(counts.values())
+                          for shard, counts in shard_loads().items()},
+                         {0: 3, 1: 2})
+        self.assertEqual(UserShard.query.get(self.u4).shard, 1)
+
+    def test_threads(self):
+        self.post(self.u2, "Root")
+        root_id = Message.query.filter_by(text="Root").one().id
+
+        # replies from both shards, each on its author's
+        self.login(self.u1)
+        self.client.post('/messages/new', data=dict(text="Odd", parent_id=root_id))
+        shard, odd = find_message(
+            [msg.id for msg in timeline_rows([self.u1], 1)][0])
+        self.assertEqual((shard, odd.parent_id, odd.thread_id), (1, root_id, root_id))
+        self.login(self.u4)
+        self.client.post('/messages/new', data=dict(text="Even", parent_id=odd.id))
+        self.assertEqual(self.shard_texts(0), ["Even", "Root"])
+
+        html = self.client.get(f"/messages/{root_id}").get_data(as_text=True)
+        self.assertLess(html.index("Odd"), html.index("Even"))
+        html = self.client.get(f"/messages/{odd.id}").get_data(as_text=True)
+        self.assertLess(html.index("Root"), html.index("Odd"))
+        self.assertIn("Even", html)
+
+    def test_everything_reads_every_shard(self):
+        """Tests that tags, likes pages, the API, the batch endpoint, page
+        validators and exports find messages on a non-main shard"""
+
+        self.post(self.u1, "Hello #sharded @testuser2")
+        self.assertEqual(self.shard_texts(1), ["Hello #sharded @testuser2"])
+        with shard_engine(1).connect() as connection:
+            message_id = connection.execute(select(Message.id)).scalar()
+
+        # indexed by the job, though it isn't on the main database
+        self.assertIn("Hello", self.client.get("/tags/sharded")
+                                          .get_data(as_text=True))
+        self.assertIn("Hello", self.client.get("/mentions/testuser2")
+                                          .get_data(as_text=True))
+
+        self.login(self.u4)
+        resp = self.client.post('/api/v1/batch', json=dict(operations=[
+            dict(op='like', message_id=message_id),
+            dict(op='follow', user_id=self.u1),
+        ]))
+        self.assertEqual([r['status'] for r in resp.json['results']],
+                         ['ok', 'ok'])
+        self.assertEqual(Notification.query.filter_by(
+            user_id=self.u1, key=f"like:{message_id}").count(), 1)
+
+        self.assertIn("Hello", self.client.get(f"/users/{self.u4}/likes")
+                                          .get_data(as_text=True))
+
+        for path in ("/api/v1/timeline", f"/api/v1/users/{self.u1}/messages",
+                     f"/api/v1/users/{self.u4}/likes"):
+            data = self.client.get(path).json['data']
+            self.assertEqual([(item['id'], item['username']) for item in data],
+                             [(message_id, "testuser1")], path)
+        profile = self.client.get(f"/api/v1/users/{self.u1}").json['data']
+        self.assertEqual(profile['messages_count'], 1)
+
+        # the page of a message on a shard is validated like any other
+        anonymous = self.app.test_client()
+        etag = anonymous.get(f"/messages/{message_id}").headers['ETag']
+        self.assertEqual(anonymous.get(f"/messages/{message_id}",
+                                       headers={'If-None-Match': etag})
+                         .status_code, 304)
+
+        lines = self.client.get('/users/export').get_data(as_text=True)
+        self.assertIn('"section":"likes","message_id":%d,"text":"Hello'
+                      % message_id, lines.replace(' ', ''))
+        self.login(self.u1)
+        lines = self.client.get('/users/export').get_data(as_text=True)
+        self.assertIn('"section":"messages","id":%d' % message_id,
+                      lines.replace(' ', ''))
+
+    def test_archive_every_shard(self):
+        self.post(self.u1, "Old one")
+        self.post(self.u2, "Old two")
+        ids = {}
+        for shard, text in ((0, "Old two"), (1, "Old one")):
+            with shard_engine(shard).begin() as connection:
+                ids[text] = connection.execute(
+                    update(Message).where(Message.text == text)
+                    .values(timestamp='2021-12-01')
+                    .returning(Message.id)).scalar()
+        # detaching waits for every transaction reading messages
+        db.session.close()
+
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertEqual(archive_partitions(12, directory),
+                             ["messages_2021_12", "shard1_messages_2021_12"])
+            self.assertEqual(self.shard_texts(1), [])
+
+            for text, message_id in ids.items():
+                self.assertIn(text, self.client.get(f"/messages/{message_id}")
+                                        .get_data(as_text=True))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_plan_rebalance(self):
+        loads = {0: {1: 50, 2: 30, 3: 20}, 1: {4: 10}, 2: {}}
+        moves = plan_rebalance(loads, tolerance=10)
+        self.assertEqual(moves, [(1, 0, 2), (3, 0, 1)])
+        self.assertEqual(plan_rebalance(loads, tolerance=100), [])
+        # one user too big to move anywhere usefully
+        self.assertEqual(plan_rebalance({0: {1: 100}, 1: {}}, tolerance=10), [])
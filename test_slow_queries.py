@@ -0,0 +1,102 @@
+"""Slow query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slow_queries.py
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+from slow_queries import SlowQuery, SlowQueryLog, parameter_shapes
+
+db.drop_all()
+
+
+class SlowQueriesTestCase(TestCase):
+    """Tests recording slow queries and the admin page."""
+
+    def setUp(self):
+        db.create_all()
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+
+        self.user = User.signup(email="test1@test.com", username="testuser1",
+                                password="HASHED_PASSWORD", image_url='null')
+        db.session.commit()
+        self.user_id = self.user.id
+
+        # every query is slow, and every slow SELECT explained
+        self.config = {name: app.config[name] for name in
+                       ('ADMINS', 'SLOW_QUERY_THRESHOLD', 'SLOW_QUERY_EXPLAIN_RATE')}
+        app.config.update(ADMINS=['testuser1'], SLOW_QUERY_THRESHOLD=0,
+                          SLOW_QUERY_EXPLAIN_RATE=1)
+        self.log = app.extensions['slow_queries']
+        self.log.clear()
+
+    def tearDown(self):
+        app.config.update(self.config)
+        db.session.rollback()
+        db.drop_all()
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_recording(self):
+        self.login()
+        self.client.get(f"/users/{self.user_id}")
+
+        queries = [query for query in self.log.recent()
+                   if query.route == 'GET /users/<int:user_id>']
+        self.assertTrue(queries)
+        for query in queries:
+            self.assertGreaterEqual(query.duration_ms, 0)
+            self.assertIn('Scan', query.plan)
+
+        # the profile lookup, with its parameter's type but not its value
+        lookup = [query for query in queries if 'count(' in query.statement][0]
+        self.assertEqual(lookup.parameters, {'id_1': 'int'})
+
+        # writes aren't explained, and the transaction carries on
+        self.log.clear()
+        self.client.post('/messages/new', data=dict(text="Slow"))
+        insert = [query for query in self.log.recent()
+                  if query.statement.startswith('INSERT INTO messages')][0]
+        self.assertIsNone(insert.plan)
+        self.assertEqual(insert.parameters['text'], 'str[4]')
+
+        # outside a request, the thread's name stands in for the route
+        self.log.clear()
+        User.query.count()
+        self.assertEqual(self.log.recent()[0].route, 'MainThread')
+
+    def test_ring_buffer(self):
+        log = SlowQueryLog(2)
+        for n in range(3):
+            log.add(SlowQuery(f"SELECT {n}", [], n, 'test'))
+        self.assertEqual([query.statement for query in log.recent()],
+                         ["SELECT 2", "SELECT 1"])
+        self.assertEqual(len(log), 2)
+
+        self.assertEqual(parameter_shapes([dict(a=1), dict(a=2)], True),
+                         dict(rows=2, first=dict(a='int')))
+        self.assertEqual(parameter_shapes((None, b'xy', [1, 2, 3])),
+                         ['None', 'bytes[2]', 'list[3]'])
+
+    def test_admin_page(self):
+        resp = self.client.get('/admin/slow-queries')
+        self.assertEqual(resp.status_code, 302)
+
+        self.login()
+        html = self.client.get('/admin/slow-queries').get_data(as_text=True)
+        self.assertIn("Slow queries", html)
+        self.assertIn("GET /admin/slow-queries", html)
+
+        app.config['ADMINS'] = []
+        self.assertEqual(self.client.get('/admin/slow-queries').status_code, 302)
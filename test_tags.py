@@ -0,0 +1,102 @@
+"""Tests hashtags and mentions"""
+import os
+from unittest import TestCase
+from models import db, User, Message, MessageTag, Mention
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+from tags import backfill, extract_links, linkify, tag_timeline
+
+db.drop_all()
+
+class LinkTestCase(TestCase):
+    """Test finding tags and mentions in text."""
+
+    def test_extract_links(self):
+        tags, usernames = extract_links("#Flask and #flask, @testuser1! a#b x@y.com ##no")
+        self.assertEqual(tags, {'flask'})
+        self.assertEqual(usernames, {'testuser1'})
+
+    def test_linkify(self):
+        html = linkify("<b>#Python</b> & @testuser1")
+        self.assertEqual(html, '&lt;b&gt;<a href="/tags/python">#Python</a>&lt;/b&gt; '
+                               '&amp; <a href="/mentions/testuser1">@testuser1</a>')
+
+
+class TagViewsTestCase(TestCase):
+    """Test tag and mention timelines."""
+
+    @classmethod
+    def setUpClass(self):
+        """Create test client, adds sample data."""
+        db.create_all()
+
+        for n in (1, 2):
+            User.signup(
+                email=f"test{n}@test.com",
+                username=f"testuser{n}",
+                password="HASHED_PASSWORD",
+                image_url='null'
+            )
+        db.session.commit()
+
+        # posted before tags were indexed
+        for day in range(1, 6):
+            db.session.add(Message(text=f"Old #history {day} for @testuser2",
+                                   timestamp=f"11/0{day}/2021",
+                                   user_id=1))
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(self):
+        """Cleans up test **DB** after tests are complete"""
+        db.session.rollback()
+        db.drop_all()
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def test_post_indexes(self):
+        resp = self.client.post('/messages/new',
+                                data=dict(text="Hello #Warbler @testuser2 @nobody"))
+        self.assertEqual(resp.status_code, 302)
+
+        msg = Message.query.filter_by(text="Hello #Warbler @testuser2 @nobody").one()
+        self.assertEqual([t.tag for t in MessageTag.query.filter_by(message_id=msg.id)],
+                         ['warbler'])
+        self.assertEqual([m.user_id for m in Mention.query.filter_by(message_id=msg.id)],
+                         [2])
+
+        resp = self.client.get('/tags/WARBLER')
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('<a href="/tags/warbler">#Warbler</a>', html)
+
+        resp = self.client.get('/mentions/testuser2')
+        self.assertIn('Hello', resp.get_data(as_text=True))
+
+        self.assertEqual(self.client.get('/mentions/nobody').status_code, 404)
+
+    def test_backfill_and_pages(self):
+        with app.app_context():
+            self.assertEqual(backfill(batch_size=2), Message.query.count())
+            # running it again changes nothing
+            backfill(batch_size=2)
+        self.assertEqual(MessageTag.query.filter_by(tag='history').count(), 5)
+
+        with app.test_request_context():
+            page, cursor = tag_timeline('history', limit=3)
+            self.assertEqual([m.timestamp.day for m in page], [5, 4, 3])
+            page, cursor = tag_timeline('history', cursor, limit=3)
+            self.assertEqual([m.timestamp.day for m in page], [2, 1])
+            self.assertIsNone(cursor)
+
+        resp = self.client.get('/tags/history')
+        self.assertEqual(resp.get_data(as_text=True).count('Old #history'), 0)
+        self.assertEqual(resp.get_data(as_text=True).count('Old <a href="/tags/history">'), 5)
+        self.assertEqual(self.client.get('/tags/history?cursor=junk').status_code, 400)
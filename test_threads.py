@@ -0,0 +1,133 @@
+"""Reply thread tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_threads.py
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+from threads import ancestor_paths, conversation, conversation_statement
+
+db.drop_all()
+
+
+class ThreadsTestCase(TestCase):
+    """Tests replying to messages and reading conversations."""
+
+    def setUp(self):
+        db.create_all()
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+
+        users = [User.signup(email=f"test{n}@test.com", username=f"testuser{n}",
+                             password="HASHED_PASSWORD", image_url='null')
+                 for n in range(1, 3)]
+        db.session.commit()
+        self.u1, self.u2 = [user.id for user in users]
+
+        root = Message(text="Root", user_id=self.u1)
+        db.session.add(root)
+        db.session.commit()
+        self.root = root.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+
+    def reply(self, parent_id, text):
+        resp = self.client.post('/messages/new',
+                                data=dict(text=text, parent_id=parent_id))
+        self.assertEqual(resp.location, f"http://localhost/messages/{parent_id}")
+        msg = Message.query.filter_by(text=text).one()
+        db.session.expunge(msg)
+        return msg
+
+    def test_replies(self):
+        a = self.reply(self.root, "A")
+        b = self.reply(self.root, "B")
+        a1 = self.reply(a.id, "A1")
+        a1x = self.reply(a1.id, "A1x")
+
+        self.assertEqual((a1x.parent_id, a1x.thread_id, a1x.depth),
+                         (a1.id, self.root, 3))
+        self.assertEqual(a1x.path, '.'.join(f"{id:010d}" for id in
+                                            (self.root, a.id, a1.id, a1x.id)))
+        self.assertEqual(ancestor_paths(a1x.path), [a.path, a1.path])
+
+        with app.test_request_context():
+            root = Message.query.get(self.root)
+            thread = conversation(root)
+            self.assertEqual(thread.ancestors, [])
+            # depth first, every reply right after its parent
+            self.assertEqual([msg.text for msg in thread.replies],
+                             ["A", "A1", "A1x", "B"])
+            self.assertIsNone(thread.after)
+
+            thread = conversation(Message.query.get(a1.id))
+            self.assertEqual([msg.text for msg in thread.ancestors],
+                             ["Root", "A"])
+            self.assertEqual([msg.text for msg in thread.replies], ["A1x"])
+
+            # paged by path
+            first = conversation(root, limit=2)
+            self.assertEqual([msg.text for msg in first.replies], ["A", "A1"])
+            self.assertEqual(first.after, a1.path)
+            second = conversation(root, after=first.after, limit=2)
+            self.assertEqual([msg.text for msg in second.replies],
+                             ["A1x", "B"])
+            self.assertIsNone(second.after)
+
+        html = self.client.get(f"/messages/{a.id}").get_data(as_text=True)
+        self.assertIn('id="reply-form"', html)
+        self.assertLess(html.index("Root"), html.index(">A<"))
+        self.assertIn("A1x", html)
+        self.assertNotIn(">B<", html)
+
+        resp = self.client.post('/messages/new',
+                                data=dict(text="Lost", parent_id=999))
+        self.assertEqual(resp.location, "http://localhost/")
+
+    def test_one_index_scan(self):
+        a = self.reply(self.root, "A")
+        a1 = self.reply(a.id, "A1")
+
+        with app.test_request_context():
+            statement = conversation_statement(Message.query.get(a1.id))
+            compiled = statement.compile(
+                db.engine, compile_kwargs=dict(render_postcompile=True))
+            cursor = db.session.connection().connection.cursor()
+            cursor.execute("SET enable_seqscan = off")
+            cursor.execute(f"EXPLAIN {compiled}", compiled.params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            db.session.rollback()
+
+        # each partition's copy of ix_messages_thread_id_path
+        self.assertIn('thread_id_path', plan)
+        self.assertNotIn('Seq Scan', plan)
+
+    def test_conditional_get(self):
+        anonymous = app.test_client()
+        resp = anonymous.get(f"/messages/{self.root}")
+        etag = resp.headers['ETag']
+        self.assertEqual(anonymous.get(
+            f"/messages/{self.root}", headers={'If-None-Match': etag}).status_code,
+            304)
+
+        # a new reply changes the page
+        self.reply(self.root, "Late")
+        resp = anonymous.get(f"/messages/{self.root}",
+                             headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Late", resp.get_data(as_text=True))
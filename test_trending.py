@@ -0,0 +1,99 @@
+"""Tests trending terms"""
+import os
+from unittest import TestCase
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///twitter_db_test"
+
+from app import CURR_USER_KEY, app
+from trending import CountMinSketch, TopK, Trending, message_terms
+
+db.drop_all()
+
+HOUR = 60 * 60
+
+class TrendingTestCase(TestCase):
+    """Test the sketches and windows behind trending terms."""
+
+    def test_message_terms(self):
+        self.assertEqual(message_terms("Loving #Flask with @someone, Flask rocks!"),
+                         {'#flask', 'loving', 'flask', 'rocks'})
+
+    def test_sketch_never_undercounts(self):
+        sketch = CountMinSketch(width=64, depth=4)
+        counts = {f"term{n}": n % 7 + 1 for n in range(200)}
+        for term, count in counts.items():
+            sketch.add(sketch.indexes(term), count)
+
+        for term, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(sketch.indexes(term)), count)
+
+    def test_top_k(self):
+        top = TopK(2)
+        for term, count in [('a', 1), ('b', 2), ('c', 3), ('a', 4), ('b', 1)]:
+            top.offer(term, count)
+
+        self.assertEqual(top.items(), [('a', 4), ('c', 3)])
+
+    def test_windows(self):
+        trending = Trending(width=256, depth=4, k=5)
+        start = 1_000_000 * HOUR
+
+        trending.record("#old news", now=start)
+        for _ in range(3):
+            trending.record("#fresh news", now=start + 2 * HOUR)
+
+        now = start + 2 * HOUR
+        self.assertEqual(trending.top('1h', now=now), [('#fresh', 3), ('news', 3)])
+        self.assertEqual(trending.top('24h', now=now),
+                         [('news', 4), ('#fresh', 3), ('#old', 1)])
+
+        self.assertEqual(trending.top('24h', now=start + 25 * HOUR),
+                         [('#fresh', 3), ('news', 3)])
+        self.assertEqual(trending.top('24h', now=start + 30 * HOUR), [])
+        self.assertEqual(trending.top('7d', now=start + 30 * HOUR)[0], ('news', 4))
+
+    def test_fixed_memory(self):
+        trending = Trending(width=64, depth=2, k=3)
+        for n in range(2000):
+            trending.record(f"#tag{n % 50} #tag{n % 7}", now=n * 600)
+
+        for window in trending.windows.values():
+            self.assertLessEqual(len(window.buckets), 28)
+            self.assertLessEqual(len(window.top.counts), 3)
+            self.assertLessEqual(len(window.top._heap), 12)
+
+
+class TrendingPanelTestCase(TestCase):
+    """Test the trending panel on the homepage."""
+
+    @classmethod
+    def setUpClass(self):
+        """Create test client, adds sample data."""
+        db.create_all()
+        User.signup(
+            email="test1@test.com",
+            username="testuser1",
+            password="HASHED_PASSWORD",
+            image_url='null'
+        )
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(self):
+        """Cleans up test **DB** after tests are complete"""
+        db.session.rollback()
+        db.drop_all()
+
+    def test_panel(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+        client.post('/messages/new', data=dict(text="Trying out #trendingtest"))
+
+        html = client.get('/').get_data(as_text=True)
+        self.assertIn('Trending now', html)
+        self.assertIn('<a href="/tags/trendingtest">#trendingtest</a>', html)
@@ -1,5 +1,6 @@
 """Tests User Views"""
 import os
+import gzip
 import flask
 from flask import session
 from unittest import TestCase
@@ -574,4 +575,104 @@ class UserModelTestCase(TestCase):
         
         
         
-        
\ No newline at end of file
+    ##############################################################################
+    
+    
+    
+    def test_user_profile_conditional_get(self):
+        """Tests ETags on the user profile view"""
+
+        resp = self.client.get('/users/3')
+        etag = resp.headers['ETag']
+        
+        self.assertTrue(resp.status_code == 200)
+        self.assertIn('public', resp.headers['Cache-Control'])
+        
+        resp = self.client.get('/users/3', headers={'If-None-Match': etag})
+        
+        self.assertTrue(resp.status_code == 304)
+        
+        ### Losing a follower changes the page ###
+        ### (testuser1 follows testuser3 since *test_user_add_follow_view*) ###
+        self.login_for_test()
+        self.client.post('/users/stop-following/3')
+        self.client.post('/logout', follow_redirects=True)
+        resp = self.client.get('/users/3', headers={'If-None-Match': etag})
+        
+        self.assertTrue(resp.status_code == 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        
+        self.login_for_test()
+        self.client.post('/users/follow/3')
+        
+        ### Tests for non existent user ###
+        resp = self.client.get('/users/60')
+
+        self.assertTrue(resp.status_code == 404)
+        self.assertIn('no-store', resp.headers['Cache-Control'])
+        
+        
+        
+    ##############################################################################
+    
+    
+    
+    def test_streamed_pages(self):
+        """Tests the homepage and user profile in streaming mode"""
+        app.config['STREAM_TEMPLATES'] = True
+        self.login_for_test()
+        
+        try:
+            resp = self.client.get('/')
+            html = resp.get_data(as_text=True)
+            
+            self.assertNotIn('Content-Length', resp.headers)
+            self.assertIn('Hello, testuser1!', html)
+            self.assertIn('<p>Message3</p>', html)
+            
+            resp = self.client.get('/users/1')
+            html = resp.get_data(as_text=True)
+            
+            self.assertNotIn('Content-Length', resp.headers)
+            self.assertNotIn('Hello, testuser1!', html)
+            self.assertIn('<p>Message1</p>', html)
+        finally:
+            app.config['STREAM_TEMPLATES'] = False
+        
+        
+        
+    ##############################################################################
+    
+    
+    
+    def test_compressed_responses(self):
+        """Tests gzip compression of buffered and streamed pages"""
+        stats = app.extensions['compression']
+        responses = stats.responses
+        
+        resp = self.client.get('/users/1', headers={'Accept-Encoding': 'gzip'})
+        html = gzip.decompress(resp.get_data()).decode()
+        
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn('<p>Message1</p>', html)
+        self.assertTrue(resp.headers['ETag'].startswith('W/'))
+        
+        ### Streamed pages ###
+        app.config['STREAM_TEMPLATES'] = True
+        try:
+            resp = self.client.get('/users/1', headers={'Accept-Encoding': 'gzip'})
+            html = gzip.decompress(resp.get_data()).decode()
+        finally:
+            app.config['STREAM_TEMPLATES'] = False
+        
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('<p>Message1</p>', html)
+        self.assertEqual(stats.responses, responses + 2)
+        self.assertLess(stats.ratio, 1)
+        
+        ### Without Accept-Encoding ###
+        resp = self.client.get('/users/1')
+        
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn('<p>Message1</p>', resp.get_data(as_text=True))
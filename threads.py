@@ -0,0 +1,131 @@
+"""Reply threads.
+
+A reply stores its parent's id, the id of the message at the top of its
+thread, and its path: the ids from the top of the thread down to its own
+(see Message.path). So everything /messages/<id> shows of a conversation
+comes out of the index on (thread_id, path):
+
+- the messages it replies to are the ones whose paths are prefixes of
+  its own, and the top of the thread, found by id;
+- the replies under it, all the way down, are the paths that start with
+  its own and a dot. In path order that's depth first, every reply right
+  after its parent.
+
+Both are read by one statement, with the replies a page of
+THREAD_PAGE_SIZE at a time. The next page starts after the last path
+shown, so it's one more index range scan however deep into a thread of
+tens of thousands of replies it is; nothing walks the tree a message at a
+time.
+
+With shards, replies live on their authors' shards, so the statement runs
+on every shard at once and the results are merged by path.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import func, select, union_all
+
+from models import Message
+from readmodels import ReadModel
+from shards import each_shard
+
+THREAD_PAGE_SIZE = 50
+
+
+class ThreadRow(ReadModel):
+    """A message in a conversation."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id', 'parent_id', 'path')
+    columns = (Message.id, Message.text, Message.timestamp, Message.user_id,
+               Message.parent_id, Message.path)
+
+    thread_path = Message.thread_path
+    depth = Message.depth
+
+
+# `ancestors` top of the thread first, `replies` depth first; `after` is
+# the path to pass back for the next page of replies, None on the last
+Conversation = namedtuple('Conversation', ['ancestors', 'replies', 'after'])
+
+
+def ancestor_paths(path):
+    """The paths of the replies above the one at `path` (not the top of
+    the thread, which has none)."""
+
+    segments = path.split('.')
+    return ['.'.join(segments[:n]) for n in range(2, len(segments))]
+
+
+def conversation_statement(msg, after=None, limit=THREAD_PAGE_SIZE):
+    """The statement for `msg`'s ancestors and the first `limit` + 1 of
+    its replies after path `after`."""
+
+    thread_id, path = msg.thread_root_id, msg.thread_path
+    statements = []
+
+    # replies are posted after what they reply to, so the timestamps keep
+    # each part to the partitions that can hold it
+    if msg.parent_id is not None:
+        statements.append(ThreadRow.select().where(
+            Message.id == thread_id,
+            Message.timestamp <= msg.timestamp))
+        prefixes = ancestor_paths(path)
+        if prefixes:
+            statements.append(ThreadRow.select().where(
+                Message.thread_id == thread_id,
+                Message.path.in_(prefixes),
+                Message.timestamp <= msg.timestamp))
+
+    # '/' is the byte after '.'
+    start = max(after or '', f"{path}.")
+    statements.append(ThreadRow.select()
+                      .where(Message.thread_id == thread_id,
+                             Message.path > start,
+                             Message.path < f"{path}/",
+                             Message.timestamp >= msg.timestamp)
+                      .order_by(Message.path)
+                      .limit(limit + 1))
+
+    if len(statements) == 1:
+        return statements[0]
+    return union_all(*statements)
+
+
+def conversation(msg, after=None, limit=THREAD_PAGE_SIZE):
+    """The Conversation around `msg` (a Message from any shard), with a
+    page of `limit` replies after path `after`."""
+
+    rows = each_shard(conversation_statement(msg, after, limit))
+
+    below = f"{msg.thread_path}."
+    ancestors, replies = [], []
+    for row in rows:
+        row = ThreadRow(*row)
+        (replies if row.path and row.path.startswith(below)
+         else ancestors).append(row)
+
+    ancestors.sort(key=lambda row: row.thread_path)
+    replies.sort(key=lambda row: row.path)
+
+    after = replies[limit - 1].path if len(replies) > limit else None
+    return Conversation(ancestors, replies[:limit], after)
+
+
+def reply_stats(thread_id):
+    """(count, newest id) of the replies in thread `thread_id`, on every
+    shard; read off the index alone."""
+
+    rows = each_shard(select(func.count(Message.id), func.max(Message.id))
+                      .where(Message.thread_id == thread_id))
+    return (sum(count for count, _ in rows),
+            max((newest for _, newest in rows if newest is not None),
+                default=None))
+
+
+def thread_page_version(version):
+    """A functions.message_page_version that also changes whenever a reply
+    is added to or deleted from the message's thread."""
+
+    if version is None:
+        return None
+    return (*version, *reply_stats(version[-1]))
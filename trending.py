@@ -0,0 +1,260 @@
+"""Trending topics.
+
+Every posted message adds one to the count of each of its terms (its
+#tags and its longer words) in three sliding windows: the last hour, day
+and week. Nothing is ever read back from the database; each window keeps
+
+- a ring of time buckets, each a count-min sketch of the counts seen in
+  that stretch of time, plus a running total sketch of the whole window;
+  a bucket that slides out of the window is subtracted from the total
+  and reused for the next stretch;
+- a top-k table of the terms with the highest estimated counts, kept up
+  to date as messages come in, which is what the homepage reads.
+
+So memory depends only on the sketch size, bucket count and k, never on
+how much gets posted, and reads cost O(k). Counts are estimates: a
+count-min sketch never undercounts, and overcounts by at most about
+2/TRENDING_WIDTH of a window's total with high probability.
+
+Trending is per process: the sketches live in the worker's memory, so
+each worker counts only the messages posted through it, and starts empty
+when it starts. With several workers the homepage panel shows whichever
+worker served the page's share of the trend; that's close enough for
+spotting what's popular, but it isn't a site-wide count. Sharing one would
+mean moving the sketches into a shared store (Postgres, or the cache
+server in caching.py), with a round trip on every post.
+"""
+
+import hashlib
+import re
+import time
+from array import array
+from collections import deque
+from heapq import heapify, heappop, heappush
+from threading import Lock
+
+from flask import current_app
+
+from tags import LINK_RE
+
+# name: (span in seconds, number of buckets)
+WINDOWS = {
+    '1h': (60 * 60, 12),
+    '24h': (24 * 60 * 60, 24),
+    '7d': (7 * 24 * 60 * 60, 28),
+}
+
+WORD_RE = re.compile(r"\b[a-z]{4,20}\b")
+
+STOPWORDS = frozenset('''
+    about after again also been before being could does doing down each
+    even every from have having here just know like made make many more
+    most much must only other over really same should some such than that
+    their them then there these they this those through today very want
+    well were what when where which while will with would your yours
+    '''.split())
+
+
+def message_terms(text):
+    """The terms `text` counts towards: its #tags, and its other words of
+    four letters or more that aren't too common to mean anything."""
+
+    terms = {f"#{name.lower()}" for sigil, name in LINK_RE.findall(text)
+             if sigil == '#'}
+
+    words = WORD_RE.findall(LINK_RE.sub(' ', text).lower())
+    terms.update(word for word in words if word not in STOPWORDS)
+
+    return terms
+
+
+class CountMinSketch:
+    """Approximate counts of terms in `depth` rows of `width` counters."""
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('q', bytes(8 * width)) for _ in range(depth)]
+
+    def indexes(self, term):
+        """The counter `term` maps to in each row."""
+
+        digest = hashlib.blake2b(term.encode('UTF-8'),
+                                 digest_size=8 * self.depth).digest()
+        return [int.from_bytes(digest[8 * i:8 * i + 8], 'little') % self.width
+                for i in range(self.depth)]
+
+    def add(self, indexes, count=1):
+        """Add `count` at `indexes`; returns the new estimate."""
+
+        for row, i in zip(self.rows, indexes):
+            row[i] += count
+        return self.estimate(indexes)
+
+    def estimate(self, indexes):
+        return min(row[i] for row, i in zip(self.rows, indexes))
+
+    def subtract(self, other):
+        """Take away all the counts of `other` (a sketch of the same shape)."""
+
+        for row, other_row in zip(self.rows, other.rows):
+            for i, count in enumerate(other_row):
+                if count:
+                    row[i] -= count
+
+    def clear(self):
+        for row in self.rows:
+            row[:] = array('q', bytes(8 * self.width))
+
+
+class TopK:
+    """The `k` terms with the highest counts offered so far."""
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        # min-heap of (count, term); entries whose count is out of date are
+        # skipped when they come up, and the heap is rebuilt when there get
+        # to be too many of them
+        self._heap = []
+
+    def offer(self, term, count):
+        if term in self.counts or len(self.counts) < self.k:
+            self.counts[term] = count
+        else:
+            lowest, lowest_term = self._lowest()
+            if count <= lowest:
+                return
+            heappop(self._heap)
+            del self.counts[lowest_term]
+            self.counts[term] = count
+
+        heappush(self._heap, (count, term))
+        if len(self._heap) > 4 * self.k:
+            self._rebuild()
+
+    def _lowest(self):
+        while True:
+            count, term = self._heap[0]
+            if self.counts.get(term) == count:
+                return count, term
+            heappop(self._heap)
+
+    def _rebuild(self):
+        self._heap = [(count, term) for term, count in self.counts.items()]
+        heapify(self._heap)
+
+    def rescore(self, estimate):
+        """Replace every count with `estimate(term)`, dropping the zeros."""
+
+        self.counts = {term: count for term, count in
+                       ((term, estimate(term)) for term in self.counts)
+                       if count > 0}
+        self._rebuild()
+
+    def items(self):
+        """(term, count) pairs, highest count first."""
+
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+class SlidingWindow:
+    """Term counts over the last `span` seconds, in `buckets` steps."""
+
+    def __init__(self, span, buckets, width, depth, k):
+        self.span = span
+        self.bucket_span = span / buckets
+        self.total = CountMinSketch(width, depth)
+        self.buckets = deque()  # (start time, CountMinSketch), oldest first
+        self.spare = [CountMinSketch(width, depth) for _ in range(buckets)]
+        self.top = TopK(k)
+
+    def advance(self, now):
+        """Slide the window forward to `now`."""
+
+        start = now - now % self.bucket_span
+
+        expired = False
+        while self.buckets and self.buckets[0][0] <= start - self.span:
+            _, sketch = self.buckets.popleft()
+            self.total.subtract(sketch)
+            sketch.clear()
+            self.spare.append(sketch)
+            expired = True
+
+        if expired:
+            self.top.rescore(lambda term: self.total.estimate(
+                self.total.indexes(term)))
+
+        if not self.buckets or self.buckets[-1][0] < start:
+            self.buckets.append((start, self.spare.pop()))
+
+    def add(self, term, indexes, now):
+        self.advance(now)
+        self.buckets[-1][1].add(indexes)
+        self.top.offer(term, self.total.add(indexes))
+
+
+class Trending:
+    """Trending terms over each of WINDOWS."""
+
+    def __init__(self, width=2048, depth=4, k=50, windows=WINDOWS):
+        self.windows = {name: SlidingWindow(span, buckets, width, depth, k)
+                        for name, (span, buckets) in windows.items()}
+        self._sketch = CountMinSketch(width, depth)  # for hashing terms
+        self._lock = Lock()
+
+    def record(self, text, now=None):
+        """Count the terms of a newly posted message."""
+
+        now = time.time() if now is None else now
+        terms = [(term, self._sketch.indexes(term))
+                 for term in message_terms(text)]
+
+        with self._lock:
+            for window in self.windows.values():
+                for term, indexes in terms:
+                    window.add(term, indexes, now)
+
+    def top(self, window, n=10, now=None):
+        """The `n` most frequent terms in `window` as (term, count) pairs."""
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            self.windows[window].advance(now)
+            return self.windows[window].top.items()[:n]
+
+
+def record_message(msg):
+    """Count a newly posted message towards trending terms."""
+
+    current_app.extensions['trending'].record(msg.text)
+
+
+def trending(window, n=10):
+    """Template global: the top `n` terms in `window` ('1h', '24h', '7d')."""
+
+    return current_app.extensions['trending'].top(window, n)
+
+
+def init_trending(app):
+    """Set up trending terms for `app`.
+
+    TRENDING_WIDTH and TRENDING_DEPTH size the count-min sketches, and
+    TRENDING_K is how many terms each window keeps track of. The counts
+    are this process's alone (see above).
+
+    You should call this in your Flask app.
+    """
+
+    app.config.setdefault('TRENDING_WIDTH', 2048)
+    app.config.setdefault('TRENDING_DEPTH', 4)
+    app.config.setdefault('TRENDING_K', 50)
+
+    engine = Trending(app.config['TRENDING_WIDTH'], app.config['TRENDING_DEPTH'],
+                      app.config['TRENDING_K'])
+    app.extensions['trending'] = engine
+    app.jinja_env.globals['trending'] = trending
+
+    return engine